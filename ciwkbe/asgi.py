@@ -2,6 +2,8 @@
 ASGI config for ciwkbe project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django, WebSocket connections go to the real-time chat
+delivery in qa.realtime.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ciwkbe.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from qa.realtime import websocket_application  # noqa: E402  needs django.setup() first
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,146 @@
+"""
+Multiplexed API requests.
+
+POST api/batch/ carries a list of sub-requests against the routes of
+qa/urls.py, e.g.
+
+    {"requests": [
+        {"method": "GET", "path": "/api/user/alice/"},
+        {"method": "GET", "path": "/api/chat/alice/?limit=10"},
+        {"method": "POST", "path": "/api/friendship/follow/", "body": {...}},
+    ]}
+
+They are dispatched in-process to the view functions, skipping the
+middleware, with the cookies of the batch request; the token is resolved
+once and handed to every sub-request. Consecutive GETs are independent
+and run concurrently on a thread pool, a POST runs alone, after every item
+before it, so a batch can read its own writes.
+Each item gets its own status code, headers and body.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlsplit
+import json
+import logging
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpRequest, QueryDict, Http404
+from django.urls import resolve, Resolver404
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_REQUESTS = getattr(settings, "BATCH_MAX_REQUESTS", 20)
+BATCH_MAX_WORKERS = getattr(settings, "BATCH_MAX_WORKERS", 4)
+BATCH_URLCONF = "qa.urls"
+BATCH_PATH = "/api/batch/"
+# 原样返回给客户端的响应头
+FORWARDED_HEADERS = ("ETag", "Last-Modified", "Cache-Control")
+
+_lock = Lock()
+_executor = None
+
+
+def private_get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="batch")
+    return _executor
+
+
+def private_item_result(status, body, headers=None):
+    return {"status": status, "headers": headers or {}, "body": body}
+
+
+def build_sub_request(request, item, auth_user):
+    """The HttpRequest of one item, raise ValueError if malformed"""
+    method = str(item.get("method", "GET")).upper()
+    if method not in ("GET", "POST"):
+        raise ValueError("unsupported method " + method)
+    url = urlsplit(str(item.get("path", "")))
+    sub = HttpRequest()
+    sub.method = method
+    sub.path = sub.path_info = url.path
+    sub.GET = QueryDict(url.query)
+    sub.COOKIES = request.COOKIES
+    # 批请求自身的条件请求头不适用于子请求
+    sub.META = {key: value for key, value in request.META.items()
+                if not key.startswith("HTTP_IF_") and key not in ("CONTENT_LENGTH", "CONTENT_TYPE")}
+    sub.META.update(REQUEST_METHOD=method, QUERY_STRING=url.query, CONTENT_TYPE="application/json")
+    for name, value in (item.get("headers") or {}).items():
+        sub.META["HTTP_" + name.upper().replace("-", "_")] = str(value)
+    if method == "POST":
+        sub._body = json.dumps(item.get("body") or {}).encode("utf-8")
+    if auth_user is not None:
+        sub.auth_user = auth_user
+    return sub
+
+
+def response_to_item(response):
+    content = response.content
+    if response.get("Content-Type", "").startswith("application/json"):
+        body = json.loads(content) if content else None
+    else:
+        body = content.decode(response.charset or "utf-8")
+    headers = {name: response[name] for name in FORWARDED_HEADERS if response.has_header(name)}
+    return private_item_result(response.status_code, body, headers)
+
+
+def run_item(request, item, auth_user):
+    try:
+        sub = build_sub_request(request, item, auth_user)
+        if sub.path_info.rstrip("/") == BATCH_PATH.rstrip("/"):
+            raise ValueError("nested batch")
+        match = resolve(sub.path_info, urlconf=BATCH_URLCONF)
+    except (ValueError, AttributeError, TypeError) as e:
+        return private_item_result(400, str(e))
+    except Resolver404:
+        return private_item_result(404, "Not found")
+    try:
+        return response_to_item(match.func(sub, *match.args, **match.kwargs))
+    except Http404:
+        return private_item_result(404, "Not found")
+    except Exception:
+        logger.exception("Batch sub-request %s %s failed", sub.method, sub.path)
+        return private_item_result(500, "Unknown error")
+
+
+def private_run_pooled(request, item, auth_user):
+    close_old_connections()
+    try:
+        return run_item(request, item, auth_user)
+    finally:
+        close_old_connections()
+
+
+def run_batch(request, items, auth_user=None, max_workers=None):
+    """Results of the items, in order"""
+    if max_workers is None:
+        max_workers = BATCH_MAX_WORKERS
+    results = [None] * len(items)
+    group = []
+
+    def run_group():
+        if len(group) == 1 or max_workers <= 1:
+            for i in group:
+                results[i] = run_item(request, items[i], auth_user)
+        else:
+            executor = private_get_executor()
+            futures = [(i, executor.submit(private_run_pooled, request, items[i], auth_user)) for i in group]
+            for i, future in futures:
+                results[i] = future.result()
+        group.clear()
+
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and str(item.get("method", "GET")).upper() == "GET":
+            group.append(i)
+            continue
+        run_group()
+        if isinstance(item, dict):
+            results[i] = run_item(request, item, auth_user)
+        else:
+            results[i] = private_item_result(400, "Sub-request must be an object")
+    run_group()
+    return results
@@ -0,0 +1,217 @@
+"""
+Chats between two users.
+
+A Chat stores its participants in canonical order, user_a < user_b (like
+Pair), under a unique constraint, so the chat of two users is found with
+one index probe and two concurrent "start chat" requests cannot create two
+chats.
+
+Messages are written together with the Last_Message pointer of their chat
+and the unread counter of the receiver (Read_Position) in one transaction,
+and deleted together with the counter when the receiver has not read them.
+A message may carry a client_key, unique per sender, so a client replaying
+its outbox never stores a message twice.
+"""
+from collections import defaultdict
+from secrets import token_urlsafe
+
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Sum
+
+from qa.counters import delta_expression
+from qa.models import Chat, Chat_Message, Last_Message, Read_Position
+from qa.pair import canonical_pair
+
+
+def get_or_create_chat(user_name, ano_user_name):
+    """(chat, created) of the two users"""
+    user_a, user_b = canonical_pair(user_name, ano_user_name)
+    # get_or_create 在唯一约束冲突时会重新读取
+    return Chat.objects.get_or_create(user_a_id=user_a, user_b_id=user_b)
+
+
+def chat_members(chat_ids) -> dict:
+    """{chat_id: (user_a, user_b)} of the existing chats"""
+    return {chat_id: (a, b) for chat_id, a, b in
+            Chat.objects.filter(pk__in=chat_ids).values_list("chat_id", "user_a_id", "user_b_id")}
+
+
+def ano_member(members, user_name):
+    """The other participant of a chat, None if user_name is not in it or
+    the other user was deleted"""
+    a, b = members
+    if user_name == a:
+        return b
+    if user_name == b:
+        return a
+    return None
+
+
+def point_last_messages(latest):
+    """Point Last_Message of each chat to its message, {chat_id: chat_message_id},
+    one UPDATE per chat plus one INSERT for the chats without a pointer"""
+    missing = [chat_id for chat_id, message_id in latest.items()
+               if not Last_Message.objects.filter(chat_id=chat_id).update(lattest_message=message_id)]
+    if missing:
+        Last_Message.objects.bulk_create([
+            Last_Message(chat_id_id=chat_id, lattest_message_id=latest[chat_id]) for chat_id in missing
+        ], ignore_conflicts=True)
+        # 并发插入时冲突的一方改为更新
+        for chat_id in missing:
+            Last_Message.objects.filter(chat_id=chat_id).update(lattest_message=latest[chat_id])
+
+
+def incr_unread(counts):
+    """Add {(chat_id, user_name): n} to the unread counters, one UPDATE per
+    chat and user plus one INSERT for the missing positions"""
+    missing = [key for key, n in counts.items()
+               if not Read_Position.objects.filter(chat_id=key[0], user_name=key[1]).update(unread_cnt=F("unread_cnt") + n)]
+    if missing:
+        Read_Position.objects.bulk_create([
+            Read_Position(chat_id_id=chat_id, user_name_id=user_name, unread_cnt=0) for chat_id, user_name in missing
+        ], ignore_conflicts=True)
+        for chat_id, user_name in missing:
+            Read_Position.objects.filter(chat_id=chat_id, user_name=user_name)\
+                .update(unread_cnt=F("unread_cnt") + counts[(chat_id, user_name)])
+
+
+def mark_read(chat_id, user_name, chat_message_id=None):
+    """user_name has read chat_id up to chat_message_id (the latest message
+    if None). Return the number of messages to the user still unread."""
+    messages = Chat_Message.objects.filter(chat_id=chat_id)
+    with transaction.atomic():
+        # 先锁住位置, 之后提交的新消息的计数会排在本次重置之后
+        position, _ = Read_Position.objects.select_for_update().get_or_create(chat_id_id=chat_id, user_name_id=user_name)
+        if chat_message_id is None:
+            chat_message_id = messages.order_by("-chat_message_id").values_list("pk", flat=True).first()
+        # 已读位置不会后退
+        if chat_message_id is not None and (position.last_read_message_id or 0) > chat_message_id:
+            return position.unread_cnt
+        unread = 0
+        if chat_message_id is not None:
+            unread = messages.filter(to_user=user_name, pk__gt=chat_message_id).count()
+        position.last_read_message_id = chat_message_id
+        position.unread_cnt = unread
+        position.save(update_fields=["last_read_message", "unread_cnt"])
+    return unread
+
+
+def read_positions(chat_ids) -> dict:
+    """{(chat_id, user_name): (last_read_message_id, unread_cnt)}"""
+    return {(chat_id, user_name): (last_read, unread) for chat_id, user_name, last_read, unread in
+            Read_Position.objects.filter(chat_id__in=chat_ids)
+            .values_list("chat_id_id", "user_name_id", "last_read_message_id", "unread_cnt")}
+
+
+def total_unread(user_name) -> int:
+    return Read_Position.objects.filter(user_name=user_name, unread_cnt__gt=0)\
+        .aggregate(total=Sum("unread_cnt"))["total"] or 0
+
+
+def post_message(chat_id, from_user, to_user, client_key=None, **fields):
+    """Store one message and point Last_Message to it.
+    Return (message, created); with a client_key already used by from_user,
+    the stored message and False."""
+    message = Chat_Message(chat_id_id=chat_id, from_user_id=from_user, to_user_id=to_user,
+                           client_key=client_key, **fields)
+    try:
+        with transaction.atomic():
+            message.save()
+            point_last_messages({chat_id: message.pk})
+            incr_unread({(chat_id, to_user): 1})
+    except IntegrityError:
+        if client_key is None:
+            raise
+        return Chat_Message.objects.get(from_user=from_user, client_key=client_key), False
+    return message, True
+
+
+def post_messages(from_user, messages):
+    """Store many messages of from_user, [{"chat_id", "to_user",
+    "client_key", **fields}] already validated, with one bulk INSERT and one
+    Last_Message update per chat.
+    Return [(message, created)] in the order of messages."""
+    for m in messages:
+        if not m.get("client_key"):
+            m["client_key"] = token_urlsafe(24)
+    keys = [m["client_key"] for m in messages]
+    with transaction.atomic():
+        stored = set(Chat_Message.objects.filter(from_user=from_user, client_key__in=keys)
+                     .values_list("client_key", flat=True))
+        new = {}
+        for m in messages:
+            if m["client_key"] not in stored and m["client_key"] not in new:
+                fields = {k: v for k, v in m.items() if k not in ("chat_id", "to_user")}
+                new[m["client_key"]] = Chat_Message(chat_id_id=m["chat_id"], from_user_id=from_user,
+                                                    to_user_id=m["to_user"], **fields)
+        # 不是每个数据库都会回填主键, 按幂等键取回
+        Chat_Message.objects.bulk_create(new.values(), batch_size=500, ignore_conflicts=True)
+        by_key = {message.client_key: message
+                  for message in Chat_Message.objects.filter(from_user=from_user, client_key__in=keys)}
+        latest, unread = {}, defaultdict(int)
+        for key in new:
+            message = by_key[key]
+            latest[message.chat_id_id] = max(latest.get(message.chat_id_id, 0), message.pk)
+            unread[(message.chat_id_id, message.to_user_id)] += 1
+        point_last_messages(latest)
+        incr_unread(unread)
+    result, created = [], set(new)
+    for m in messages:
+        # 同一批中重复的幂等键只算第一条为新写入
+        result.append((by_key[m["client_key"]], m["client_key"] in created))
+        created.discard(m["client_key"])
+    return result
+
+
+def private_merge_into(keeper, duplicates):
+    """Move the messages and unread counters of the duplicated chats into
+    keeper and delete them"""
+    unread = defaultdict(int)
+    for user_name, n in Read_Position.objects.filter(chat_id__in=duplicates).values_list("user_name_id", "unread_cnt"):
+        unread[(keeper, user_name)] += n
+    incr_unread(unread)
+    Chat_Message.objects.filter(chat_id__in=duplicates).update(chat_id=keeper)
+    Chat.objects.filter(pk__in=duplicates).delete()
+    latest = Chat_Message.objects.filter(chat_id=keeper).order_by("-created_time", "-chat_message_id")\
+        .values_list("pk", flat=True).first()
+    if latest is not None:
+        Last_Message.objects.update_or_create(chat_id_id=keeper, defaults={"lattest_message_id": latest})
+
+
+@transaction.atomic
+def merge_duplicate_chats(dry_run=False):
+    """Put every chat in canonical order and merge the chats of the same
+    two users into the oldest one, with their messages, Last_Message and
+    unread counters. Migration 0002 runs the same merge on historical models
+    before it creates the unique constraint on (user_a, user_b); only
+    dry_run works on a database not migrated yet.
+    Return (merged_cnt, reordered_cnt)."""
+    groups = defaultdict(list)
+    chats = Chat.objects.filter(user_a__isnull=False, user_b__isnull=False).order_by("chat_id")\
+        .values_list("chat_id", "user_a_id", "user_b_id")
+    for chat_id, a, b in chats.iterator(chunk_size=2000):
+        groups[canonical_pair(a, b)].append((chat_id, a, b))
+    merged_cnt = reordered_cnt = 0
+    for key, rows in groups.items():
+        keeper, a, b = rows[0]
+        duplicates = [row[0] for row in rows[1:]]
+        merged_cnt += len(duplicates)
+        reordered_cnt += (a, b) != key
+        if dry_run:
+            continue
+        if duplicates:
+            private_merge_into(keeper, duplicates)
+        if (a, b) != key:
+            Chat.objects.filter(pk=keeper).update(user_a_id=key[0], user_b_id=key[1])
+    return merged_cnt, reordered_cnt
+
+
+def delete_message(message):
+    """Delete the message, and take it out of the unread counter of the
+    receiver if it is after the last message the receiver has read"""
+    with transaction.atomic():
+        # 先于删除更新计数, 删除会把指向本消息的已读位置置空
+        Read_Position.objects.filter(chat_id=message.chat_id_id, user_name=message.to_user_id)\
+            .filter(Q(last_read_message__isnull=True) | Q(last_read_message__lt=message.pk))\
+            .update(unread_cnt=delta_expression("unread_cnt", -1))
+        message.delete()
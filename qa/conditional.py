@@ -0,0 +1,104 @@
+"""
+Conditional GET for read endpoints.
+
+Each endpoint declares the version stamps its response depends on, e.g.
+get_user_info depends on "profile:<user_name>". The write paths bump the
+stamps of what they change. The ETag is derived from the stamps (and the
+full path), Last-Modified from their latest bump, so answering a
+revalidation costs one indexed query on Version_Stamp and none of the
+endpoint's own queries:
+
+    @conditional_get(lambda request, user_name: [profile_stamp(user_name)])
+    def get_user_info(request, user_name): ...
+
+A response that embeds other users lists their profile stamps too, so the
+key function may run the (cheap) query that finds them.
+
+Commands that rewrite data in bulk bump EPOCH_STAMP, which every endpoint
+depends on.
+"""
+from calendar import timegm
+from datetime import datetime
+from functools import wraps
+import hashlib
+
+from django.db.models import F
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from qa.models import Version_Stamp
+
+# 响应格式变化时修改, 使所有旧 ETag 失效
+ETAG_FORMAT_VERSION = "1"
+EPOCH_STAMP = "epoch"
+INTIMACY_STAMP = "intimacy"
+
+
+def profile_stamp(user_name):
+    return "profile:{}".format(user_name)
+
+
+def moment_stamp(user_name):
+    return "moment:{}".format(user_name)
+
+
+def friendship_stamp(user_name):
+    return "friendship:{}".format(user_name)
+
+
+def pair_stamp(user_name):
+    return "pair:{}".format(user_name)
+
+
+def get_stamps(keys) -> dict:
+    """{key: (version, updated_time)}, (0, None) for a stamp never bumped"""
+    stamps = {key: (0, None) for key in keys}
+    for key, version, updated_time in Version_Stamp.objects.filter(key__in=list(stamps))\
+            .values_list("key", "version", "updated_time"):
+        stamps[key] = (version, updated_time)
+    return stamps
+
+
+def bump(*keys):
+    keys = sorted(set(keys))
+    now = datetime.now()
+    for k in range(0, len(keys), 500):
+        chunk = keys[k:k + 500]
+        updated = Version_Stamp.objects.filter(key__in=chunk).update(version=F("version") + 1, updated_time=now)
+        if updated < len(chunk):
+            existing = set(Version_Stamp.objects.filter(key__in=chunk).values_list("key", flat=True))
+            Version_Stamp.objects.bulk_create([
+                Version_Stamp(key=key, version=1, updated_time=now) for key in chunk if key not in existing
+            ], ignore_conflicts=True)
+
+
+def conditional_get(keys_func, max_age=0):
+    """Decorate a GET view whose response only changes when one of the
+    stamps keys_func(request, *args, **kwargs) is bumped. Only 200 responses
+    are tagged, the shared error responses of the views are left alone."""
+    def validators(request, *args, **kwargs):
+        stamps = get_stamps([EPOCH_STAMP] + list(keys_func(request, *args, **kwargs)))
+        raw = "|".join([ETAG_FORMAT_VERSION, request.get_full_path()]
+                       + ["{}={}".format(key, stamps[key][0]) for key in sorted(stamps)])
+        etag = quote_etag(hashlib.md5(raw.encode("utf-8")).hexdigest())
+        times = [t for _, t in stamps.values() if t is not None]
+        last_modified = timegm(max(times).utctimetuple()) if times else None
+        return etag, last_modified
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            etag, last_modified = validators(request, *args, **kwargs)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                response["ETag"] = etag
+                if last_modified is not None:
+                    response["Last-Modified"] = http_date(last_modified)
+            # 客户端每次都要带着 ETag 重新验证
+            patch_cache_control(response, private=True, no_cache=max_age == 0, max_age=max_age)
+            return response
+        return wrapper
+    return decorator
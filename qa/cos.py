@@ -1,19 +1,49 @@
-from qcloud_cos import CosConfig
-from qcloud_cos import CosS3Client
-import sys
-import logging
+"""
+Tencent COS settings and client, built on first use.
+
+cos.json is only read, and the CosS3Client only built, when something asks
+for them, so importing this module (and qa.views) costs nothing and does
+not need cos.json. `from qa.cos import client, settings` still works and
+triggers the lazy load.
+"""
+from threading import Lock
 import json
 import os
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+_lock = Lock()
+_settings = None
+_client = None
+
+
+def get_settings() -> dict:
+    global _settings
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                with open(os.path.join(BASE_DIR, "cos.json"), "r") as f:
+                    _settings = json.load(f)
+    return _settings
+
 
-settings = None
-with open(os.path.join(BASE_DIR, "cos.json"), "r") as f:
-  settings = json.load(f)
-print("cos: ", settings)
+def get_client():
+    global _client
+    if _client is None:
+        from qcloud_cos import CosConfig
+        from qcloud_cos import CosS3Client
+        cos_settings = get_settings()
+        with _lock:
+            if _client is None:
+                config = CosConfig(Region=cos_settings["region"], SecretId=cos_settings["secret_id"],
+                                   SecretKey=cos_settings["secret_key"])
+                _client = CosS3Client(config)
+    return _client
 
-config = CosConfig(Region=settings["region"], SecretId=settings["secret_id"], SecretKey=settings["secret_key"])
 
-client = CosS3Client(config)
+def __getattr__(name):
+    if name == "settings":
+        return get_settings()
+    if name == "client":
+        return get_client()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,128 @@
+"""
+Follower / follow counters of User_Info.
+
+Counter changes are applied as DB-side deltas (follower_cnt = follower_cnt + n),
+so concurrent follows of the same user never lose updates and only the two
+counter columns are written.
+
+With settings.COUNTER_WRITE_BEHIND the deltas are first summed in memory per
+user and flushed every COUNTER_FLUSH_INTERVAL seconds, users with the same
+delta in one UPDATE. This takes the hot User_Info row of a popular user out
+of every follow request, at the cost of the counters lagging by up to one
+interval (and losing the unflushed deltas if the process is killed, which
+the reconcile_follow_counts command repairs). Deltas enter the buffer when
+the surrounding transaction commits.
+"""
+from collections import defaultdict
+from threading import Lock, Thread, Event
+import atexit
+import logging
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F, Value, Case, When
+
+from qa import conditional, user_card
+from qa.models import User_Info
+
+logger = logging.getLogger(__name__)
+
+COUNTER_WRITE_BEHIND = getattr(settings, "COUNTER_WRITE_BEHIND", False)
+COUNTER_FLUSH_INTERVAL = getattr(settings, "COUNTER_FLUSH_INTERVAL", 1.0)
+
+
+def delta_expression(field, delta):
+    """field + delta, not below 0. The counters are unsigned, on MySQL
+    field - n raises out of range before GREATEST could clamp it, so
+    negative deltas only subtract where the result stays >= 0."""
+    if delta >= 0:
+        return F(field) + delta
+    return Case(When(**{field + "__gte": -delta}, then=F(field) + delta), default=Value(0))
+
+
+def apply_deltas(deltas):
+    """Apply {user_name: (follower_delta, follow_delta)} to User_Info,
+    one UPDATE per distinct delta"""
+    by_delta = defaultdict(list)
+    for user_name, delta in deltas.items():
+        if delta != (0, 0):
+            by_delta[delta].append(user_name)
+    with transaction.atomic():
+        for (follower_delta, follow_delta), user_names in by_delta.items():
+            fields = {}
+            if follower_delta:
+                fields["follower_cnt"] = delta_expression("follower_cnt", follower_delta)
+            if follow_delta:
+                fields["follow_cnt"] = delta_expression("follow_cnt", follow_delta)
+            for k in range(0, len(user_names), 500):
+                User_Info.objects.filter(pk__in=user_names[k:k + 500]).update(**fields)
+        # 用户资料含计数, 推荐依赖 follower_cnt 排序
+        user_names = [user_name for names in by_delta.values() for user_name in names]
+        # 提交后再清缓存, 以免并发读取把旧值重新放回缓存
+        transaction.on_commit(lambda: user_card.invalidate(*user_names))
+        # 只更新相关用户的版本号, 不再有全局热点行
+        conditional.bump(*(stamp(user_name) for user_name in user_names
+                           for stamp in (conditional.profile_stamp, conditional.pair_stamp)))
+
+
+class CounterBuffer:
+    """Sums counter deltas in memory, a daemon thread flushes them"""
+
+    def __init__(self, flush_interval=COUNTER_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._deltas = defaultdict(lambda: (0, 0))
+        self._stop = Event()
+        self._thread = None
+
+    def add(self, user_name, follower_delta=0, follow_delta=0):
+        with self._lock:
+            old = self._deltas[user_name]
+            self._deltas[user_name] = (old[0] + follower_delta, old[1] + follow_delta)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="counter-write-behind", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(lambda: (0, 0))
+        if not deltas:
+            return
+        try:
+            apply_deltas(deltas)
+        except Exception:
+            logger.exception("Fail to flush follow counters, retry in the next round")
+            with self._lock:
+                for user_name, (follower_delta, follow_delta) in deltas.items():
+                    old = self._deltas[user_name]
+                    self._deltas[user_name] = (old[0] + follower_delta, old[1] + follow_delta)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            close_old_connections()
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+_buffer = CounterBuffer() if COUNTER_WRITE_BEHIND else None
+if _buffer is not None:
+    atexit.register(_buffer.close)
+
+
+def change_follow_counts(follower, follow, delta):
+    """follower started (delta > 0) or stopped (delta < 0) following follow"""
+    if not delta:
+        return
+    if _buffer is not None:
+        # 事务提交后才计入缓冲, 回滚的关注不改变计数
+        def stage():
+            _buffer.add(follower, follow_delta=delta)
+            _buffer.add(follow, follower_delta=delta)
+        transaction.on_commit(stage)
+    elif follower == follow:
+        apply_deltas({follower: (delta, delta)})
+    else:
+        apply_deltas({follower: (0, delta), follow: (delta, 0)})
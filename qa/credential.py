@@ -0,0 +1,128 @@
+"""
+Cached COS STS credential.
+
+The temporary credential handed to clients for uploads lasts
+STS_DURATION_SECONDS and has the same policy for everyone, so one credential
+is reused until COS_CREDENTIAL_SAFETY_MARGIN seconds before it expires.
+Concurrent refreshes are coalesced into a single upstream call, and a
+daemon thread refreshes the credential before it goes stale so requests
+normally never wait for STS.
+
+The upstream call goes through an STS client, any object with a
+get_credential() method returning the STS response dict (with
+"expiredTime", a unix timestamp); tests use a local fake.
+"""
+from threading import Lock, Thread, Event
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+STS_DURATION_SECONDS = 7200
+COS_CREDENTIAL_SAFETY_MARGIN = getattr(settings, "COS_CREDENTIAL_SAFETY_MARGIN", 600)
+# 在失效前多久由后台线程刷新
+COS_CREDENTIAL_REFRESH_AHEAD = getattr(settings, "COS_CREDENTIAL_REFRESH_AHEAD", 300)
+REFRESH_RETRY_SECONDS = 30
+
+
+def build_sts_config(cos_settings):
+    return {
+        # 临时密钥有效时长，单位是秒
+        'duration_seconds': STS_DURATION_SECONDS,
+        'secret_id': cos_settings["secret_id"],
+        # 固定密钥
+        'secret_key': cos_settings["secret_key"],
+        # 换成你的 bucket
+        'bucket': cos_settings["bucket"],
+        # 换成 bucket 所在地区
+        'region': cos_settings["region"],
+        # 例子： a.jpg 或者 a/* 或者 * (使用通配符*存在重大安全风险, 请谨慎评估使用)
+        'allow_prefix': '*',
+        # 密钥的权限列表。简单上传和分片需要以下的权限，其他权限列表请看 https://cloud.tencent.com/document/product/436/31923
+        'allow_actions': [
+            # 简单上传
+            'name/cos:PutObject',
+            'name/cos:PostObject',
+            # 分片上传
+            'name/cos:InitiateMultipartUpload',
+            'name/cos:ListMultipartUploads',
+            'name/cos:ListParts',
+            'name/cos:UploadPart',
+            'name/cos:CompleteMultipartUpload'
+        ],
+    }
+
+
+def default_sts_client():
+    from sts.sts import Sts
+    from qa import cos
+    return Sts(build_sts_config(cos.get_settings()))
+
+
+class CredentialCache:
+    def __init__(self, client_factory=default_sts_client, safety_margin=COS_CREDENTIAL_SAFETY_MARGIN,
+                 refresh_ahead=COS_CREDENTIAL_REFRESH_AHEAD, background=True, clock=time.time):
+        self.client_factory = client_factory
+        self.safety_margin = safety_margin
+        self.refresh_ahead = refresh_ahead
+        self.background = background
+        self.clock = clock
+        self.upstream_cnt = 0
+        self._client = None
+        self._credential = None
+        self._refresh_lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _usable(self, credential):
+        return credential is not None and self.clock() < credential["expiredTime"] - self.safety_margin
+
+    def get(self) -> dict:
+        credential = self._credential
+        if not self._usable(credential):
+            credential = self.refresh(force=False)
+        if self.background and self._thread is None:
+            self._start_refresher()
+        return credential
+
+    def refresh(self, force=True) -> dict:
+        """Fetch a new credential. Callers arriving while a refresh is in
+        flight wait for it and share its result."""
+        stale = self._credential
+        with self._refresh_lock:
+            # 等锁期间别的线程已刷新
+            if self._credential is not stale or (not force and self._usable(self._credential)):
+                return self._credential
+            if self._client is None:
+                self._client = self.client_factory()
+            credential = dict(self._client.get_credential())
+            self.upstream_cnt += 1
+            self._credential = credential
+            return credential
+
+    def _start_refresher(self):
+        with self._refresh_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="cos-credential-refresher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            credential = self._credential
+            wait = credential["expiredTime"] - self.safety_margin - self.refresh_ahead - self.clock() if credential else 0
+            if self._stop.wait(max(wait, 1)):
+                return
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Fail to refresh COS credential, retry in %ds", REFRESH_RETRY_SECONDS)
+                if self._stop.wait(REFRESH_RETRY_SECONDS):
+                    return
+
+    def close(self):
+        self._stop.set()
+
+
+cos_credential = CredentialCache()
@@ -0,0 +1,100 @@
+"""
+Moment feeds.
+
+Totals come from maintained counters (Global_Counter "moment" and
+User_Info.moment_cnt, bumped by post_moment) instead of COUNT(*).
+The first page of each feed is cached in memory keyed by its total, so a
+new moment, posted through any worker process, changes the total and
+makes the cached page stale everywhere.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+
+from qa import conditional, user_card
+from qa.models import Moment, User_Info, Global_Counter
+from qa.serializer import serializer_for
+
+MOMENT_COUNTER = "moment"
+FIRST_PAGE_CACHE_SIZE = 1000
+
+
+def moment_total(user_name=None):
+    """Number of moments of the user, or of everyone. None if the user does not exist."""
+    if user_name is not None:
+        return User_Info.objects.filter(pk=user_name).values_list("moment_cnt", flat=True).first()
+    total = Global_Counter.objects.filter(pk=MOMENT_COUNTER).values_list("value", flat=True).first()
+    if total is None:
+        total = private_init_moment_counter()
+    return total
+
+
+def private_init_moment_counter():
+    total = Moment.objects.count()
+    try:
+        Global_Counter.objects.create(name=MOMENT_COUNTER, value=total)
+    except IntegrityError:
+        # 并发初始化
+        pass
+    return total
+
+
+def incr_moment_count(user_name):
+    User_Info.objects.filter(pk=user_name).update(moment_cnt=F("moment_cnt") + 1)
+    if not Global_Counter.objects.filter(pk=MOMENT_COUNTER).update(value=F("value") + 1):
+        private_init_moment_counter()
+    invalidate_first_pages(user_name)
+    transaction.on_commit(lambda: user_card.invalidate(user_name))
+    conditional.bump(conditional.profile_stamp(user_name), conditional.moment_stamp(user_name))
+
+
+def moment_rows(queryset, start, stop):
+    """Serialized moments queryset[start:stop], without building Moment instances"""
+    moment_serializer = serializer_for(Moment)
+    return moment_serializer.from_rows(queryset.values_list(*moment_serializer.attnames)[start:stop])
+
+
+def query_moments(user_name=None, before=None, limit=6):
+    """One page of serialized moments, newest first, after the keyset cursor
+    (created_time, moment_id) if given. Return (moments, has_more)."""
+    moments = Moment.objects.all() if user_name is None else Moment.objects.filter(user_name=user_name)
+    if before is not None:
+        moments = moments.filter(Q(created_time__lt=before[0]) | Q(created_time=before[0], moment_id__lt=before[1]))
+    moments = moment_rows(moments.order_by("-created_time", "-moment_id"), 0, limit + 1)
+    return moments[:limit], len(moments) > limit
+
+
+_lock = Lock()
+# (user_name, limit) -> (total, moments, has_more)
+_first_pages = OrderedDict()
+
+
+def first_page(user_name, total, limit):
+    """The cached first page of the feed, (serialized moments, has_more).
+    The cached dicts are shared, callers must not modify them."""
+    key = (user_name, limit)
+    with _lock:
+        entry = _first_pages.get(key)
+        if entry is not None and entry[0] == total:
+            _first_pages.move_to_end(key)
+            return entry[1], entry[2]
+    moments, has_more = query_moments(user_name, limit=limit)
+    with _lock:
+        _first_pages[key] = (total, moments, has_more)
+        _first_pages.move_to_end(key)
+        while len(_first_pages) > FIRST_PAGE_CACHE_SIZE:
+            _first_pages.popitem(last=False)
+    return moments, has_more
+
+
+def invalidate_first_pages(user_name):
+    with _lock:
+        for key in [k for k in _first_pages if k[0] is None or k[0] == user_name]:
+            del _first_pages[key]
+
+
+def clear():
+    with _lock:
+        _first_pages.clear()
@@ -0,0 +1,184 @@
+"""
+Chat intimacy between two users.
+
+Every message adds 1 to the weight of its direction (weight_a: user_a to
+user_b, weight_b: the reverse), and weights decay exponentially with a
+half-life of INTIMACY_HALF_LIFE_DAYS, so recent conversations count more.
+The mark (0-100) grows with the total weight and is scaled down when the
+conversation is one-sided:
+
+    volume = weight_a + weight_b
+    reciprocity = 2 * min(weight_a, weight_b) / volume
+    mark = 100 * (1 - exp(-volume / INTIMACY_VOLUME_SCALE)) * (0.5 + 0.5 * reciprocity)
+
+The compute_intimacy command streams Chat_Message in id order from a
+high-water mark kept in Global_Counter, one batch per transaction, so a run
+only reads the messages posted since the last one and memory is bounded by
+the batch size. Ids are assigned at insert but become visible at commit, so
+a message with a lower id can appear after a higher one was read. A run
+therefore stops at the first message younger than INTIMACY_SAFETY_LAG_SECONDS;
+a transaction that takes longer than that to commit is still missed.
+Stored weights refer to updated_time; readers decay them to now,
+initmacy_mark is the mark at the last update and is only used to rank.
+
+Deleting a message (delete_chat_message) does not take it out of the
+weights: a message already folded in keeps counting until it decays, and
+only a --full rescan forgets it.
+"""
+from datetime import datetime, timedelta
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from qa.models import Chat_Message, Intimacy, Global_Counter
+from qa.pair import canonical_pair
+
+INTIMACY_HALF_LIFE_DAYS = getattr(settings, "INTIMACY_HALF_LIFE_DAYS", 30)
+INTIMACY_VOLUME_SCALE = getattr(settings, "INTIMACY_VOLUME_SCALE", 20.0)
+INTIMACY_SAFETY_LAG_SECONDS = getattr(settings, "INTIMACY_SAFETY_LAG_SECONDS", 60)
+HIGH_WATER_MARK = "intimacy_high_water_mark"
+
+DECAY_RATE = math.log(2) / (INTIMACY_HALF_LIFE_DAYS * 86400)
+
+
+def decay(weight, seconds):
+    """weight after seconds, no growth for negative seconds"""
+    return weight * math.exp(-DECAY_RATE * max(seconds, 0))
+
+
+def intimacy_mark(weight_a, weight_b) -> int:
+    volume = weight_a + weight_b
+    if volume <= 0:
+        return 0
+    reciprocity = 2 * min(weight_a, weight_b) / volume
+    return int(round(100 * (1 - math.exp(-volume / INTIMACY_VOLUME_SCALE)) * (0.5 + 0.5 * reciprocity)))
+
+
+def current_mark(intimacy, now=None):
+    """The mark of the Intimacy row decayed to now"""
+    if intimacy.updated_time is None:
+        return 0
+    seconds = ((now or datetime.now()) - intimacy.updated_time).total_seconds()
+    return intimacy_mark(decay(intimacy.weight_a, seconds), decay(intimacy.weight_b, seconds))
+
+
+def add_message(intimacy, from_user, created_time):
+    """Add one message of from_user to the weights of the row"""
+    if intimacy.updated_time is None:
+        intimacy.updated_time = created_time
+    seconds = (created_time - intimacy.updated_time).total_seconds()
+    if seconds > 0:
+        intimacy.weight_a = decay(intimacy.weight_a, seconds)
+        intimacy.weight_b = decay(intimacy.weight_b, seconds)
+        intimacy.updated_time = created_time
+    # 晚到的旧消息按其时间衰减后计入
+    weight = decay(1, -seconds)
+    if from_user == intimacy.user_a_id:
+        intimacy.weight_a += weight
+    else:
+        intimacy.weight_b += weight
+
+
+def high_water_mark() -> int:
+    value = Global_Counter.objects.filter(pk=HIGH_WATER_MARK).values_list("value", flat=True).first()
+    return value or 0
+
+
+@transaction.atomic
+def apply_batch(rows, last_id, now=None):
+    """Fold [(from_user, to_user, created_time)] into Intimacy and move the
+    high-water mark to last_id. Return the number of pairs touched."""
+    keys = {canonical_pair(from_user, to_user) for from_user, to_user, _ in rows}
+    if keys:
+        existing, sorted_keys = {}, sorted(keys)
+        # 分块查询, 控制 IN 的参数个数
+        for k in range(0, len(sorted_keys), 400):
+            chunk = sorted_keys[k:k + 400]
+            for i in Intimacy.objects.filter(user_a__in={a for a, _ in chunk}, user_b__in={b for _, b in chunk}):
+                if (i.user_a_id, i.user_b_id) in keys:
+                    existing[(i.user_a_id, i.user_b_id)] = i
+        new = {key: Intimacy(user_a_id=key[0], user_b_id=key[1]) for key in keys if key not in existing}
+        rows_by_key = {**existing, **new}
+        for from_user, to_user, created_time in rows:
+            add_message(rows_by_key[canonical_pair(from_user, to_user)], from_user, created_time)
+        for intimacy in rows_by_key.values():
+            intimacy.initmacy_mark = current_mark(intimacy, now)
+        if existing:
+            Intimacy.objects.bulk_update(existing.values(), ["weight_a", "weight_b", "updated_time", "initmacy_mark"],
+                                         batch_size=500)
+        Intimacy.objects.bulk_create(new.values(), batch_size=500)
+    Global_Counter.objects.update_or_create(name=HIGH_WATER_MARK, defaults={"value": last_id})
+    return len(keys)
+
+
+def stream(batch_size=10000, chunk_size=2000, now=None, lag=INTIMACY_SAFETY_LAG_SECONDS):
+    """Process the messages above the high-water mark and older than lag
+    seconds, one batch per transaction. Yield (last_id, messages, pairs)
+    after every batch."""
+    last_id = high_water_mark()
+    cutoff = datetime.now() - timedelta(seconds=lag)
+    while True:
+        messages = Chat_Message.objects.filter(pk__gt=last_id).order_by("pk")\
+            .values_list("pk", "from_user_id", "to_user_id", "created_time")[:batch_size]
+        rows, n, done = [], 0, False
+        for pk, from_user, to_user, created_time in messages.iterator(chunk_size=chunk_size):
+            # 较新的消息之前可能还有未提交的, 留到下次
+            if created_time >= cutoff:
+                done = True
+                break
+            n += 1
+            last_id = pk
+            # 已删除的用户和发给自己的消息不计
+            if from_user and to_user and from_user != to_user:
+                rows.append((from_user, to_user, created_time))
+        if n:
+            yield last_id, n, apply_batch(rows, last_id, now)
+        if done or not n:
+            return
+
+
+def rescore(chunk_size=2000, now=None):
+    """Rewrite initmacy_mark of every row decayed to now, so the ranking
+    also ages for pairs without new messages. Return the number of rows."""
+    now = now or datetime.now()
+    last_pk, total = 0, 0
+    while True:
+        chunk = list(Intimacy.objects.filter(pk__gt=last_pk).order_by("pk")[:chunk_size])
+        if not chunk:
+            return total
+        for intimacy in chunk:
+            intimacy.initmacy_mark = current_mark(intimacy, now)
+        Intimacy.objects.bulk_update(chunk, ["initmacy_mark"], batch_size=500)
+        last_pk, total = chunk[-1].pk, total + len(chunk)
+
+
+def reset():
+    Intimacy.objects.all().delete()
+    Global_Counter.objects.filter(pk=HIGH_WATER_MARK).delete()
+
+
+def intimacy_marks(user_name, others, now=None) -> dict:
+    """{other: current mark} of user_name with each of others, one query
+    on the (user_a, user_b) unique index"""
+    others = [other for other in others if other and other != user_name]
+    if not others:
+        return {}
+    query = Q(user_a=user_name, user_b__in=[o for o in others if o > user_name]) \
+        | Q(user_b=user_name, user_a__in=[o for o in others if o < user_name])
+    marks = {}
+    for intimacy in Intimacy.objects.filter(query):
+        other = intimacy.user_b_id if intimacy.user_a_id == user_name else intimacy.user_a_id
+        marks[other] = current_mark(intimacy, now)
+    return marks
+
+
+def top_intimate(user_name, k=5):
+    """[(other, mark)] of the k most intimate users, by the stored mark"""
+    rows = list(Intimacy.objects.filter(user_a=user_name).order_by("-initmacy_mark")
+                .values_list("user_b_id", "initmacy_mark")[:k])
+    rows += Intimacy.objects.filter(user_b=user_name).order_by("-initmacy_mark")\
+        .values_list("user_a_id", "initmacy_mark")[:k]
+    rows.sort(key=lambda row: -row[1])
+    return [row for row in rows if row[0] is not None][:k]
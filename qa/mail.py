@@ -0,0 +1,216 @@
+"""
+Outbound email pipeline.
+
+Views build the message and put it on outbox, which returns at once.
+MAIL_QUEUE_WORKERS threads drain the queue, each over its own SMTP
+connection that is opened once and reused until it fails. A worker sends
+the messages waiting in the queue, up to MAIL_BATCH_SIZE, with one
+send_messages call. A failed message is retried with exponential backoff
+up to MAIL_MAX_RETRIES times, the messages after it in its batch go back
+to the queue.
+
+The HTML templates are read and compiled once, at import time.
+"""
+from queue import Queue, Empty
+from threading import Lock, Thread
+import logging
+import os
+import re
+import smtplib
+import socket
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAIL_QUEUE_WORKERS = getattr(settings, "MAIL_QUEUE_WORKERS", 2)
+MAIL_MAX_RETRIES = getattr(settings, "MAIL_MAX_RETRIES", 5)
+MAIL_RETRY_BASE_DELAY = getattr(settings, "MAIL_RETRY_BASE_DELAY", 1.0)
+# 一个连接连续发送的最大邮件数, 之后重新连接
+MAIL_MESSAGES_PER_CONNECTION = getattr(settings, "MAIL_MESSAGES_PER_CONNECTION", 100)
+# 一次 send_messages 调用发送的最大邮件数
+MAIL_BATCH_SIZE = getattr(settings, "MAIL_BATCH_SIZE", 20)
+
+RETRY_EXCEPTIONS = (smtplib.SMTPException, socket.error)
+
+
+class CompiledTemplate:
+    """Template with --name-- placeholders, split once into literal text and
+    placeholder names so rendering is a single join"""
+    PLACEHOLDER = re.compile(r"--(\w+)--")
+
+    def __init__(self, source: str):
+        self.parts = self.PLACEHOLDER.split(source)
+
+    @classmethod
+    def from_file(cls, file_name):
+        with open(os.path.join(BASE_DIR, file_name), "r") as f:
+            return cls(f.read())
+
+    def render(self, **values) -> str:
+        # 奇数位是占位符名
+        return "".join(
+            part if i % 2 == 0 else values.get(part, "--{}--".format(part))
+            for i, part in enumerate(self.parts)
+        )
+
+
+VALIDATE_EMAIL_TEMPLATE = CompiledTemplate.from_file("email.html")
+RESET_PASSWORD_EMAIL_TEMPLATE = CompiledTemplate.from_file("email-reset-psw.html")
+
+
+def build_validate_email(user, from_email) -> EmailMultiAlternatives:
+    text_content = "This is a validation email, please copy the following code: {} and finish validation\n".format(user.email_code)\
+        + "这是一封验证邮件：请复制验证码: {} 完成注册".format(user.email_code)
+    message = EmailMultiAlternatives(subject="Confirm your email 验证电子邮箱", body=text_content,
+                                     from_email=from_email, to=[user.email])
+    message.attach_alternative(VALIDATE_EMAIL_TEMPLATE.render(code=user.email_code, user=user.user_name), "text/html")
+    return message
+
+
+def build_reset_password_email(user, from_email) -> EmailMultiAlternatives:
+    text_content = "This is a validation email, please copy the following code: {} and finish validation\n".format(user.email_code)\
+        + "这是一封验证邮件：请复制验证码: {} 完成修改".format(user.email_code)
+    message = EmailMultiAlternatives(subject="Reset password 重置您的密码", body=text_content,
+                                     from_email=from_email, to=[user.email])
+    message.attach_alternative(RESET_PASSWORD_EMAIL_TEMPLATE.render(code=user.email_code), "text/html")
+    return message
+
+
+class MailQueue:
+    def __init__(self, workers=MAIL_QUEUE_WORKERS, connection_factory=None,
+                 max_retries=MAIL_MAX_RETRIES, retry_base_delay=MAIL_RETRY_BASE_DELAY):
+        self.workers = workers
+        self.connection_factory = connection_factory or (lambda: get_connection(fail_silently=False))
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.sent_cnt = 0
+        self.failed_cnt = 0
+        self._pending_retries = 0
+        self._queue = Queue()
+        self._lock = Lock()
+        self._threads = []
+
+    def send(self, message):
+        """Queue the message and return at once"""
+        self._queue.put((message, 0))
+        if not self._threads:
+            with self._lock:
+                if not self._threads:
+                    for i in range(self.workers):
+                        thread = Thread(target=self._run, name="mail-worker-{}".format(i), daemon=True)
+                        thread.start()
+                        self._threads.append(thread)
+
+    def join(self):
+        """Block until every queued message is sent or given up"""
+        while True:
+            self._queue.join()
+            with self._lock:
+                if not self._pending_retries:
+                    return
+            time.sleep(0.05)
+
+    def _take_batch(self, batch, connection, used):
+        """Wait for a message, make sure the connection is open, then add the
+        queued messages that fit on it to batch. Return (connection, used)."""
+        batch.append(self._queue.get())
+        if connection is None or used >= MAIL_MESSAGES_PER_CONNECTION:
+            connection = self._reconnect(connection)
+            used = 0
+        limit = min(MAIL_BATCH_SIZE, MAIL_MESSAGES_PER_CONNECTION - used)
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return connection, used
+
+    @staticmethod
+    def _iter_batch(batch, taken):
+        # 后端逐条取出并发送, taken 记录取到第几条, 出错时即可知道哪条失败
+        for item in batch:
+            taken.append(item)
+            yield item[0]
+
+    def _run(self):
+        connection, used = None, 0
+        while True:
+            batch, taken = [], []
+            try:
+                connection, used = self._take_batch(batch, connection, used)
+                connection.send_messages(self._iter_batch(batch, taken))
+                used += len(batch)
+                with self._lock:
+                    self.sent_cnt += len(batch)
+            except RETRY_EXCEPTIONS as e:
+                connection = self._close(connection)
+                self._after_failure(batch, taken, lambda message, attempt: self._retry(message, attempt, e))
+            except Exception:
+                connection = self._close(connection)
+
+                def give_up(message, attempt):
+                    logger.exception("Fail to send email to %s", message.to)
+                    with self._lock:
+                        self.failed_cnt += 1
+                self._after_failure(batch, taken, give_up)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _after_failure(self, batch, taken, on_failed):
+        """The messages before the last taken one were sent, the last taken
+        one failed and the rest were not tried and go back to the queue.
+        Nothing taken means the connection failed, every message failed."""
+        if not taken:
+            failed, untried = batch, []
+        else:
+            failed, untried = taken[-1:], batch[len(taken):]
+        with self._lock:
+            self.sent_cnt += len(taken[:-1])
+        for message, attempt in failed:
+            on_failed(message, attempt)
+        for item in untried:
+            self._queue.put(item)
+
+    def _reconnect(self, connection):
+        self._close(connection)
+        connection = self.connection_factory()
+        connection.open()
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        return None
+
+    def _retry(self, message, attempt, error):
+        if attempt + 1 >= self.max_retries:
+            logger.error("Give up sending email to %s after %d attempts: %s", message.to, attempt + 1, error)
+            with self._lock:
+                self.failed_cnt += 1
+            return
+        delay = self.retry_base_delay * 2 ** attempt
+        logger.warning("Fail to send email to %s (%s), retry in %.1fs", message.to, error, delay)
+        # 在定时线程里延迟放回队列, 不阻塞当前 worker
+        with self._lock:
+            self._pending_retries += 1
+        timer = Thread(target=self._requeue, args=(message, attempt + 1, delay), daemon=True)
+        timer.start()
+
+    def _requeue(self, message, attempt, delay):
+        time.sleep(delay)
+        self._queue.put((message, attempt))
+        with self._lock:
+            self._pending_retries -= 1
+
+
+outbox = MailQueue()
@@ -0,0 +1,348 @@
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_urlsafe
+from threading import Lock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from qa import synthetic
+from qa.management.commands.bench_search import percentile
+from qa.models import Chat, User
+
+SEARCH_WORDS = ["图书馆", "考试", "hello", "食堂 吃饭"]
+
+
+# 每个场景返回 (method, path, body, token), 由当前用户 me 和被访问的用户 other 构造
+def private_chat_of(ctx, rng, me):
+    chats = ctx["chats_of"].get(me)
+    return rng.choice(chats) if chats else None
+
+
+def scenario_user_info(ctx, rng, me, other):
+    return "GET", "/api/user/{}/".format(other), None, me
+
+
+def scenario_user_cards(ctx, rng, me, other):
+    names = rng.sample(ctx["users"], min(10, len(ctx["users"])))
+    return "GET", "/api/users/batch/?" + urlencode({"user_names": ",".join(names)}), None, me
+
+
+def scenario_chat_list(ctx, rng, me, other):
+    return "GET", "/api/chat/{}/".format(me), None, me
+
+
+def scenario_chat_messages(ctx, rng, me, other):
+    chat_id = private_chat_of(ctx, rng, me)
+    if chat_id is None:
+        return None
+    return "GET", "/api/chat-message/{}/?limit=20".format(chat_id), None, me
+
+
+def scenario_chat_unread(ctx, rng, me, other):
+    return "GET", "/api/chat-unread/", None, me
+
+
+def scenario_follower(ctx, rng, me, other):
+    return "GET", "/api/friendship/follower/{}/".format(other), None, me
+
+
+def scenario_follow(ctx, rng, me, other):
+    return "GET", "/api/friendship/follow/{}/".format(other), None, me
+
+
+def scenario_pair(ctx, rng, me, other):
+    return "GET", "/api/pair/{}/".format(me), None, me
+
+
+def scenario_pair_initial(ctx, rng, me, other):
+    return "GET", "/api/pair-initial/{}/".format(me), None, me
+
+
+def scenario_user_moments(ctx, rng, me, other):
+    return "GET", "/api/moment/user/{}/".format(other), None, me
+
+
+def scenario_lattest_moments(ctx, rng, me, other):
+    return "GET", "/api/moment/lattest/", None, me
+
+
+def scenario_timeline(ctx, rng, me, other):
+    return "GET", "/api/moment/timeline/{}/".format(me), None, me
+
+
+def scenario_search_moment(ctx, rng, me, other):
+    return "GET", "/api/search/moment/?" + urlencode({"q": rng.choice(SEARCH_WORDS)}), None, me
+
+
+def scenario_post_chat_message(ctx, rng, me, other):
+    chat_id = private_chat_of(ctx, rng, me)
+    if chat_id is None:
+        return None
+    body = {"user_name": me, "chat_id": chat_id, "content": synthetic.random_text(rng), "client_key": token_urlsafe(16)}
+    return "POST", "/api/chat-message/", body, me
+
+
+def scenario_post_chat_read(ctx, rng, me, other):
+    chat_id = private_chat_of(ctx, rng, me)
+    if chat_id is None:
+        return None
+    return "POST", "/api/chat-read/", {"user_name": me, "chat_id": chat_id}, me
+
+
+def scenario_post_moment(ctx, rng, me, other):
+    return "POST", "/api/moment/", {"user_name": me, "content": synthetic.random_text(rng)}, me
+
+
+def scenario_post_follow(ctx, rng, me, other):
+    if me == other:
+        return None
+    return "POST", "/api/friendship/follow/", {"user_name": me, "follow_user_name": other}, me
+
+
+def scenario_batch(ctx, rng, me, other):
+    requests = [
+        {"method": "GET", "path": "/api/user/{}/".format(other)},
+        {"method": "GET", "path": "/api/chat/{}/?limit=10".format(me)},
+        {"method": "GET", "path": "/api/chat-unread/"},
+    ]
+    return "POST", "/api/batch/", {"requests": requests}, me
+
+
+# {name: (default weight, scenario)}, 权重大致按读多写少的线上比例
+ENDPOINTS = {
+    "get_user_info": (15, scenario_user_info),
+    "get_user_cards": (5, scenario_user_cards),
+    "get_chat": (10, scenario_chat_list),
+    "get_chat_message": (12, scenario_chat_messages),
+    "get_total_unread": (8, scenario_chat_unread),
+    "get_follower": (4, scenario_follower),
+    "get_follow": (4, scenario_follow),
+    "get_pair_degree": (3, scenario_pair),
+    "get_initialize_pair": (1, scenario_pair_initial),
+    "get_user_moments": (8, scenario_user_moments),
+    "get_lattest_moments": (6, scenario_lattest_moments),
+    "get_timeline": (8, scenario_timeline),
+    "search_moment": (0, scenario_search_moment),
+    "post_chat_message": (6, scenario_post_chat_message),
+    "post_chat_read": (4, scenario_post_chat_read),
+    "post_moment": (2, scenario_post_moment),
+    "post_follow": (1, scenario_post_follow),
+    "post_batch": (3, scenario_batch),
+}
+
+
+def parse_mix(value):
+    """{name: weight} from "get_user_info=10,post_moment=2", the other
+    endpoints keep their default weight"""
+    weights = {name: weight for name, (weight, _) in ENDPOINTS.items()}
+    for item in filter(None, (value or "").split(",")):
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise CommandError("Unknown endpoint {}, one of {}".format(name, ", ".join(ENDPOINTS)))
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise CommandError("Bad weight in {}".format(item))
+    weights = {name: weight for name, weight in weights.items() if weight > 0}
+    if not weights:
+        raise CommandError("The mix is empty")
+    return weights
+
+
+class QueryCounter:
+    """connection.execute_wrapper that counts the queries of the current thread"""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = "Load a synthetic dataset (qa/synthetic.py) and replay a weighted mix of the qa endpoints "\
+           "through the Django test client, or a running server with --base-url. "\
+           "Report latency percentiles, throughput and queries per request of every endpoint. "\
+           "It writes to the configured database, so it refuses to run on anything but SQLite without --force."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--follows-per-user", type=int, default=20)
+        parser.add_argument("--chats", type=int, default=2000)
+        parser.add_argument("--messages", type=int, default=50000)
+        parser.add_argument("--moments", type=int, default=20000)
+        parser.add_argument("--tags-per-user", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--reuse", action="store_true", help="Keep the synthetic data of a previous run")
+        parser.add_argument("--keep", action="store_true", help="Do not delete the synthetic data at the end")
+        parser.add_argument("--requests", type=int, default=2000, help="Total number of requests")
+        parser.add_argument("--warmup", type=int, default=100, help="Requests run before measuring")
+        parser.add_argument("--concurrency", type=int, default=4, help="Client threads")
+        parser.add_argument("--mix", help='Endpoint weights, e.g. "get_user_info=10,post_moment=0"')
+        parser.add_argument("--base-url", help="Send the requests to this server instead of the test client")
+        parser.add_argument("--output", help="Write the JSON report to this file")
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+        parser.add_argument("--force", action="store_true", help="Run on a database other than SQLite")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite" and not options["force"]:
+            raise CommandError("The database is {}, not SQLite. The benchmark loads and deletes synthetic users "
+                               "and posts through the endpoints; pass --force to run it anyway".format(connection.vendor))
+        if options["requests"] < 1 or options["concurrency"] < 1 or options["warmup"] < 0:
+            raise CommandError("--requests and --concurrency must be positive")
+        weights = parse_mix(options["mix"])
+        if not options["reuse"]:
+            synthetic.cleanup()
+            synthetic.generate(users=options["users"], follows_per_user=options["follows_per_user"],
+                               chats=options["chats"], messages=options["messages"], moments=options["moments"],
+                               tags_per_user=options["tags_per_user"], seed=options["seed"])
+        try:
+            ctx = self.load_context()
+            if not ctx["users"]:
+                raise CommandError("No synthetic data, run without --reuse")
+            rng = random.Random(options["seed"])
+            names, cum_weights = list(weights), []
+            for name in names:
+                cum_weights.append((cum_weights[-1] if cum_weights else 0) + weights[name])
+            plan = []
+            # 活跃用户和被访问的用户都偏向热门用户
+            for _ in range(options["warmup"] + options["requests"]):
+                name = rng.choices(names, cum_weights=cum_weights)[0]
+                me, other = rng.choices(ctx["users"], ctx["popularity"], k=2)
+                call = ENDPOINTS[name][1](ctx, rng, me, other)
+                if call is not None:
+                    plan.append((name,) + call)
+            send = self.base_url_sender(options["base_url"]) if options["base_url"] else self.client_sender()
+            self.run_plan(plan[:options["warmup"]], send, options["concurrency"])
+            start = time.perf_counter()
+            results = self.run_plan(plan[options["warmup"]:], send, options["concurrency"])
+            elapsed = time.perf_counter() - start
+        finally:
+            if not options["keep"]:
+                synthetic.cleanup()
+        report = self.make_report(results, elapsed, options, weights)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+        self.stdout.write("{:<22} {:>6} {:>6} {:>9} {:>9} {:>9} {:>8}".format(
+            "endpoint", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "queries"))
+        for name, r in sorted(report["endpoints"].items()):
+            self.stdout.write("{:<22} {:>6} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8}".format(
+                name, r["count"], r["errors"], r["p50_ms"], r["p95_ms"], r["p99_ms"],
+                "-" if r["queries_per_request"] is None else "{:.1f}".format(r["queries_per_request"])))
+        total = report["total"]
+        self.stdout.write(self.style.SUCCESS("{} requests in {:.2f} s, {:.1f} req/s, {} errors".format(
+            total["count"], total["elapsed_s"], total["throughput_rps"], total["errors"])))
+
+    def load_context(self):
+        users = list(User.objects.filter(user_name__startswith=synthetic.SYNTHETIC_PREFIX)
+                     .order_by("-user_info__follower_cnt", "user_name").values_list("user_name", flat=True))
+        chats_of = {}
+        for chat_id, a, b in Chat.objects.filter(user_a__in=users).values_list("chat_id", "user_a_id", "user_b_id"):
+            chats_of.setdefault(a, []).append(chat_id)
+            chats_of.setdefault(b, []).append(chat_id)
+        return {"users": users, "popularity": [1 / (i + 1) for i in range(len(users))], "chats_of": chats_of}
+
+    def client_sender(self):
+        def send(method, path, body, token):
+            client = Client()
+            client.cookies["token"] = token
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                if method == "GET":
+                    response = client.get(path)
+                else:
+                    response = client.post(path, json.dumps(body), content_type="application/json")
+            return response.status_code, counter.count
+        return send
+
+    def base_url_sender(self, base_url):
+        def send(method, path, body, token):
+            data = json.dumps(body).encode() if method == "POST" else None
+            request = Request(base_url.rstrip("/") + path, data=data, method=method,
+                              headers={"Cookie": "token=" + token, "Content-Type": "application/json"})
+            try:
+                with urlopen(request, timeout=30) as response:
+                    response.read()
+                    return response.status, None
+            except HTTPError as e:
+                return e.code, None
+        return send
+
+    def run_plan(self, plan, send, concurrency):
+        """[(name, status, ms, queries)] of the calls of the plan"""
+        def run(call):
+            name, method, path, body, token = call
+            start = time.perf_counter()
+            try:
+                status, queries = send(method, path, body, token)
+            except Exception as e:
+                self.stderr.write("{} {}: {!r}".format(method, path, e))
+                status, queries = 500, None
+            return name, status, (time.perf_counter() - start) * 1000, queries
+
+        # 单线程时在当前连接上执行, 测试库的事务只对当前线程可见
+        if concurrency == 1:
+            return [run(call) for call in plan]
+        lock, results = Lock(), []
+
+        def worker(calls):
+            try:
+                for call in calls:
+                    result = run(call)
+                    with lock:
+                        results.append(result)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, [plan[k::concurrency] for k in range(concurrency)]))
+        return results
+
+    def make_report(self, results, elapsed, options, weights):
+        by_name = {}
+        for name, status, ms, queries in results:
+            by_name.setdefault(name, []).append((status, ms, queries))
+        endpoints = {}
+        for name, rows in by_name.items():
+            samples = [ms for _, ms, _ in rows]
+            queries = [q for _, _, q in rows if q is not None]
+            statuses = {}
+            for status, _, _ in rows:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            endpoints[name] = {
+                "count": len(rows),
+                "errors": sum(1 for status, _, _ in rows if status >= 500),
+                "status": statuses,
+                "mean_ms": statistics.mean(samples),
+                "p50_ms": percentile(samples, 50),
+                "p95_ms": percentile(samples, 95),
+                "p99_ms": percentile(samples, 99),
+                "queries_per_request": statistics.mean(queries) if queries else None,
+            }
+        samples = [ms for _, _, ms, _ in results]
+        return {
+            "config": {key: options[key] for key in ("users", "follows_per_user", "chats", "messages", "moments",
+                                                     "seed", "requests", "warmup", "concurrency", "base_url")},
+            "mix": weights,
+            "endpoints": endpoints,
+            "total": {
+                "count": len(results),
+                "errors": sum(r["errors"] for r in endpoints.values()),
+                "elapsed_s": elapsed,
+                "throughput_rps": len(results) / elapsed if elapsed else 0,
+                "p50_ms": percentile(samples, 50) if samples else 0,
+                "p99_ms": percentile(samples, 99) if samples else 0,
+            },
+        }
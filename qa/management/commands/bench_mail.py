@@ -0,0 +1,55 @@
+import json
+import time
+from types import SimpleNamespace
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from qa.mail import MailQueue, build_validate_email
+from qa.smtp_sink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = "Measure the throughput of the mail queue against a local SMTP sink"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=2)
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+
+    def handle(self, *args, **options):
+        sink = SMTPSink()
+        sink.start()
+        factory = lambda: get_connection("django.core.mail.backends.smtp.EmailBackend", host="127.0.0.1",
+                                         port=sink.port, username="", password="", use_tls=False,
+                                         use_ssl=False, fail_silently=False)
+        queue = MailQueue(workers=options["workers"], connection_factory=factory, retry_base_delay=0.1)
+        messages = [
+            build_validate_email(SimpleNamespace(user_name="bench{}".format(i), email="bench{}@example.com".format(i),
+                                                 email_code="123456"), "TeaPal <bench@example.com>")
+            for i in range(options["messages"])
+        ]
+
+        start = time.perf_counter()
+        for message in messages:
+            queue.send(message)
+        enqueue_seconds = time.perf_counter() - start
+        queue.join()
+        seconds = time.perf_counter() - start
+        sink.shutdown()
+
+        report = {
+            "messages": len(messages),
+            "workers": options["workers"],
+            "sent": queue.sent_cnt,
+            "failed": queue.failed_cnt,
+            "received": sink.message_cnt,
+            "enqueue_us_per_message": enqueue_seconds / len(messages) * 1e6,
+            "seconds": seconds,
+            "messages_per_second": len(messages) / seconds,
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write("{sent}/{messages} sent with {workers} workers in {seconds:.2f}s, "
+                              "{messages_per_second:.1f} msg/s, enqueue {enqueue_us_per_message:.1f} us/msg".format(**report))
@@ -0,0 +1,164 @@
+from contextlib import nullcontext
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+
+from qa.models import User, User_Info, Chat, Chat_Message, Friendship, Moment, Pair
+
+BENCH_PREFIX = "~bench-plan-"
+# 需要对比有无复合索引的表
+INDEXED_MODELS = [Chat_Message, Moment, Friendship, Pair, User_Info]
+
+
+def endpoint_queries(user_name, chat_id):
+    """{name: queryset} with the shapes of the endpoint queries"""
+    return {
+        "get_chat_message": Chat_Message.objects.filter(chat_id=chat_id).order_by("-created_time", "-chat_message_id")[:20],
+        "get_user_moments": Moment.objects.filter(user_name=user_name).order_by("-created_time", "-moment_id")[:6],
+        "get_lattest_moments": Moment.objects.order_by("-created_time", "-moment_id")[:6],
+        "get_follower": Friendship.objects.filter(follow=user_name).order_by("-created_time", "-friendship_id")[:20],
+        "get_follow": Friendship.objects.filter(follower=user_name).order_by("-created_time", "-friendship_id")[:20],
+        "get_pair_degree": Pair.objects.filter(Q(user_a=user_name) | Q(user_b=user_name)).order_by("-pair_degree")[:4],
+        "popular_users": User_Info.objects.order_by("-follower_cnt")[:3],
+    }
+
+
+class Command(BaseCommand):
+    help = "Seed a synthetic dataset and report the query plan and latency of the endpoint queries "\
+           "without and with the composite indexes of qa/models.py. "\
+           "The rows are created in a transaction that is rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default")
+        parser.add_argument("--users", type=int, default=2000)
+        parser.add_argument("--moments", type=int, default=50000)
+        parser.add_argument("--messages", type=int, default=100000)
+        parser.add_argument("--follows", type=int, default=40000)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+
+    def handle(self, *args, **options):
+        self.using = options["database"]
+        connection = connections[self.using]
+        if not connection.features.can_rollback_ddl:
+            self.stderr.write("{} cannot roll back DDL, the benchmark rows are committed and deleted at the end"
+                              .format(connection.vendor))
+        rollback = connection.features.can_rollback_ddl
+        report = {"vendor": connection.vendor}
+        try:
+            with transaction.atomic(using=self.using) if rollback else nullcontext():
+                user_name, chat_id = self.seed(options, random.Random(options["seed"]))
+                queries = endpoint_queries(user_name, chat_id)
+                self.toggle_indexes(connection, add=False)
+                report["without_index"] = self.measure(queries, options["repeat"])
+                self.toggle_indexes(connection, add=True)
+                report["with_index"] = self.measure(queries, options["repeat"])
+                if rollback:
+                    transaction.set_rollback(True, using=self.using)
+        finally:
+            if not rollback:
+                self.toggle_indexes(connection, add=True)
+                self.delete_seed()
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name in report["with_index"]:
+            before, after = report["without_index"][name], report["with_index"][name]
+            self.stdout.write("{:<20} {:8.3f} ms -> {:8.3f} ms".format(name, before["p50_ms"], after["p50_ms"]))
+            self.stdout.write("    without: " + " | ".join(before["plan"]))
+            self.stdout.write("    with:    " + " | ".join(after["plan"]))
+
+    def seed(self, options, rng):
+        """Create the synthetic rows, return a user and a chat of it to query"""
+        db = User.objects.using(self.using)
+        expired_date = datetime.now() + timedelta(days=1)
+        names = ["{}{}".format(BENCH_PREFIX, i) for i in range(options["users"])]
+        db.bulk_create([User(user_name=name, email="{}@example.com".format(name), token=name,
+                             expired_date=expired_date) for name in names], batch_size=1000)
+        # 关注数服从幂律分布, 少数用户拥有大量粉丝
+        weights = [1 / (i + 1) for i in range(len(names))]
+        follows = set()
+        for _ in range(options["follows"]):
+            follower, follow = rng.choice(names), rng.choices(names, weights)[0]
+            if follower != follow:
+                follows.add((follower, follow))
+        follower_cnt = {}
+        for _, follow in follows:
+            follower_cnt[follow] = follower_cnt.get(follow, 0) + 1
+        User_Info.objects.using(self.using).bulk_create([
+            User_Info(user_name_id=name, follower_cnt=follower_cnt.get(name, 0)) for name in names
+        ], batch_size=1000)
+        Friendship.objects.using(self.using).bulk_create([
+            Friendship(follower_id=follower, follow_id=follow) for follower, follow in follows
+        ], batch_size=1000)
+        Moment.objects.using(self.using).bulk_create([
+            Moment(user_name_id=rng.choices(names, weights)[0], content="moment {}".format(i))
+            for i in range(options["moments"])
+        ], batch_size=1000)
+        Chat.objects.using(self.using).bulk_create([
+            Chat(user_a_id=names[i], user_b_id=names[i + 1]) for i in range(0, len(names) - 1, 2)
+        ], batch_size=1000)
+        chats = list(Chat.objects.using(self.using).filter(user_a__in=names[::2]).values_list("chat_id", "user_a_id", "user_b_id"))
+        messages = []
+        for i in range(options["messages"]):
+            chat_id, a, b = rng.choice(chats)
+            messages.append(Chat_Message(chat_id_id=chat_id, from_user_id=a, to_user_id=b, content="message {}".format(i)))
+        Chat_Message.objects.using(self.using).bulk_create(messages, batch_size=1000)
+        Pair.objects.using(self.using).bulk_create([
+            Pair(user_a_id=a, user_b_id=b, pair_degree=rng.random())
+            for a, b in sorted({tuple(sorted(rng.sample(names, 2))) for _ in range(options["users"] * 5)})
+        ], batch_size=1000)
+        # auto_now 使时间都相同, 按小批打散以接近真实数据
+        now = datetime.now()
+        for model, owner in ((Moment, "user_name"), (Chat_Message, "from_user"), (Friendship, "follower")):
+            rows = list(model.objects.using(self.using).filter(**{owner + "__user_name__startswith": BENCH_PREFIX})
+                        .values_list("pk", flat=True))
+            rng.shuffle(rows)
+            for k in range(0, len(rows), 50):
+                model.objects.using(self.using).filter(pk__in=rows[k:k + 50])\
+                    .update(created_time=now - timedelta(seconds=rng.randrange(86400 * 365)))
+        return names[0], chats[0][0]
+
+    def delete_seed(self):
+        db = self.using
+        Chat_Message.objects.using(db).filter(from_user__user_name__startswith=BENCH_PREFIX).delete()
+        Moment.objects.using(db).filter(user_name__user_name__startswith=BENCH_PREFIX).delete()
+        Chat.objects.using(db).filter(user_a__user_name__startswith=BENCH_PREFIX).delete()
+        User.objects.using(db).filter(user_name__startswith=BENCH_PREFIX).delete()
+
+    def toggle_indexes(self, connection, add):
+        # 不进入 schema_editor 的上下文: SQLite 不允许在事务中进入
+        editor = connection.schema_editor(atomic=False)
+        with connection.cursor() as cursor:
+            for model in INDEXED_MODELS:
+                existing = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                for index in model._meta.indexes:
+                    if add and index.name not in existing:
+                        editor.add_index(model, index)
+                    elif not add and index.name in existing:
+                        editor.remove_index(model, index)
+            if connection.vendor == "sqlite":
+                cursor.execute("ANALYZE")
+
+    def measure(self, queries, repeat):
+        result = {}
+        for name, queryset in queries.items():
+            queryset = queryset.using(self.using)
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                samples.append((time.perf_counter() - start) * 1000)
+            result[name] = {
+                "p50_ms": statistics.median(samples),
+                "max_ms": max(samples),
+                "plan": [line.strip() for line in queryset.explain().splitlines() if line.strip()],
+            }
+        return result
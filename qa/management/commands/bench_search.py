@@ -0,0 +1,54 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from qa import search
+
+DEFAULT_QUERIES = ["你好", "图书馆", "考试", "hello", "deadline", "食堂 吃饭"]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    k = min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))
+    return samples[k]
+
+
+class Command(BaseCommand):
+    help = "Measure full-text search latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--query", action="append", help="Query to run (default: a built-in mix)")
+        parser.add_argument("--user", help="Also search the chat messages of this user")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+
+    def handle(self, *args, **options):
+        queries = options["query"] or DEFAULT_QUERIES
+        targets = [("moment", lambda q: search.search_moments(q, options["limit"]))]
+        if options["user"]:
+            targets.append(("chat_message", lambda q: search.search_chat_messages(options["user"], q, options["limit"])))
+        report = {}
+        for name, run in targets:
+            samples, hits = [], 0
+            for _ in range(options["repeat"]):
+                for q in queries:
+                    start = time.perf_counter()
+                    hits += len(run(q))
+                    samples.append((time.perf_counter() - start) * 1000)
+            report[name] = {
+                "queries": len(samples),
+                "avg_hits": hits / len(samples),
+                "mean_ms": statistics.mean(samples),
+                "p50_ms": percentile(samples, 50),
+                "p95_ms": percentile(samples, 95),
+                "p99_ms": percentile(samples, 99),
+            }
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, r in report.items():
+            self.stdout.write("{}: {} queries, p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, {:.1f} hits".format(
+                name, r["queries"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["avg_hits"]))
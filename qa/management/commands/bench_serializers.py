@@ -0,0 +1,75 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from qa.models import User, Chat, Chat_Message, Moment
+from qa.serializer import serializer_for, dumps, reflective_to_dict
+
+BENCH_PREFIX = "~bench-serializer-"
+
+
+class Command(BaseCommand):
+    help = "Compare the reflective to_dict with the compiled serializers on Chat_Message and Moment rows. "\
+           "The rows are created in a transaction that is rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            querysets = self.seed(options["rows"])
+            report = {name: self.measure(qs, options["repeat"]) for name, qs in querysets.items()}
+            transaction.set_rollback(True)
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, paths in report.items():
+            baseline = paths["reflective"]
+            for path, ms in paths.items():
+                self.stdout.write("{:<13} {:<10} {:8.1f} ms  x{:.2f}".format(name, path, ms, baseline / ms))
+
+    def seed(self, rows):
+        expired_date = datetime.now() + timedelta(days=1)
+        a, b = BENCH_PREFIX + "a", BENCH_PREFIX + "b"
+        User.objects.bulk_create([
+            User(user_name=name, email="{}@example.com".format(name), token=name, expired_date=expired_date)
+            for name in (a, b)
+        ])
+        chat = Chat.objects.create(user_a_id=a, user_b_id=b)
+        Chat_Message.objects.bulk_create([
+            Chat_Message(chat_id=chat, from_user_id=a, to_user_id=b, content="message {} 你好".format(i))
+            for i in range(rows)
+        ], batch_size=1000)
+        Moment.objects.bulk_create([
+            Moment(user_name_id=a, content="moment {} 今天天气很好".format(i))
+            for i in range(rows)
+        ], batch_size=1000)
+        return {
+            "chat_message": Chat_Message.objects.filter(chat_id=chat).order_by("-created_time"),
+            "moment": Moment.objects.filter(user_name=a).order_by("-created_time"),
+        }
+
+    def measure(self, queryset, repeat):
+        """Milliseconds to fetch, serialize and encode the queryset, best of repeat"""
+        model_serializer = serializer_for(queryset.model)
+        paths = {
+            "reflective": lambda: json.dumps([reflective_to_dict(m) for m in queryset.all()], cls=DjangoJSONEncoder),
+            "compiled": lambda: dumps([model_serializer.from_instance(m) for m in queryset.all()]),
+            "values": lambda: dumps(model_serializer.values(queryset.all())),
+        }
+        result = {}
+        for path, run in paths.items():
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            result[path] = best
+        return result
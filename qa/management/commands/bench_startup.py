@@ -0,0 +1,68 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+PHASES = ["import_django_ms", "django_setup_ms", "import_views_ms", "total_ms"]
+
+
+class Command(BaseCommand):
+    help = "Measure worker cold start: Django setup, qa.views import and first request latency, per worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Worker processes to start")
+        parser.add_argument("--parallel", action="store_true", help="Start the workers at the same time")
+        parser.add_argument("--url", action="append", help="URL of the first request (default: latest moments)")
+        parser.add_argument("--importtime", action="store_true",
+                            help="Also write python -X importtime output of the first worker to importtime.log")
+        parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+
+    def spawn(self, urls, importtime=False):
+        command = [sys.executable]
+        if importtime:
+            command += ["-X", "importtime"]
+        command += ["-m", "qa.startup_probe"] + urls
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "ciwkbe.settings"))
+        return subprocess.Popen(command, cwd=settings.BASE_DIR, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def collect(self, process, wall_start, importtime=False):
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise CommandError("Worker failed:\n" + err)
+        if importtime:
+            with open("importtime.log", "w") as f:
+                f.write(err)
+        report = json.loads(out.strip().splitlines()[-1])
+        report["wall_ms"] = (time.perf_counter() - wall_start) * 1000
+        return report
+
+    def handle(self, *args, **options):
+        urls = options["url"] or ["/api/moment/lattest/"]
+        workers = []
+        if options["parallel"]:
+            start = time.perf_counter()
+            processes = [self.spawn(urls, options["importtime"] and i == 0) for i in range(options["workers"])]
+            workers = [self.collect(p, start, options["importtime"] and i == 0) for i, p in enumerate(processes)]
+        else:
+            for i in range(options["workers"]):
+                start = time.perf_counter()
+                importtime = options["importtime"] and i == 0
+                workers.append(self.collect(self.spawn(urls, importtime), start, importtime))
+
+        summary = {phase: statistics.median(w[phase] for w in workers) for phase in PHASES + ["wall_ms"]}
+        summary["first_request_ms"] = statistics.median(sum(r["first_ms"] for r in w["requests"]) for w in workers)
+        report = {"workers": workers, "median": summary}
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for i, w in enumerate(workers):
+            self.stdout.write("worker {}: setup {:.1f} ms, views {:.1f} ms, first request {:.1f} ms, wall {:.1f} ms".format(
+                i, w["django_setup_ms"], w["import_views_ms"], sum(r["first_ms"] for r in w["requests"]), w["wall_ms"]))
+        self.stdout.write("median: setup {django_setup_ms:.1f} ms, views {import_views_ms:.1f} ms, "
+                          "first request {first_request_ms:.1f} ms, wall {wall_ms:.1f} ms".format(**summary))
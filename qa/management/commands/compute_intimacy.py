@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from qa import conditional, intimacy
+
+
+class Command(BaseCommand):
+    help = "Fold the chat messages posted since the last run into Intimacy"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="Messages per transaction")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Rows fetched from the cursor at a time")
+        parser.add_argument("--lag", type=int, default=intimacy.INTIMACY_SAFETY_LAG_SECONDS,
+                            help="Leave the messages younger than this many seconds to the next run")
+        parser.add_argument("--rescore", action="store_true",
+                            help="Also decay the stored marks of all pairs to now")
+        parser.add_argument("--full", action="store_true", help="Drop the scores and rescan the whole history")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1 or options["chunk_size"] < 1:
+            raise CommandError("--batch-size and --chunk-size must be positive")
+        if options["lag"] < 0:
+            raise CommandError("--lag must not be negative")
+        if options["full"]:
+            intimacy.reset()
+        total = 0
+        batches = intimacy.stream(options["batch_size"], options["chunk_size"], lag=options["lag"])
+        for last_id, messages, pairs in batches:
+            total += messages
+            self.stdout.write("Up to message {}: {} messages, {} pairs".format(last_id, messages, pairs))
+        if options["rescore"]:
+            self.stdout.write("{} pairs rescored".format(intimacy.rescore(options["chunk_size"])))
+        conditional.bump(conditional.INTIMACY_STAMP)
+        self.stdout.write(self.style.SUCCESS("{} messages processed".format(total)))
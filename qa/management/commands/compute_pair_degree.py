@@ -0,0 +1,102 @@
+import json
+import os
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from qa.models import Pair
+from qa.pair import FriendGraph, canonical_pair, save_pairs, pending_users, clear_pending, \
+    update_pairs_among_followers
+
+_graph = None
+
+
+def _init_worker(graph):
+    global _graph
+    _graph = graph
+
+
+def _compute_shard(shard):
+    index, start, stop = shard
+    return index, _graph.shard_rows(start, stop)
+
+
+class Command(BaseCommand):
+    help = "Recompute the pair degree of all users from the Friendship graph. "\
+           "With --pending, only the pairs among the followers of the users the follow views left "\
+           "to this command (more than PAIR_QUEUE_MAX_FOLLOWERS followers)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--shard-size", type=int, default=500, help="Users per shard")
+        parser.add_argument("--checkpoint", default="pair_degree.checkpoint.json",
+                            help="File recording the finished shards")
+        parser.add_argument("--resume", action="store_true", help="Skip the shards finished by the last run")
+        parser.add_argument("--pending", action="store_true",
+                            help="Only recompute the pairs among the followers of the pending users")
+
+    def handle(self, *args, **options):
+        shard_size = options["shard_size"]
+        if shard_size < 1 or options["workers"] < 1:
+            raise CommandError("--shard-size and --workers must be positive")
+        # 全量计算开始前标记的用户由本次计算覆盖
+        pending = pending_users()
+        if options["pending"]:
+            for user_name in pending:
+                update_pairs_among_followers(user_name, shard_size=shard_size)
+                clear_pending([user_name])
+                self.stdout.write("Pairs among the followers of {} updated".format(user_name))
+            self.stdout.write(self.style.SUCCESS("{} pending users done".format(len(pending))))
+            return
+        graph = FriendGraph.load()
+        self.stdout.write("Loaded {} users and {} follows".format(len(graph), graph.edge_cnt))
+
+        checkpoint_path = options["checkpoint"]
+        done = set()
+        if options["resume"] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint["user_cnt"] != len(graph) or checkpoint["shard_size"] != shard_size:
+                raise CommandError("Checkpoint does not match the current users or --shard-size, run without --resume")
+            done = set(checkpoint["done"])
+            self.stdout.write("Resume, {} shards already done".format(len(done)))
+        else:
+            self.delete_unordered_pairs()
+
+        shards = [
+            (index, start, min(start + shard_size, len(graph)))
+            for index, start in enumerate(range(0, len(graph), shard_size))
+            if index not in done
+        ]
+
+        def finish(index, rows):
+            start = index * shard_size
+            save_pairs(rows, graph.user_names[start:start + shard_size], by_user_a_only=True)
+            done.add(index)
+            with open(checkpoint_path, "w") as f:
+                json.dump({"user_cnt": len(graph), "shard_size": shard_size, "done": sorted(done)}, f)
+            self.stdout.write("Shard {} done, {} pairs".format(index, len(rows)))
+
+        if options["workers"] == 1:
+            _init_worker(graph)
+            for shard in shards:
+                finish(*_compute_shard(shard))
+        else:
+            with Pool(options["workers"], initializer=_init_worker, initargs=(graph,)) as pool:
+                for index, rows in pool.imap_unordered(_compute_shard, shards):
+                    finish(index, rows)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        clear_pending(pending)
+        self.stdout.write(self.style.SUCCESS("Pair degree has been updated"))
+
+    def delete_unordered_pairs(self, chunk_size=2000):
+        """Delete the rows saved in (user, p) direction by old versions.
+        The order is checked with canonical_pair in Python, the collation of
+        the database may order user names differently."""
+        wrong = [pk for pk, a, b in Pair.objects.values_list("pair_id", "user_a_id", "user_b_id")
+                 .iterator(chunk_size=chunk_size) if canonical_pair(a, b) != (a, b)]
+        for k in range(0, len(wrong), 500):
+            Pair.objects.filter(pair_id__in=wrong[k:k + 500]).delete()
+        if wrong:
+            self.stdout.write("Deleted {} pairs in the old order".format(len(wrong)))
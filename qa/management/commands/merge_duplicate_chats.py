@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from qa import chat
+
+
+class Command(BaseCommand):
+    help = "Put the participants of every Chat in canonical order (user_a < user_b) and merge the chats "\
+           "of the same two users, with their messages and Last_Message. "\
+           "Migration 0002 does the same before it creates the unique constraint on Chat (user_a, user_b); "\
+           "--dry-run previews it on a database not migrated yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would change")
+
+    def handle(self, *args, **options):
+        merged_cnt, reordered_cnt = chat.merge_duplicate_chats(dry_run=options["dry_run"])
+        verb = "to merge" if options["dry_run"] else "merged"
+        self.stdout.write(self.style.SUCCESS("{} duplicated chats {}, {} chats reordered".format(
+            merged_cnt, verb, reordered_cnt)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from qa import tag_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the inverted tag index from User_Tag"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        cnt = tag_index.rebuild(chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS("Tag index rebuilt, {} entries".format(cnt)))
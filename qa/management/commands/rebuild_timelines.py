@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from qa import timeline
+from qa.models import User, Friendship
+
+
+class Command(BaseCommand):
+    help = "Build the home timelines from the existing follows and moments. "\
+           "Run it with --author for an author who dropped below the celebrity threshold, "\
+           "whose moments posted as a celebrity were never fanned out."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", action="append", help="Only rebuild these users (default: everyone)")
+        parser.add_argument("--author", action="append", help="Only rebuild the followers of these users")
+
+    def handle(self, *args, **options):
+        user_names = list(options["user"] or [])
+        if options["author"]:
+            user_names += Friendship.objects.filter(follow__in=options["author"], follower__isnull=False)\
+                .order_by("follower_id").values_list("follower_id", flat=True).distinct()
+        elif not user_names:
+            user_names = list(User.objects.order_by("user_name").values_list("user_name", flat=True))
+        users = entries = 0
+        for user_name in user_names:
+            entries += timeline.rebuild(user_name)
+            users += 1
+        self.stdout.write(self.style.SUCCESS("{} timelines rebuilt, {} entries".format(users, entries)))
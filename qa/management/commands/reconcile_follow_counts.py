@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Count, Q, F, Value, IntegerField
+from django.db.models.functions import Coalesce
+
+from qa import conditional
+from qa.models import User_Info, Friendship
+
+
+class Command(BaseCommand):
+    help = "Recompute User_Info.follower_cnt / follow_cnt from Friendship"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the drifted users")
+
+    def handle(self, *args, **options):
+        real_follower = Friendship.objects.filter(follow=OuterRef("pk")).order_by()\
+            .values("follow").annotate(n=Count("follower", distinct=True)).values("n")
+        real_follow = Friendship.objects.filter(follower=OuterRef("pk")).order_by()\
+            .values("follower").annotate(n=Count("follow", distinct=True)).values("n")
+        drifted = User_Info.objects.annotate(
+            real_follower=Coalesce(Subquery(real_follower, output_field=IntegerField()), Value(0)),
+            real_follow=Coalesce(Subquery(real_follow, output_field=IntegerField()), Value(0)),
+        ).filter(~Q(follower_cnt=F("real_follower")) | ~Q(follow_cnt=F("real_follow")))
+
+        batch, total = [], 0
+        for user_info in drifted.iterator(chunk_size=2000):
+            self.stdout.write("{}: follower {} -> {}, follow {} -> {}".format(
+                user_info.pk, user_info.follower_cnt, user_info.real_follower,
+                user_info.follow_cnt, user_info.real_follow))
+            total += 1
+            if options["dry_run"]:
+                continue
+            user_info.follower_cnt = user_info.real_follower
+            user_info.follow_cnt = user_info.real_follow
+            batch.append(user_info)
+            if len(batch) >= 500:
+                User_Info.objects.bulk_update(batch, ["follower_cnt", "follow_cnt"])
+                batch = []
+        if batch:
+            User_Info.objects.bulk_update(batch, ["follower_cnt", "follow_cnt"])
+        if total and not options["dry_run"]:
+            # 使所有条件请求的缓存失效
+            conditional.bump(conditional.EPOCH_STAMP)
+        verb = "drifted" if options["dry_run"] else "repaired"
+        self.stdout.write(self.style.SUCCESS("{} users {}".format(total, verb)))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Count, IntegerField, Value
+from django.db.models.functions import Coalesce
+
+from qa import conditional
+from qa.feed import MOMENT_COUNTER
+from qa.models import User_Info, Moment, Global_Counter
+
+
+class Command(BaseCommand):
+    help = "Recompute the maintained moment counters from Moment"
+
+    def handle(self, *args, **options):
+        real = Moment.objects.filter(user_name=OuterRef("pk")).order_by()\
+            .values("user_name").annotate(n=Count("moment_id")).values("n")
+        updated = User_Info.objects.update(moment_cnt=Coalesce(Subquery(real, output_field=IntegerField()), Value(0)))
+        total = Moment.objects.count()
+        Global_Counter.objects.update_or_create(name=MOMENT_COUNTER, defaults={"value": total})
+        conditional.bump(conditional.EPOCH_STAMP)
+        self.stdout.write(self.style.SUCCESS("{} users updated, {} moments in total".format(updated, total)))
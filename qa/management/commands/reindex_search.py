@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from qa.models import Moment, Chat_Message
+from qa.search import private_get_backend
+
+MODELS = {"moment": Moment, "chat_message": Chat_Message}
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text index of moments and chat messages, streaming rows in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", choices=sorted(MODELS), action="append",
+                            help="Only reindex these models (default: all)")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--clear", action="store_true", help="Clear the index of the model first")
+
+    def handle(self, *args, **options):
+        unified_index, backend = private_get_backend()
+        for name in options["model"] or sorted(MODELS):
+            model = MODELS[name]
+            index = unified_index.get_index(model)
+            if options["clear"]:
+                backend.clear(models=[model])
+            total, last_pk = 0, None
+            # 按主键分段读取, 不用 OFFSET
+            while True:
+                rows = index.index_queryset().order_by("pk")
+                if last_pk is not None:
+                    rows = rows.filter(pk__gt=last_pk)
+                rows = list(rows[:options["chunk_size"]])
+                if not rows:
+                    break
+                backend.update(index, rows)
+                total += len(rows)
+                last_pk = rows[-1].pk
+                self.stdout.write("{}: {} indexed".format(name, total))
+            self.stdout.write(self.style.SUCCESS("{}: done, {} rows".format(name, total)))
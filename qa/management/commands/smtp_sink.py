@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from qa.smtp_sink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = "Run a local SMTP server that accepts and discards every message"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=1025)
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(options["host"], options["port"])
+        sink.start()
+        self.stdout.write("SMTP sink listening on {}:{}".format(options["host"], sink.port))
+        last_cnt = 0
+        try:
+            while True:
+                time.sleep(5)
+                if sink.message_cnt != last_cnt:
+                    self.stdout.write("{} messages received ({:.1f}/s)".format(
+                        sink.message_cnt, (sink.message_cnt - last_cnt) / 5))
+                    last_cnt = sink.message_cnt
+        except KeyboardInterrupt:
+            sink.shutdown()
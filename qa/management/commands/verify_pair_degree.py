@@ -0,0 +1,89 @@
+import random
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from qa.models import User, Friendship, Pair, Global_Counter, Version_Stamp
+from qa.pair import FriendGraph, PairQueue, friendship_edges, follow_changed, pending_users, clear_pending, \
+    update_pairs_among_followers, PAIR_PENDING_PREFIX
+
+SYNTHETIC_PREFIX = "~pair-verify-"
+
+
+class Command(BaseCommand):
+    help = "Check incremental pair degree maintenance against the batch result on a synthetic graph. "\
+           "Follows go through follow_changed and a PairQueue like in the views, users above "\
+           "--max-followers through the pending path of compute_pair_degree. The transactions are "\
+           "committed, the synthetic users are deleted afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=40)
+        parser.add_argument("--steps", type=int, default=400, help="Number of random follow/unfollow")
+        parser.add_argument("--max-followers", type=int, default=8,
+                            help="Followers above which a user is left to the pending recompute")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.in_atomic_block:
+            raise CommandError("The follow changes must commit, run outside a transaction")
+        rng = random.Random(options["seed"])
+        self.cleanup()
+        try:
+            mismatch = self.run(rng, options["users"], options["steps"], options["max_followers"])
+        finally:
+            self.cleanup()
+        if mismatch:
+            for key, incremental, batch in mismatch[:20]:
+                self.stderr.write("{}: incremental {} batch {}".format(key, incremental, batch))
+            raise CommandError("{} pairs differ from the batch result".format(len(mismatch)))
+        self.stdout.write(self.style.SUCCESS("Incremental pair degree matches the batch result"))
+
+    def run(self, rng, user_cnt, steps, max_followers):
+        expired_date = datetime.now() + timedelta(days=1)
+        names = ["{}{:05d}".format(SYNTHETIC_PREFIX, i) for i in range(user_cnt)]
+        User.objects.bulk_create([
+            User(user_name=name, email="{}@example.com".format(name), password="", token=name, expired_date=expired_date)
+            for name in names
+        ])
+        queue = PairQueue(max_followers=max_followers, background=False)
+        for _ in range(steps):
+            follower, follow = rng.sample(names, 2)
+            with transaction.atomic():
+                edge = Friendship.objects.filter(follower=follower, follow=follow)
+                if not edge.exists():
+                    Friendship.objects.create(follower_id=follower, follow_id=follow)
+                elif rng.random() < 0.4:
+                    edge.delete()
+                else:
+                    continue
+                follow_changed(follower, follow, queue)
+            # 队列不一定每次都及时处理
+            if rng.random() < 0.3:
+                queue.flush()
+        queue.flush()
+        pending = [name for name in pending_users() if name in set(names)]
+        for user_name in pending:
+            update_pairs_among_followers(user_name, shard_size=3)
+        clear_pending(pending)
+
+        edges = friendship_edges().filter(follower__in=names).values_list("follower_id", "follow_id")
+        graph = FriendGraph(names, edges)
+        batch = {(a, b): score for a, b, score in graph.shard_rows(0, len(graph))}
+        incremental = {
+            (p.user_a_id, p.user_b_id): p.pair_degree
+            for p in Pair.objects.filter(user_a__in=names)
+        }
+        mismatch = []
+        for key in sorted(set(batch) | set(incremental)):
+            if key not in batch or key not in incremental or abs(batch[key] - incremental[key]) > 1e-9:
+                mismatch.append((key, incremental.get(key), batch.get(key)))
+        self.stdout.write("{} follows, {} pairs compared, {} users recomputed as pending".format(
+            graph.edge_cnt, len(batch), len(pending)))
+        return mismatch
+
+    def cleanup(self):
+        # Friendship 和 Pair 随用户删除
+        User.objects.filter(user_name__startswith=SYNTHETIC_PREFIX).delete()
+        Global_Counter.objects.filter(name__startswith=PAIR_PENDING_PREFIX + SYNTHETIC_PREFIX).delete()
+        Version_Stamp.objects.filter(key__contains=":" + SYNTHETIC_PREFIX).delete()
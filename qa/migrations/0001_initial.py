@@ -0,0 +1,158 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Chat',
+            fields=[
+                ('chat_id', models.AutoField(primary_key=True, serialize=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('user_name', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('password', models.CharField(max_length=200)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('token', models.CharField(max_length=100, unique=True)),
+                ('expired_date', models.DateTimeField()),
+                ('email_code', models.CharField(default=None, max_length=10, null=True)),
+                ('is_active', models.BooleanField(default=False)),
+                ('avatar', models.CharField(default=None, max_length=200, null=True)),
+                ('identity', models.CharField(default='V', max_length=1, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='User_Info',
+            fields=[
+                ('user_name', models.OneToOneField(db_column='user_name', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='user_info', serialize=False, to='qa.User')),
+                ('phone', models.CharField(default=None, max_length=30, null=True, unique=True)),
+                ('year', models.IntegerField(default=None, null=True)),
+                ('school', models.CharField(default=None, max_length=20, null=True)),
+                ('college', models.CharField(default=None, max_length=20, null=True)),
+                ('intro', models.CharField(default=None, max_length=200, null=True)),
+                ('tag', models.CharField(default=None, max_length=500, null=True)),
+                ('school_id', models.IntegerField(default=None, null=True, unique=True)),
+                ('follower_cnt', models.PositiveIntegerField(default=0)),
+                ('follow_cnt', models.PositiveIntegerField(default=0)),
+                ('gender', models.CharField(choices=[('M', 'Man'), ('W', 'Woman'), ('U', 'Unknown')], default=None, max_length=1, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='User_Tag',
+            fields=[
+                ('tag_id', models.AutoField(primary_key=True, serialize=False)),
+                ('content', models.CharField(default=None, max_length=100, null=True)),
+                ('user_name', models.ForeignKey(db_column='user_name', on_delete=django.db.models.deletion.CASCADE, to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Pair',
+            fields=[
+                ('pair_id', models.AutoField(primary_key=True, serialize=False)),
+                ('pair_degree', models.FloatField(default=0)),
+                ('user_a', models.ForeignKey(db_column='user_a', on_delete=django.db.models.deletion.CASCADE, related_name='pair_user_a', to='qa.User')),
+                ('user_b', models.ForeignKey(db_column='user_b', on_delete=django.db.models.deletion.CASCADE, related_name='pair_user_b', to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Moment',
+            fields=[
+                ('moment_id', models.AutoField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('image', models.CharField(default=None, max_length=500, null=True)),
+                ('quote', models.CharField(default=None, max_length=200, null=True)),
+                ('created_time', models.DateTimeField(auto_now=True)),
+                ('user_name', models.ForeignKey(db_column='user_name', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Intimacy',
+            fields=[
+                ('intimacy_id', models.AutoField(primary_key=True, serialize=False)),
+                ('initmacy_mark', models.PositiveIntegerField(default=0)),
+                ('user_a', models.ForeignKey(db_column='user_a', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='intimacy_user_a', to='qa.User')),
+                ('user_b', models.ForeignKey(db_column='user_b', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='intimacy_user_b', to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('friendship_id', models.AutoField(primary_key=True, serialize=False)),
+                ('created_time', models.DateTimeField(auto_now=True)),
+                ('follow', models.ForeignKey(db_column='follower', default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='friendship_follower', to='qa.User')),
+                ('follower', models.ForeignKey(db_column='followed', default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='friendship_followed', to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Chat_Message',
+            fields=[
+                ('chat_message_id', models.AutoField(primary_key=True, serialize=False)),
+                ('created_time', models.DateTimeField(auto_now=True)),
+                ('content', models.TextField(default=None, null=True)),
+                ('quote', models.CharField(default=None, max_length=200, null=True)),
+                ('image', models.CharField(default=None, max_length=500, null=True)),
+                ('chat_id', models.ForeignKey(db_column='chat_id', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chat_message_chat_id', to='qa.Chat')),
+                ('from_user', models.ForeignKey(db_column='from_user', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chat_message_from_user', to='qa.User')),
+                ('to_user', models.ForeignKey(db_column='to_user', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chat_message_to_user', to='qa.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='user_a',
+            field=models.ForeignKey(db_column='user_a', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chat_user_a', to='qa.User'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='user_b',
+            field=models.ForeignKey(db_column='user_b', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chat_user_b', to='qa.User'),
+        ),
+        migrations.CreateModel(
+            name='Last_Message',
+            fields=[
+                ('chat_id', models.OneToOneField(db_column='chat_id', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='last_message', serialize=False, to='qa.Chat')),
+                ('lattest_message', models.ForeignKey(db_column='lattest_message', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='qa.Chat_Message')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
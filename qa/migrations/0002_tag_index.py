@@ -0,0 +1,25 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag_Index',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=100)),
+                ('user_name', models.ForeignKey(db_column='user_name', on_delete=django.db.models.deletion.CASCADE, related_name='tag_index', to='qa.User')),
+            ],
+            options={
+                'unique_together': {('term', 'user_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0002_tag_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Global_Counter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='user_info',
+            name='moment_cnt',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
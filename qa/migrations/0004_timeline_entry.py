@@ -0,0 +1,35 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0003_moment_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Timeline_Entry',
+            fields=[
+                ('entry_id', models.AutoField(primary_key=True, serialize=False)),
+                ('created_time', models.DateTimeField()),
+                ('author', models.ForeignKey(db_column='author', on_delete=django.db.models.deletion.CASCADE, related_name='timeline_authored', to='qa.User')),
+                ('moment', models.ForeignKey(db_column='moment_id', on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entry', to='qa.Moment')),
+                ('user_name', models.ForeignKey(db_column='user_name', on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to='qa.User')),
+            ],
+            options={
+                'unique_together': {('user_name', 'moment')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='timeline_entry',
+            index=models.Index(fields=['user_name', '-created_time', '-moment'], name='qa_timeline_user_na_f04fef_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timeline_entry',
+            index=models.Index(fields=['user_name', 'author'], name='qa_timeline_user_na_a37908_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0004_timeline_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Version_Stamp',
+            fields=[
+                ('key', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(default=0)),
+                ('updated_time', models.DateTimeField(default=None, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0005_version_stamp'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat_message',
+            index=models.Index(fields=['chat_id', '-created_time', '-chat_message_id'], name='qa_chat_mes_chat_id_1d73fc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['follow', '-created_time', '-friendship_id'], name='qa_friendsh_followe_ffc734_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['follower', '-created_time', '-friendship_id'], name='qa_friendsh_followe_a37658_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moment',
+            index=models.Index(fields=['user_name', '-created_time', '-moment_id'], name='qa_moment_user_na_8ddc3f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moment',
+            index=models.Index(fields=['-created_time', '-moment_id'], name='qa_moment_created_924688_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pair',
+            index=models.Index(fields=['user_a', '-pair_degree'], name='qa_pair_user_a_3eec99_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pair',
+            index=models.Index(fields=['user_b', '-pair_degree'], name='qa_pair_user_b_55503f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user_info',
+            index=models.Index(fields=['-follower_cnt'], name='qa_user_inf_followe_6e4fa5_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def canonical_pair(user_a, user_b):
+    # 与 qa.pair.canonical_pair 相同, 按 Python 字符串顺序, 不依赖数据库排序规则
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+def canonicalize_chats(apps, schema_editor):
+    """Put every Chat in canonical order (user_a < user_b) and merge the chats
+    of the same two users into the oldest one, with their messages and
+    Last_Message, so unique_chat_users can be created."""
+    Chat = apps.get_model("qa", "Chat")
+    Chat_Message = apps.get_model("qa", "Chat_Message")
+    Last_Message = apps.get_model("qa", "Last_Message")
+    groups = defaultdict(list)
+    chats = Chat.objects.filter(user_a__isnull=False, user_b__isnull=False).order_by("chat_id")\
+        .values_list("chat_id", "user_a_id", "user_b_id")
+    for chat_id, a, b in chats.iterator(chunk_size=2000):
+        groups[canonical_pair(a, b)].append((chat_id, a, b))
+    for key, rows in groups.items():
+        keeper, a, b = rows[0]
+        duplicates = [row[0] for row in rows[1:]]
+        if duplicates:
+            Chat_Message.objects.filter(chat_id__in=duplicates).update(chat_id=keeper)
+            Chat.objects.filter(pk__in=duplicates).delete()
+            latest = Chat_Message.objects.filter(chat_id=keeper).order_by("-created_time", "-chat_message_id")\
+                .values_list("pk", flat=True).first()
+            if latest is not None:
+                Last_Message.objects.update_or_create(chat_id_id=keeper, defaults={"lattest_message_id": latest})
+        if (a, b) != key:
+            Chat.objects.filter(pk=keeper).update(user_a_id=key[0], user_b_id=key[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonicalize_chats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(fields=('user_a', 'user_b'), name='unique_chat_users'),
+        ),
+    ]
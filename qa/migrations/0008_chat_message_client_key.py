@@ -0,0 +1,22 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0007_unique_chat_users'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat_message',
+            name='client_key',
+            field=models.CharField(default=None, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='chat_message',
+            constraint=models.UniqueConstraint(fields=('from_user', 'client_key'), name='unique_chat_message_client_key'),
+        ),
+    ]
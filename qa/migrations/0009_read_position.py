@@ -0,0 +1,31 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0008_chat_message_client_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Read_Position',
+            fields=[
+                ('read_position_id', models.AutoField(primary_key=True, serialize=False)),
+                ('unread_cnt', models.PositiveIntegerField(default=0)),
+                ('chat_id', models.ForeignKey(db_column='chat_id', on_delete=django.db.models.deletion.CASCADE, related_name='read_position', to='qa.Chat')),
+                ('last_read_message', models.ForeignKey(db_column='last_read_message', default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='qa.Chat_Message')),
+                ('user_name', models.ForeignKey(db_column='user_name', on_delete=django.db.models.deletion.CASCADE, related_name='read_position', to='qa.User')),
+            ],
+            options={
+                'unique_together': {('chat_id', 'user_name')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='read_position',
+            index=models.Index(fields=['user_name', 'unread_cnt'], name='qa_read_pos_user_na_c23b43_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:16
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def canonical_pair(user_a, user_b):
+    # 与 qa.pair.canonical_pair 相同, 按 Python 字符串顺序, 不依赖数据库排序规则
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+def canonicalize_intimacy(apps, schema_editor):
+    """Put every Intimacy row in canonical order and keep the highest mark of
+    each pair, so unique_intimacy_users can be created. The weights are
+    rebuilt by compute_intimacy --full."""
+    Intimacy = apps.get_model("qa", "Intimacy")
+    groups = defaultdict(list)
+    rows = Intimacy.objects.filter(user_a__isnull=False, user_b__isnull=False)\
+        .order_by("-initmacy_mark", "intimacy_id").values_list("intimacy_id", "user_a_id", "user_b_id")
+    for intimacy_id, a, b in rows.iterator(chunk_size=2000):
+        groups[canonical_pair(a, b)].append((intimacy_id, a, b))
+    for key, rows in groups.items():
+        keeper, a, b = rows[0]
+        duplicates = [row[0] for row in rows[1:]]
+        for k in range(0, len(duplicates), 500):
+            Intimacy.objects.filter(pk__in=duplicates[k:k + 500]).delete()
+        if (a, b) != key:
+            Intimacy.objects.filter(pk=keeper).update(user_a_id=key[0], user_b_id=key[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0009_read_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='intimacy',
+            name='updated_time',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='intimacy',
+            name='weight_a',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='intimacy',
+            name='weight_b',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='intimacy',
+            index=models.Index(fields=['user_a', '-initmacy_mark'], name='qa_intimacy_user_a_b32a89_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='intimacy',
+            index=models.Index(fields=['user_b', '-initmacy_mark'], name='qa_intimacy_user_b_dd2dfd_idx'),
+        ),
+        migrations.RunPython(canonicalize_intimacy, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='intimacy',
+            constraint=models.UniqueConstraint(fields=('user_a', 'user_b'), name='unique_intimacy_users'),
+        ),
+    ]
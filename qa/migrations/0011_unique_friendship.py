@@ -0,0 +1,42 @@
+# Generated by Django 3.0.8 on 2026-10-17 15:17
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Min, Count, F, Value, Case, When
+
+
+def delete_duplicated_follows(apps, schema_editor):
+    """Keep the oldest Friendship of each (follower, follow) and take the
+    deleted duplicates out of the maintained follower_cnt / follow_cnt"""
+    Friendship = apps.get_model("qa", "Friendship")
+    User_Info = apps.get_model("qa", "User_Info")
+    duplicated = Friendship.objects.order_by().values("follower_id", "follow_id")\
+        .annotate(keep=Min("friendship_id"), n=Count("friendship_id")).filter(n__gt=1)
+    follower_delta, follow_delta = Counter(), Counter()
+    for row in list(duplicated):
+        Friendship.objects.filter(follower_id=row["follower_id"], follow_id=row["follow_id"])\
+            .exclude(pk=row["keep"]).delete()
+        follow_delta[row["follower_id"]] += row["n"] - 1
+        follower_delta[row["follow_id"]] += row["n"] - 1
+    for field, deltas in (("follow_cnt", follow_delta), ("follower_cnt", follower_delta)):
+        for user_name, n in deltas.items():
+            if user_name is not None:
+                # 无符号列先减会越界, 不足 n 的直接置 0
+                User_Info.objects.filter(pk=user_name).update(**{
+                    field: Case(When(**{field + "__gte": n}, then=F(field) - n), default=Value(0))})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qa', '0010_intimacy_weights'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicated_follows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.UniqueConstraint(fields=('follower', 'follow'), name='unique_friendship'),
+        ),
+    ]
@@ -1,5 +1,5 @@
 from django.db import models
-from itertools import chain
+from qa.serializer import serializer_for
 
 
 class PrintableModel(models.Model):
@@ -7,13 +7,7 @@ class PrintableModel(models.Model):
         return str(self.to_dict())
 
     def to_dict(instance):
-        opts = instance._meta
-        data = {}
-        for f in chain(opts.concrete_fields, opts.private_fields):
-            data[f.name] = f.value_from_object(instance)
-        for f in opts.many_to_many:
-            data[f.name] = [i.id for i in f.value_from_object(instance)]
-        return data
+        return serializer_for(type(instance)).from_instance(instance)
 
     class Meta:
         abstract = True
@@ -43,6 +37,7 @@ class User_Info(PrintableModel):
     school_id = models.IntegerField(unique=True, null=True, default=None)
     follower_cnt = models.PositiveIntegerField(default=0)
     follow_cnt = models.PositiveIntegerField(default=0)
+    moment_cnt = models.PositiveIntegerField(default=0)
 
     class Gender(models.TextChoices):
         MAN = 'M'
@@ -50,6 +45,12 @@ class User_Info(PrintableModel):
         UNKNOWN = 'U'
     gender = models.CharField(max_length=1, choices=Gender.choices, null=True, default=None)
 
+    class Meta:
+        indexes = [
+            # 热门用户推荐
+            models.Index(fields=["-follower_cnt"]),
+        ]
+
 
 class User_Tag(PrintableModel):
     tag_id = models.AutoField(primary_key=True)
@@ -57,11 +58,26 @@ class User_Tag(PrintableModel):
     content = models.CharField(max_length=100, default=None, null=True)
 
 
+class Tag_Index(PrintableModel):
+    """Inverted index of User_Tag: one row per (normalized tag term, user)"""
+    term = models.CharField(max_length=100, db_index=True)
+    user_name = models.ForeignKey(User, on_delete=models.CASCADE, db_column="user_name", related_name="tag_index")
+
+    class Meta:
+        unique_together = [["term", "user_name"]]
+
+
 class Chat(PrintableModel):
+    """A chat between two users, user_a < user_b (see qa/chat.py)"""
     chat_id = models.AutoField(primary_key=True)
     user_a = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, db_column="user_a", default=None, related_name="chat_user_a")
     user_b = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, db_column="user_b", default=None, related_name="chat_user_b")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_a", "user_b"], name="unique_chat_users"),
+        ]
+
 
 class Chat_Message(PrintableModel):
     chat_message_id = models.AutoField(primary_key=True)
@@ -72,6 +88,16 @@ class Chat_Message(PrintableModel):
     content = models.TextField(null=True, default=None)
     quote = models.CharField(max_length=200, null=True, default=None)
     image = models.CharField(max_length=500, null=True, default=None)
+    # 客户端生成的幂等键, 重发同一条消息不会重复写入
+    client_key = models.CharField(max_length=64, null=True, default=None)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat_id", "-created_time", "-chat_message_id"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["from_user", "client_key"], name="unique_chat_message_client_key"),
+        ]
 
 
 class Last_Message(PrintableModel):
@@ -79,11 +105,42 @@ class Last_Message(PrintableModel):
     lattest_message = models.ForeignKey(Chat_Message, on_delete=models.SET_NULL, null=True, default=None, db_column="lattest_message")
 
 
+class Read_Position(PrintableModel):
+    """How far user_name has read chat_id, with the number of messages to the
+    user after that point, maintained by the message write path"""
+    read_position_id = models.AutoField(primary_key=True)
+    chat_id = models.ForeignKey(Chat, on_delete=models.CASCADE, db_column="chat_id", related_name="read_position")
+    user_name = models.ForeignKey(User, on_delete=models.CASCADE, db_column="user_name", related_name="read_position")
+    last_read_message = models.ForeignKey(Chat_Message, on_delete=models.SET_NULL, null=True, default=None, db_column="last_read_message")
+    unread_cnt = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [["chat_id", "user_name"]]
+        indexes = [
+            # 总未读数只读索引
+            models.Index(fields=["user_name", "unread_cnt"]),
+        ]
+
+
 class Intimacy(PrintableModel):
+    """Chat intimacy of two users, user_a < user_b, computed by qa/intimacy.py"""
     intimacy_id = models.AutoField(primary_key=True)
     user_a = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, db_column="user_a", default=None, related_name="intimacy_user_a")
     user_b = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, db_column="user_b", default=None, related_name="intimacy_user_b")
     initmacy_mark = models.PositiveIntegerField(default=0)
+    # 按时间衰减后的消息数 (a 发给 b, b 发给 a), 衰减到 updated_time
+    weight_a = models.FloatField(default=0)
+    weight_b = models.FloatField(default=0)
+    updated_time = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_a", "user_b"], name="unique_intimacy_users"),
+        ]
+        indexes = [
+            models.Index(fields=["user_a", "-initmacy_mark"]),
+            models.Index(fields=["user_b", "-initmacy_mark"]),
+        ]
 
 
 class Friendship(PrintableModel):
@@ -92,6 +149,15 @@ class Friendship(PrintableModel):
     follower = models.ForeignKey(User, on_delete=models.CASCADE, null=True, db_column="followed", default=None, related_name="friendship_followed")
     created_time = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["follow", "-created_time", "-friendship_id"]),
+            models.Index(fields=["follower", "-created_time", "-friendship_id"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["follower", "follow"], name="unique_friendship"),
+        ]
+
 
 class Moment(PrintableModel):
     moment_id = models.AutoField(primary_key=True)
@@ -101,9 +167,52 @@ class Moment(PrintableModel):
     quote = models.CharField(max_length=200, null=True, default=None)
     created_time = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_name", "-created_time", "-moment_id"]),
+            models.Index(fields=["-created_time", "-moment_id"]),
+        ]
+
+
+class Timeline_Entry(PrintableModel):
+    """A moment in the home timeline of user_name, written by fan-out on post"""
+    entry_id = models.AutoField(primary_key=True)
+    user_name = models.ForeignKey(User, on_delete=models.CASCADE, db_column="user_name", related_name="timeline")
+    moment = models.ForeignKey(Moment, on_delete=models.CASCADE, db_column="moment_id", related_name="timeline_entry")
+    author = models.ForeignKey(User, on_delete=models.CASCADE, db_column="author", related_name="timeline_authored")
+    # moment 的 created_time, 用于排序
+    created_time = models.DateTimeField()
+
+    class Meta:
+        unique_together = [["user_name", "moment"]]
+        indexes = [
+            models.Index(fields=["user_name", "-created_time", "-moment"]),
+            models.Index(fields=["user_name", "author"]),
+        ]
+
 
 class Pair(PrintableModel):
     pair_id = models.AutoField(primary_key=True)
     user_a = models.ForeignKey(User, on_delete=models.CASCADE, db_column="user_a", related_name="pair_user_a")
     user_b = models.ForeignKey(User, on_delete=models.CASCADE, db_column="user_b", related_name="pair_user_b")
     pair_degree = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_a", "-pair_degree"]),
+            models.Index(fields=["user_b", "-pair_degree"]),
+        ]
+
+
+class Global_Counter(PrintableModel):
+    """Site-wide counters maintained by the write views, e.g. the number of moments"""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+
+class Version_Stamp(PrintableModel):
+    """Version of a piece of data (e.g. "profile:<user_name>"), bumped by the
+    views that change it. Used as the validator of conditional GETs."""
+    key = models.CharField(max_length=100, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    updated_time = models.DateTimeField(null=True, default=None)
@@ -0,0 +1,394 @@
+"""
+Pair degree (匹配度) computation.
+
+The pair degree of users a and b is computed from the users both of them
+follow (common friends):
+
+    sum(1 / log2(followers of c) for c in common) * |common| / |union|
+
+i.e. the common friends are weighted by how many followers they have and
+the sum is scaled by the Jaccard coefficient of the two follow sets.
+A common friend has at least the two followers a and b, so the weight is
+always defined.
+
+Pair rows are stored once per unordered pair, with user_a < user_b, and
+only for pairs with at least one common friend.
+
+A follow or unfollow changes the pairs of the follower and the pairs among
+the followers of the followed user (O(followers²)). Both are recomputed by
+pair_queue on a background thread after the commit. Users with more than
+PAIR_QUEUE_MAX_FOLLOWERS followers are marked pending in Global_Counter
+instead; compute_pair_degree --pending recomputes the pairs among their
+followers in shards (a full compute_pair_degree run also covers them), so
+Pair matches a full recompute once the queue and the pending users are
+processed.
+"""
+from array import array
+from collections import defaultdict, OrderedDict
+from threading import Lock, Thread, Event
+import logging
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Count
+
+from qa import conditional
+from qa.models import Friendship, Pair, User, Global_Counter
+
+logger = logging.getLogger(__name__)
+
+PAIR_QUEUE_MAX_FOLLOWERS = getattr(settings, "PAIR_QUEUE_MAX_FOLLOWERS", 2000)
+PAIR_PENDING_PREFIX = "pair_pending:"
+
+
+def common_friend_weight(follower_cnt: int) -> float:
+    return 1 / math.log2(follower_cnt)
+
+
+def pair_score(weight: float, n_common: int, n_union: int) -> float:
+    if not n_union:
+        return 0.0
+    return float(weight * n_common / n_union)
+
+
+def canonical_pair(user_a, user_b):
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+class FriendGraph:
+    """The follow graph in CSR form, loaded once from Friendship.
+    Users are indexed in user_name order, duplicated follows are merged.
+        out_indptr/out_indices  users each user follows
+        in_indptr/in_indices    followers of each user
+    """
+
+    def __init__(self, user_names, edges):
+        self.user_names = sorted(user_names)
+        self.index = {name: i for i, name in enumerate(self.user_names)}
+        n = len(self.user_names)
+        out_sets = [set() for _ in range(n)]
+        for follower, follow in edges:
+            i, j = self.index.get(follower), self.index.get(follow)
+            if i is None or j is None or i == j:
+                continue
+            out_sets[i].add(j)
+        self.out_indptr, self.out_indices = self._to_csr(out_sets)
+        in_sets = [[] for _ in range(n)]
+        for i, follows in enumerate(out_sets):
+            for j in follows:
+                in_sets[j].append(i)
+        self.in_indptr, self.in_indices = self._to_csr(in_sets)
+
+    @staticmethod
+    def _to_csr(rows):
+        indptr, indices = array("l", [0]), array("l")
+        for row in rows:
+            indices.extend(sorted(row))
+            indptr.append(len(indices))
+        return indptr, indices
+
+    @classmethod
+    def load(cls):
+        user_names = User.objects.values_list("user_name", flat=True)
+        edges = friendship_edges().values_list("follower_id", "follow_id").iterator(chunk_size=10000)
+        return cls(list(user_names), edges)
+
+    def __len__(self):
+        return len(self.user_names)
+
+    @property
+    def edge_cnt(self):
+        return len(self.out_indices)
+
+    def follows(self, i):
+        return self.out_indices[self.out_indptr[i]:self.out_indptr[i + 1]]
+
+    def followers(self, i):
+        return self.in_indices[self.in_indptr[i]:self.in_indptr[i + 1]]
+
+    def out_degree(self, i):
+        return self.out_indptr[i + 1] - self.out_indptr[i]
+
+    def in_degree(self, i):
+        return self.in_indptr[i + 1] - self.in_indptr[i]
+
+    def scores_of(self, i, only_greater=True):
+        """Pair degree of user i with every user sharing a common friend,
+        {j: score}. This is row i of the sparse product of the follow matrix
+        with its weighted transpose. With only_greater, only j > i is kept so
+        every unordered pair is produced once."""
+        weight, common = defaultdict(float), defaultdict(int)
+        for c in self.follows(i):
+            # 只有 i 一个粉丝的用户不是任何人的共同好友
+            if self.in_degree(c) < 2:
+                continue
+            w = common_friend_weight(self.in_degree(c))
+            for j in self.followers(c):
+                if j == i or (only_greater and j < i):
+                    continue
+                weight[j] += w
+                common[j] += 1
+        out_degree = self.out_degree(i)
+        return {
+            j: pair_score(weight[j], n, out_degree + self.out_degree(j) - n)
+            for j, n in common.items()
+        }
+
+    def shard_rows(self, start, stop):
+        """(user_a, user_b, score) rows of the users with index in [start, stop)"""
+        rows = []
+        for i in range(start, stop):
+            name = self.user_names[i]
+            for j, score in self.scores_of(i).items():
+                rows.append((name, self.user_names[j], score))
+        return rows
+
+
+def friendship_edges():
+    """Friendship rows as graph edges, the same ones FriendGraph keeps"""
+    return Friendship.objects.filter(follow__isnull=False, follower__isnull=False).exclude(follow=F("follower"))
+
+
+def compute_user_scores(user_name) -> dict:
+    """Pair degree of one user with every user sharing a common friend,
+    {user_name: score}, computed in two queries without loading the graph."""
+    follows_qs = friendship_edges().filter(follower=user_name).values("follow_id")
+    followers_of = defaultdict(set)
+    for follower, follow in friendship_edges().filter(follow__in=follows_qs)\
+            .values_list("follower_id", "follow_id").distinct():
+        followers_of[follow].add(follower)
+    if not followers_of:
+        return {}
+    weight, common = defaultdict(float), defaultdict(int)
+    for followers in followers_of.values():
+        if len(followers) < 2:
+            continue
+        w = common_friend_weight(len(followers))
+        for other in followers:
+            if other != user_name:
+                weight[other] += w
+                common[other] += 1
+    candidates_qs = friendship_edges().filter(follow__in=follows_qs).values("follower_id")
+    out_degree = {
+        row["follower_id"]: row["n"]
+        for row in friendship_edges().filter(follower__in=candidates_qs)
+        .values("follower_id").annotate(n=Count("follow_id", distinct=True)).order_by()
+    }
+    user_degree = out_degree.get(user_name, 0)
+    return {
+        other: pair_score(weight[other], n, user_degree + out_degree.get(other, 0) - n)
+        for other, n in common.items()
+    }
+
+
+def _write_pairs(existing, scores, delete_missing):
+    """Make the Pair rows in existing match scores, {(user_a, user_b): score}
+    with canonical keys. Duplicated rows are always deleted, rows missing
+    from scores only with delete_missing."""
+    to_update, to_delete, seen, touched = [], [], set(), set()
+    for pair in existing:
+        key = canonical_pair(pair.user_a_id, pair.user_b_id)
+        if key in seen or (key not in scores and delete_missing):
+            to_delete.append(pair.pair_id)
+            touched.update(key)
+            continue
+        if key not in scores:
+            continue
+        seen.add(key)
+        if (pair.user_a_id, pair.user_b_id) != key or pair.pair_degree != scores[key]:
+            pair.user_a_id, pair.user_b_id = key
+            pair.pair_degree = scores[key]
+            to_update.append(pair)
+            touched.update(key)
+    for k in range(0, len(to_delete), 500):
+        Pair.objects.filter(pair_id__in=to_delete[k:k + 500]).delete()
+    if to_update:
+        Pair.objects.bulk_update(to_update, ["user_a", "user_b", "pair_degree"], batch_size=500)
+    created = [(a, b, score) for (a, b), score in scores.items() if (a, b) not in seen]
+    Pair.objects.bulk_create([Pair(user_a_id=a, user_b_id=b, pair_degree=score) for a, b, score in created],
+                             batch_size=500)
+    touched.update(name for a, b, _ in created for name in (a, b))
+    conditional.bump(*(conditional.pair_stamp(user_name) for user_name in touched))
+
+
+@transaction.atomic
+def save_pairs(rows, owners, by_user_a_only=False):
+    """Upsert (user_a, user_b, score) rows into Pair.
+    owners are the users whose pairs are fully described by rows, their
+    other Pair rows are deleted. With by_user_a_only, only the rows where the
+    owner is user_a are replaced (used by sharded batch runs, where each
+    unordered pair belongs to the shard of its smaller user)."""
+    scores = {canonical_pair(a, b): score for a, b, score in rows}
+    if by_user_a_only:
+        existing = Pair.objects.filter(user_a__in=owners)
+    else:
+        existing = Pair.objects.filter(Q(user_a__in=owners) | Q(user_b__in=owners))
+    _write_pairs(existing, scores, delete_missing=True)
+
+
+def update_user_pairs(user_name):
+    scores = compute_user_scores(user_name)
+    save_pairs([(user_name, other, score) for other, score in scores.items()], [user_name])
+    return scores
+
+
+def update_pairs_among_followers(follow, shard_size=None):
+    """Recompute the pairs among the followers of follow, the weight of
+    follow as their common friend depends on its number of followers.
+    O(followers²), run by PairQueue outside the request. With shard_size,
+    the pairs of every shard_size followers are written in their own
+    transaction (the pending users of compute_pair_degree --pending)."""
+    members_qs = friendship_edges().filter(follow=follow).values("follower_id")
+    follows = defaultdict(set)
+    for member, c in friendship_edges().filter(follower__in=members_qs)\
+            .values_list("follower_id", "follow_id").distinct():
+        follows[member].add(c)
+    if len(follows) < 2:
+        return
+    in_degree = dict(
+        friendship_edges().filter(follow__in=friendship_edges().filter(follower__in=members_qs).values("follow_id"))
+        .values("follow_id").annotate(n=Count("follower_id", distinct=True)).order_by()
+        .values_list("follow_id", "n")
+    )
+    members = sorted(follows)
+    shard_size = shard_size or len(members)
+    for start in range(0, len(members), shard_size):
+        shard = members[start:start + shard_size]
+        scores = {}
+        for i, x in enumerate(shard, start):
+            follows_x = follows[x]
+            for y in members[i + 1:]:
+                common = follows_x & follows[y]
+                weight = sum(common_friend_weight(in_degree[c]) for c in common)
+                scores[(x, y)] = pair_score(weight, len(common), len(follows_x) + len(follows[y]) - len(common))
+        # 每对用户按 user_a < user_b 存储, 属于 user_a 所在的分片
+        with transaction.atomic():
+            existing = Pair.objects.filter(user_a__in=shard, user_b__in=members_qs)
+            _write_pairs(existing, scores, delete_missing=False)
+
+
+def pending_name(user_name):
+    return PAIR_PENDING_PREFIX + user_name
+
+
+def mark_pending(user_name):
+    """Leave the pairs among the followers of user_name to
+    compute_pair_degree --pending"""
+    Global_Counter.objects.update_or_create(name=pending_name(user_name), defaults={"value": 1})
+
+
+def pending_users() -> list:
+    return sorted(name[len(PAIR_PENDING_PREFIX):] for name in
+                  Global_Counter.objects.filter(name__startswith=PAIR_PENDING_PREFIX).values_list("name", flat=True))
+
+
+def clear_pending(user_names):
+    names = [pending_name(user_name) for user_name in user_names]
+    for k in range(0, len(names), 500):
+        Global_Counter.objects.filter(name__in=names[k:k + 500]).delete()
+
+
+@transaction.atomic
+def update_pairs_on_follow_change(follower, follow):
+    """Bring Pair up to date after follower started or stopped following
+    follow, with the same result as a full recompute.
+    Two groups of pairs change:
+        the pairs of follower, whose follow set changed
+        the pairs among the other followers of follow, because the weight of
+        follow as a common friend depends on its number of followers
+    """
+    update_user_pairs(follower)
+    update_pairs_among_followers(follow)
+
+
+class PairQueue:
+    """Applies follow changes to Pair on a daemon thread, outside the
+    request: the pairs of the follower, and the pairs among the followers of
+    the followed user. A task queued again before its turn runs once.
+    Users with more than PAIR_QUEUE_MAX_FOLLOWERS followers are marked
+    pending instead, compute_pair_degree --pending recomputes them in
+    shards. With background=False nothing runs until flush()."""
+    USER, FOLLOWERS = "user", "followers"
+
+    def __init__(self, max_followers=PAIR_QUEUE_MAX_FOLLOWERS, background=True):
+        self.max_followers = max_followers
+        self.background = background
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        # 取任务和执行在同一把锁内, flush() 返回时没有执行中的任务
+        self._apply_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def put(self, follow):
+        """Recompute the pairs among the followers of follow"""
+        self._put((self.FOLLOWERS, follow))
+
+    def put_user(self, user_name):
+        """Recompute the pairs of user_name"""
+        self._put((self.USER, user_name))
+
+    def _put(self, task):
+        with self._lock:
+            self._pending[task] = None
+            if self._thread is None and self.background:
+                self._thread = Thread(target=self._run, name="pair-queue", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _take(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            return self._pending.popitem(last=False)[0]
+
+    def _apply(self, task):
+        kind, user_name = task
+        try:
+            if kind == self.USER:
+                update_user_pairs(user_name)
+            elif friendship_edges().filter(follow=user_name).count() <= self.max_followers:
+                update_pairs_among_followers(user_name)
+            else:
+                mark_pending(user_name)
+        except Exception:
+            logger.exception("Fail to update the pairs of %s %s", kind, user_name)
+
+    def _apply_next(self):
+        """Apply the oldest task, False if there is none"""
+        with self._apply_lock:
+            task = self._take()
+            if task is None:
+                return False
+            self._apply(task)
+            return True
+
+    def _run(self):
+        from django.db import close_old_connections
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            close_old_connections()
+            while self._apply_next():
+                pass
+
+    def flush(self):
+        """Apply every queued task in the calling thread"""
+        while self._apply_next():
+            pass
+
+
+pair_queue = PairQueue()
+
+
+def follow_changed(follower, follow, queue=None):
+    """Called by post_follow/post_unfollow: the pairs of follower and the
+    pairs among the followers of follow are queued on pair_queue when the
+    transaction commits"""
+    queue = queue or pair_queue
+
+    def put():
+        queue.put_user(follower)
+        queue.put(follow)
+    transaction.on_commit(put)
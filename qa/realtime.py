@@ -0,0 +1,378 @@
+"""
+Real-time chat delivery.
+
+post_chat_message publishes every new message to the Hub, which pushes it
+to the WebSocket connections subscribed to the chat ("chat:<chat_id>") or
+to the receiving user ("user:<user_name>").
+
+Events travel between worker processes through a Broker:
+    LocalBroker   single process, delivers in memory
+    SQLiteBroker  several processes on one host share a SQLite event table
+
+Requests never publish themselves: publish_chat_message() hands the
+message to publish_queue after the commit, a daemon thread sends its events
+to the Broker (one SQLite transaction for all of them) and logs failures,
+so a stored message never turns into an error response.
+
+Each connection has a bounded queue. A consumer that falls
+REALTIME_QUEUE_SIZE events behind is disconnected with
+CLOSE_CODE_OVERFLOW and should resync with get_chat_message?after_id=.
+"""
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from queue import Queue, Empty
+from threading import Lock, Thread, Event, local
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+REALTIME_QUEUE_SIZE = getattr(settings, "REALTIME_QUEUE_SIZE", 100)
+CLOSE_CODE_OVERFLOW = 4008
+CLOSE_CODE_AUTH_FAIL = 4003
+CLOSE_CODE_INVALID_PARAM = 4000
+WEBSOCKET_PATH = "/ws/chat/"
+
+
+def chat_channel(chat_id) -> str:
+    return "chat:{}".format(chat_id)
+
+
+def user_channel(user_name) -> str:
+    return "user:{}".format(user_name)
+
+
+# Broker
+
+class Broker:
+    """Carry (channel, payload) events to every subscribed process,
+    including the publishing one."""
+
+    def publish(self, channel: str, payload: str):
+        raise NotImplementedError
+
+    def publish_many(self, events):
+        """Publish [(channel, payload)]"""
+        for channel, payload in events:
+            self.publish(channel, payload)
+
+    def subscribe(self, callback):
+        """callback(channel, payload) is called for every event, possibly
+        from another thread."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBroker(Broker):
+    def __init__(self):
+        self._callbacks = []
+
+    def publish(self, channel, payload):
+        for callback in self._callbacks:
+            callback(channel, payload)
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+
+class SQLiteBroker(Broker):
+    """Event bus on a SQLite table shared by the worker processes of a host.
+    Publishing appends a row, a polling thread in every process reads the
+    rows after the last one it has seen. Rows older than retention seconds
+    are pruned by the publishers."""
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, poll_interval=0.05, retention=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = local()
+        self._callbacks = []
+        self._stop = Event()
+        self._thread = None
+        self._publish_cnt = 0
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS realtime_event ("
+                     "event_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)")
+        conn.commit()
+        # 只投递启动之后的事件
+        self._last_id = conn.execute("SELECT COALESCE(MAX(event_id), 0) FROM realtime_event").fetchone()[0]
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def publish(self, channel, payload):
+        self.publish_many([(channel, payload)])
+
+    def publish_many(self, events):
+        conn = self._connection()
+        now = time.time()
+        conn.executemany("INSERT INTO realtime_event (channel, payload, created) VALUES (?, ?, ?)",
+                         [(channel, payload, now) for channel, payload in events])
+        self._publish_cnt += 1
+        if self._publish_cnt % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM realtime_event WHERE created < ?", (now - self.retention,))
+        conn.commit()
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        if self._thread is None:
+            self._thread = Thread(target=self._poll, name="realtime-sqlite-broker", daemon=True)
+            self._thread.start()
+
+    def _poll(self):
+        conn = self._connection()
+        while not self._stop.is_set():
+            try:
+                rows = conn.execute("SELECT event_id, channel, payload FROM realtime_event "
+                                    "WHERE event_id > ? ORDER BY event_id", (self._last_id,)).fetchall()
+            except sqlite3.Error:
+                logger.exception("Fail to poll realtime events")
+                rows = []
+            for event_id, channel, payload in rows:
+                self._last_id = event_id
+                for callback in self._callbacks:
+                    callback(channel, payload)
+            if not rows:
+                self._stop.wait(self.poll_interval)
+
+    def close(self):
+        self._stop.set()
+
+
+# Hub
+
+class Subscription:
+    """The bounded event queue of one connection. Lives on the event loop
+    of the connection, the Hub hands events over with call_soon_threadsafe."""
+
+    def __init__(self, channels, loop, maxsize=REALTIME_QUEUE_SIZE):
+        self.channels = tuple(channels)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def offer(self, payload):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # 慢消费者: 不再缓存, 通知连接关闭
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class Hub:
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self._lock = Lock()
+        self._subscriptions = defaultdict(set)
+        broker.subscribe(self._dispatch)
+
+    def subscribe(self, channels, loop, maxsize=REALTIME_QUEUE_SIZE) -> Subscription:
+        subscription = Subscription(channels, loop, maxsize)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subs = self._subscriptions.get(channel)
+                if subs is not None:
+                    subs.discard(subscription)
+                    if not subs:
+                        del self._subscriptions[channel]
+
+    def publish(self, channel, message: dict):
+        self.broker.publish(channel, json.dumps(message, cls=DjangoJSONEncoder))
+
+    def publish_chat_message(self, message: dict):
+        """Publish a serialized Chat_Message to its chat and to both users"""
+        payload = json.dumps({"type": "chat_message", "message": message}, cls=DjangoJSONEncoder)
+        channels = [chat_channel(message["chat_id"]), user_channel(message["to_user"])]
+        if message["from_user"] != message["to_user"]:
+            channels.append(user_channel(message["from_user"]))
+        self.broker.publish_many([(channel, payload) for channel in channels])
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            subs = list(self._subscriptions.get(channel, ()))
+        for subscription in subs:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, payload)
+            except RuntimeError:
+                # event loop 已关闭
+                self.unsubscribe(subscription)
+
+
+_hub = None
+_hub_lock = Lock()
+
+
+def build_broker() -> Broker:
+    name = getattr(settings, "REALTIME_BROKER", "local")
+    if name == "local":
+        return LocalBroker()
+    if name == "sqlite":
+        return SQLiteBroker(getattr(settings, "REALTIME_SQLITE_PATH", "/tmp/teapal-realtime.sqlite3"))
+    raise ValueError("Unknown REALTIME_BROKER: {}".format(name))
+
+
+def get_hub() -> Hub:
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                _hub = Hub(build_broker())
+    return _hub
+
+
+class PublishQueue:
+    """Publishes the queued chat messages to the Hub on a daemon thread.
+    A failed publish is logged and dropped, clients resync with
+    get_chat_message?after_id=."""
+
+    def __init__(self):
+        self._queue = Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def put(self, message: dict):
+        self._queue.put(message)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name="realtime-publish", daemon=True)
+                    self._thread.start()
+
+    def _apply(self, message):
+        try:
+            get_hub().publish_chat_message(message)
+        except Exception:
+            logger.exception("Fail to publish chat message %s", message.get("chat_message_id"))
+        finally:
+            self._queue.task_done()
+
+    def _run(self):
+        while True:
+            self._apply(self._queue.get())
+
+    def flush(self):
+        """Publish every queued message in the calling thread"""
+        while True:
+            try:
+                message = self._queue.get_nowait()
+            except Empty:
+                return
+            self._apply(message)
+
+
+publish_queue = PublishQueue()
+
+
+def publish_chat_message(message: dict):
+    """Publish a serialized Chat_Message once the surrounding transaction
+    commits, without waiting for the Broker"""
+    transaction.on_commit(lambda: publish_queue.put(message))
+
+
+# WebSocket
+
+def private_get_cookie(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == b"cookie":
+            morsel = SimpleCookie(value.decode("latin-1")).get(name)
+            if morsel is not None:
+                return morsel.value
+    return None
+
+
+@sync_to_async
+def private_authorize(token, chat_id):
+    """Return the channels the token may subscribe to, None if not allowed"""
+    from qa import session
+    from qa.models import Chat
+    auth_user = session.resolve_token(token)
+    if auth_user is None:
+        return None
+    if chat_id is None:
+        return [user_channel(auth_user.user_name)]
+    try:
+        chat = Chat.objects.get(pk=chat_id)
+    except Chat.DoesNotExist:
+        return None
+    if auth_user.user_name not in (chat.user_a_id, chat.user_b_id):
+        return None
+    return [chat_channel(chat_id)]
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ws://<host>/ws/chat/            messages of all chats of the user
+    ws://<host>/ws/chat/?chat_id=1  messages of one chat
+    Authenticated by the token cookie, every frame is a JSON event.
+    """
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+    if scope["path"] != WEBSOCKET_PATH:
+        await send({"type": "websocket.close", "code": 4004})
+        return
+    query = parse_qs(scope.get("query_string", b"").decode())
+    try:
+        chat_id = int(query["chat_id"][0]) if "chat_id" in query else None
+    except ValueError:
+        # 不能退回为订阅用户的全部聊天
+        await send({"type": "websocket.close", "code": CLOSE_CODE_INVALID_PARAM})
+        return
+    channels = await private_authorize(private_get_cookie(scope, "token"), chat_id)
+    if channels is None:
+        await send({"type": "websocket.close", "code": CLOSE_CODE_AUTH_FAIL})
+        return
+    await send({"type": "websocket.accept"})
+
+    hub = get_hub()
+    subscription = hub.subscribe(channels, asyncio.get_event_loop())
+    receiver = asyncio.ensure_future(receive())
+    try:
+        while True:
+            getter = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait([getter, receiver], return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                payload = getter.result()
+                if payload is None:
+                    await send({"type": "websocket.close", "code": CLOSE_CODE_OVERFLOW})
+                    return
+                await send({"type": "websocket.send", "text": payload})
+            else:
+                getter.cancel()
+            if receiver in done:
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                # 客户端发来的消息忽略
+                receiver = asyncio.ensure_future(receive())
+    finally:
+        receiver.cancel()
+        hub.unsubscribe(subscription)
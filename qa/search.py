@@ -0,0 +1,144 @@
+"""
+Full-text search over Moment.content and Chat_Message.content, on the
+haystack + Whoosh + jieba stack (see qa/search_indexes.py and
+qa/whoosh_cn_backend.py).
+
+Write views never wait for an index commit: post_moment, post_chat_message
+and delete_chat_message only put the change on index_queue, a daemon
+thread applies the queued changes to the index in batches.
+Indexing is disabled when haystack is not in INSTALLED_APPS.
+"""
+from queue import Queue, Empty
+from threading import Lock, Thread
+import logging
+import time
+
+from django.apps import apps
+from django.conf import settings
+
+from qa.models import Moment, Chat_Message
+
+logger = logging.getLogger(__name__)
+
+SEARCH_QUEUE_BATCH = getattr(settings, "SEARCH_QUEUE_BATCH", 200)
+SEARCH_QUEUE_INTERVAL = getattr(settings, "SEARCH_QUEUE_INTERVAL", 1.0)
+
+ACTION_UPDATE = "update"
+ACTION_REMOVE = "remove"
+
+
+def search_enabled():
+    return apps.is_installed("haystack")
+
+
+def private_get_backend():
+    from haystack import connections
+    connection = connections["default"]
+    return connection.get_unified_index(), connection.get_backend()
+
+
+def apply_changes(changes):
+    """Apply [(action, model, pk)] to the index. The last action on the same
+    row wins, updates of one model are sent to the backend as one batch."""
+    latest = {}
+    for action, model, pk in changes:
+        latest[(model, pk)] = action
+    unified_index, backend = private_get_backend()
+    updates = {}
+    for (model, pk), action in latest.items():
+        if action == ACTION_UPDATE:
+            updates.setdefault(model, []).append(pk)
+        else:
+            backend.remove("{}.{}".format(model._meta.label_lower, pk))
+    for model, pks in updates.items():
+        index = unified_index.get_index(model)
+        objs = list(index.index_queryset().filter(pk__in=pks))
+        if objs:
+            backend.update(index, objs)
+
+
+class IndexQueue:
+    def __init__(self, batch_size=SEARCH_QUEUE_BATCH, interval=SEARCH_QUEUE_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def update(self, instance):
+        self._put(ACTION_UPDATE, instance)
+
+    def remove(self, instance):
+        self._put(ACTION_REMOVE, instance)
+
+    def _put(self, action, instance):
+        if not search_enabled():
+            return
+        self._queue.put((action, type(instance), instance.pk))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name="search-index-queue", daemon=True)
+                    self._thread.start()
+
+    def _take_batch(self, block=True):
+        """Wait for the first change, then gather more for up to interval seconds"""
+        batch = []
+        try:
+            batch.append(self._queue.get(block=block))
+        except Empty:
+            return batch
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic() if block else 0
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _apply(self, batch):
+        try:
+            apply_changes(batch)
+        except Exception:
+            logger.exception("Fail to apply %d search index changes", len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        from django.db import close_old_connections
+        while True:
+            batch = self._take_batch()
+            close_old_connections()
+            self._apply(batch)
+
+    def flush(self):
+        """Apply every queued change in the calling thread"""
+        while True:
+            batch = self._take_batch(block=False)
+            if not batch:
+                return
+            self._apply(batch)
+
+
+index_queue = IndexQueue()
+
+
+def private_load_in_order(model, pks):
+    rows = model.objects.in_bulk(pks)
+    return [rows[pk] for pk in pks if pk in rows]
+
+
+def search_moments(q, limit=20):
+    """Moments matching q, best match first"""
+    from haystack.query import SearchQuerySet
+    results = SearchQuerySet().models(Moment).auto_query(q)[:limit]
+    return private_load_in_order(Moment, [int(r.pk) for r in results])
+
+
+def search_chat_messages(user_name, q, limit=20):
+    """Chat messages of the chats of the user matching q, best match first"""
+    from haystack.query import SearchQuerySet
+    results = SearchQuerySet().models(Chat_Message).filter(participants=user_name).auto_query(q)[:limit]
+    return private_load_in_order(Chat_Message, [int(r.pk) for r in results])
@@ -0,0 +1,32 @@
+from haystack import indexes
+
+from qa.models import Moment, Chat_Message
+
+
+class MomentIndex(indexes.SearchIndex, indexes.Indexable):
+    text = indexes.CharField(document=True, use_template=True)
+    user_name = indexes.CharField(model_attr="user_name_id", null=True)
+    created_time = indexes.DateTimeField(model_attr="created_time")
+
+    def get_model(self):
+        return Moment
+
+    def get_updated_field(self):
+        return "created_time"
+
+
+class ChatMessageIndex(indexes.SearchIndex, indexes.Indexable):
+    text = indexes.CharField(document=True, use_template=True)
+    # 只允许搜索自己参与的聊天
+    participants = indexes.MultiValueField()
+    chat_id = indexes.IntegerField(model_attr="chat_id_id", null=True)
+    created_time = indexes.DateTimeField(model_attr="created_time")
+
+    def get_model(self):
+        return Chat_Message
+
+    def get_updated_field(self):
+        return "created_time"
+
+    def prepare_participants(self, obj):
+        return [name for name in (obj.from_user_id, obj.to_user_id) if name]
@@ -0,0 +1,94 @@
+"""
+In-process session cache.
+
+Maps a login token to the few fields the token auth decorator needs
+(user_name, identity, is_active, expired_date), so authenticated POSTs do
+not hit the User table on every request.
+Entries expire after SESSION_TTL_SECONDS and the least recently used entry
+is dropped once SESSION_MAX_SIZE is reached.
+Views that change a user's token or state must call invalidate_user().
+"""
+from collections import OrderedDict, namedtuple
+from threading import Lock
+import time
+
+SESSION_TTL_SECONDS = 300
+SESSION_MAX_SIZE = 10000
+
+Session = namedtuple("Session", ["user_name", "token", "identity", "is_active", "expired_date"])
+
+_lock = Lock()
+# token -> (Session, deadline)
+_sessions = OrderedDict()
+# user_name -> token, so a user can be invalidated without knowing the token
+_user_tokens = {}
+
+
+def session_from_user(user) -> Session:
+    return Session(user_name=user.user_name,
+                   token=user.token,
+                   identity=user.identity,
+                   is_active=user.is_active,
+                   expired_date=user.expired_date)
+
+
+def get_session(token):
+    """Return the cached Session of the token, or None on miss / expiry"""
+    if not token:
+        return None
+    with _lock:
+        entry = _sessions.get(token)
+        if entry is None:
+            return None
+        session, deadline = entry
+        if deadline < time.monotonic():
+            del _sessions[token]
+            _forget_user_token(token, session.user_name)
+            return None
+        _sessions.move_to_end(token)
+        return session
+
+
+def put_session(session: Session):
+    with _lock:
+        old_token = _user_tokens.get(session.user_name)
+        if old_token is not None and old_token != session.token:
+            _sessions.pop(old_token, None)
+        _sessions[session.token] = (session, time.monotonic() + SESSION_TTL_SECONDS)
+        _sessions.move_to_end(session.token)
+        _user_tokens[session.user_name] = session.token
+        while len(_sessions) > SESSION_MAX_SIZE:
+            token, (session, _) = _sessions.popitem(last=False)
+            _forget_user_token(token, session.user_name)
+
+
+def resolve_token(token):
+    """Return the Session of the token, loading it from the User table on a
+    cache miss. None if no user holds the token."""
+    auth_user = get_session(token)
+    if auth_user is None and token:
+        from qa.models import User
+        try:
+            auth_user = session_from_user(User.objects.get(token=token))
+        except User.DoesNotExist:
+            return None
+        put_session(auth_user)
+    return auth_user
+
+
+def invalidate_user(user_name):
+    with _lock:
+        token = _user_tokens.pop(user_name, None)
+        if token is not None:
+            _sessions.pop(token, None)
+
+
+def clear():
+    with _lock:
+        _sessions.clear()
+        _user_tokens.clear()
+
+
+def _forget_user_token(token, user_name):
+    if _user_tokens.get(user_name) == token:
+        del _user_tokens[user_name]
@@ -0,0 +1,67 @@
+"""
+A local SMTP server that accepts and counts every message without
+delivering it, to test the mail pipeline offline. Speaks just enough SMTP
+for smtplib / Django's SMTP backend (no TLS, no AUTH).
+
+    python manage.py smtp_sink --port 1025
+"""
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Lock, Thread
+
+
+class SMTPSinkHandler(StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self):
+        self.reply("220 teapal-smtp-sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip().split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.reply("250-teapal-smtp-sink")
+                self.reply("250 8BITMIME")
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    size += len(data)
+                self.server.record(size)
+                self.reply("250 OK queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SMTPSink(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), SMTPSinkHandler)
+        self._lock = Lock()
+        self.message_cnt = 0
+        self.byte_cnt = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, size):
+        with self._lock:
+            self.message_cnt += 1
+            self.byte_cnt += size
+
+    def start(self):
+        """Serve in a daemon thread"""
+        thread = Thread(target=self.serve_forever, name="smtp-sink", daemon=True)
+        thread.start()
+        return thread
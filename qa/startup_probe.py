@@ -0,0 +1,55 @@
+"""
+Measure the cold start of one worker process, run in a fresh interpreter:
+
+    python -m qa.startup_probe [url ...]
+
+Print one JSON object with the milliseconds spent importing Django,
+in django.setup(), importing qa.views and serving the first (cold) and
+second (warm) request of every url through the test client.
+Used by the bench_startup command.
+"""
+import json
+import os
+import sys
+import time
+
+
+def main(urls):
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(name, since):
+        now = time.perf_counter()
+        timings[name] = (now - since) * 1000
+        return now
+
+    t = time.perf_counter()
+    import django
+    t = lap("import_django_ms", t)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ciwkbe.settings")
+    django.setup()
+    t = lap("django_setup_ms", t)
+    import qa.views  # noqa: F401
+    t = lap("import_views_ms", t)
+
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    client = Client()
+    requests = []
+    for url in urls:
+        t = time.perf_counter()
+        status = client.get(url).status_code
+        cold = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        client.get(url)
+        warm = (time.perf_counter() - t) * 1000
+        requests.append({"url": url, "status": status, "first_ms": cold, "second_ms": warm})
+    timings["requests"] = requests
+    timings["total_ms"] = (time.perf_counter() - start) * 1000
+    timings["modules_loaded"] = len(sys.modules)
+    print(json.dumps(timings))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["/api/moment/lattest/"])
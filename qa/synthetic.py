@@ -0,0 +1,152 @@
+"""
+Seeded synthetic dataset for benchmarks.
+
+generate() bulk-loads users (with User_Info and User_Tag), a follow graph
+whose in-degrees follow a power law (a few users have most followers),
+chats with messages and moments, with the maintained counters
+(follower_cnt, follow_cnt, moment_cnt, Last_Message, the global moment
+counter) consistent with the rows. The derived tables are built after the
+bulk load the way their batch jobs would: Timeline_Entry, Pair,
+Read_Position (each participant has read a random prefix of the chat) and
+Intimacy (intimacy.stream, which folds in every message above the
+high-water mark, not only the synthetic ones). The same seed gives the
+same data.
+Every synthetic user name starts with SYNTHETIC_PREFIX, cleanup() deletes
+them with their rows.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import random
+
+from django.db import transaction
+from django.db.models import Max, Q
+
+from qa import tag_index, timeline, intimacy
+from qa.feed import MOMENT_COUNTER
+from qa.models import (User, User_Info, User_Tag, Friendship, Chat, Chat_Message, Last_Message, Read_Position,
+                       Moment, Global_Counter, Intimacy, Pair)
+from qa.pair import FriendGraph, canonical_pair
+
+SYNTHETIC_PREFIX = "~load-"
+TAGS = ["篮球", "足球", "Python", "音乐", "电影", "摄影", "读书", "旅行", "游戏", "健身", "美食", "动漫",
+        "chess", "hiking", "music", "coding", "跑步", "画画", "吉他", "考研"]
+WORDS = ["今天", "图书馆", "食堂", "考试", "deadline", "hello", "好累", "一起", "吃饭", "周末", "上课", "作业"]
+
+
+def user_names(users):
+    return ["{}{:06d}".format(SYNTHETIC_PREFIX, i) for i in range(users)]
+
+
+def random_text(rng, n=6):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+@transaction.atomic
+def generate(users=1000, follows_per_user=20, chats=2000, messages=50000, moments=20000, tags_per_user=3,
+             power=1.0, seed=0) -> list:
+    """Load the dataset, return the synthetic user names, most followed first"""
+    rng = random.Random(seed)
+    names = user_names(users)
+    # 第 i 个用户被选中的权重为 1 / (i + 1) ** power
+    popularity = [1 / (i + 1) ** power for i in range(users)]
+    expired_date = datetime.now() + timedelta(days=365)
+    User.objects.bulk_create([
+        User(user_name=name, email="{}@example.com".format(name), password=name, token=name,
+             expired_date=expired_date, is_active=True, identity="S", avatar=name + ".png")
+        for name in names
+    ], batch_size=1000)
+
+    follows = set()
+    for follower in names:
+        for follow in rng.choices(names, popularity, k=follows_per_user):
+            if follow != follower:
+                follows.add((follower, follow))
+    Friendship.objects.bulk_create([Friendship(follower_id=a, follow_id=b) for a, b in follows], batch_size=1000)
+
+    moment_authors = rng.choices(names, popularity, k=moments)
+    Moment.objects.bulk_create([Moment(user_name_id=author, content=random_text(rng)) for author in moment_authors],
+                               batch_size=1000)
+
+    follower_cnt = Counter(b for _, b in follows)
+    follow_cnt = Counter(a for a, _ in follows)
+    moment_cnt = Counter(moment_authors)
+    User_Info.objects.bulk_create([
+        User_Info(user_name_id=name, intro=random_text(rng, 3), school="CUHK-SZ",
+                  follower_cnt=follower_cnt[name], follow_cnt=follow_cnt[name], moment_cnt=moment_cnt[name])
+        for name in names
+    ], batch_size=1000)
+    User_Tag.objects.bulk_create([
+        User_Tag(user_name_id=name, content=tag)
+        for name in names for tag in rng.sample(TAGS, min(tags_per_user, len(TAGS)))
+    ], batch_size=1000)
+
+    # 聊天多发生在关注关系之间
+    candidates = sorted({canonical_pair(a, b) for a, b in follows})
+    chat_keys = rng.sample(candidates, min(chats, len(candidates)))
+    Chat.objects.bulk_create([Chat(user_a_id=a, user_b_id=b) for a, b in sorted(chat_keys)], batch_size=1000)
+    chat_rows = list(Chat.objects.filter(user_a__in=names).values_list("chat_id", "user_a_id", "user_b_id"))
+    if chat_rows:
+        activity = [1 / (i + 1) ** power for i in range(len(chat_rows))]
+        batch = []
+        for chat_id, a, b in rng.choices(chat_rows, activity, k=messages):
+            from_user, to_user = (a, b) if rng.random() < 0.5 else (b, a)
+            batch.append(Chat_Message(chat_id_id=chat_id, from_user_id=from_user, to_user_id=to_user,
+                                      content=random_text(rng)))
+            if len(batch) >= 5000:
+                Chat_Message.objects.bulk_create(batch, batch_size=1000)
+                batch = []
+        Chat_Message.objects.bulk_create(batch, batch_size=1000)
+        latest = Chat_Message.objects.filter(chat_id__in=[row[0] for row in chat_rows]).order_by()\
+            .values("chat_id").annotate(latest=Max("chat_message_id")).values_list("chat_id", "latest")
+        Last_Message.objects.bulk_create([Last_Message(chat_id_id=chat_id, lattest_message_id=message_id)
+                                          for chat_id, message_id in latest], batch_size=1000)
+
+    Global_Counter.objects.update_or_create(name=MOMENT_COUNTER, defaults={"value": Moment.objects.count()})
+    tag_index.rebuild()
+    for name in names:
+        timeline.rebuild(name)
+    # 全部是新用户, 直接写入, 每对用户按 user_a < user_b 只出现一次
+    graph = FriendGraph(names, follows)
+    Pair.objects.bulk_create([Pair(user_a_id=a, user_b_id=b, pair_degree=score)
+                              for a, b, score in graph.shard_rows(0, len(graph))], batch_size=1000)
+    generate_read_positions(rng, chat_rows)
+    for _ in intimacy.stream(lag=0):
+        pass
+    return sorted(names, key=lambda name: -follower_cnt[name])
+
+
+def generate_read_positions(rng, chat_rows):
+    """Read_Position of both participants of every chat, read up to a random
+    message (or nothing), with unread_cnt counted from the messages"""
+    messages = defaultdict(list)
+    for k in range(0, len(chat_rows), 500):
+        chat_ids = [row[0] for row in chat_rows[k:k + 500]]
+        for pk, chat_id, to_user in Chat_Message.objects.filter(chat_id__in=chat_ids).order_by("pk")\
+                .values_list("pk", "chat_id_id", "to_user_id"):
+            messages[chat_id].append((pk, to_user))
+    positions = []
+    for chat_id, a, b in chat_rows:
+        for user_name in (a, b):
+            chat_messages = messages[chat_id]
+            # 已读到第 k 条之前, k == 0 表示未读过
+            k = rng.randint(0, len(chat_messages))
+            last_read = chat_messages[k - 1][0] if k else None
+            unread = sum(1 for _, to_user in chat_messages[k:] if to_user == user_name)
+            positions.append(Read_Position(chat_id_id=chat_id, user_name_id=user_name,
+                                           last_read_message_id=last_read, unread_cnt=unread))
+    Read_Position.objects.bulk_create(positions, batch_size=1000)
+
+
+@transaction.atomic
+def cleanup():
+    """Delete the synthetic users and everything they own"""
+    users = User.objects.filter(user_name__startswith=SYNTHETIC_PREFIX)
+    # 删除用户只会把亲密度的用户置空
+    Intimacy.objects.filter(Q(user_a__in=users) | Q(user_b__in=users)).delete()
+    Chat_Message.objects.filter(from_user__in=users).delete()
+    Chat.objects.filter(user_a__in=users).delete()
+    Moment.objects.filter(user_name__in=users).delete()
+    deleted, _ = users.delete()
+    Global_Counter.objects.update_or_create(name=MOMENT_COUNTER, defaults={"value": Moment.objects.count()})
+    tag_index.rebuild()
+    return deleted
@@ -0,0 +1,59 @@
+"""
+Inverted tag index.
+
+Tag_Index maps every normalized tag term to the users having it (its
+posting list), so the users sharing tags with someone are found with one
+indexed GROUP BY instead of a LIKE scan of User_Tag per tag.
+post_user_tag keeps it up to date, the rebuild_tag_index command rebuilds
+it from User_Tag.
+"""
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Count
+
+from qa.models import User_Tag, Tag_Index
+
+TERM_MAX_LENGTH = 100
+
+
+def normalize_tag(content):
+    """Fold width, case and whitespace of a tag, e.g. "Ｍachine  Learning" and
+    "machine learning" give the same term. None for a blank tag."""
+    if not content:
+        return None
+    term = unicodedata.normalize("NFKC", content).casefold()
+    term = re.sub(r"\s+", " ", term).strip()
+    return term[:TERM_MAX_LENGTH] or None
+
+
+def add_user_tag(user_name, content):
+    term = normalize_tag(content)
+    if term is not None:
+        Tag_Index.objects.bulk_create([Tag_Index(term=term, user_name_id=user_name)], ignore_conflicts=True)
+
+
+def top_overlap_users(user_name, k=3):
+    """The k users sharing the most tag terms with the user, as
+    [(user_name, shared_tag_cnt)], most shared first"""
+    terms = Tag_Index.objects.filter(user_name=user_name).values("term")
+    rows = Tag_Index.objects.filter(term__in=terms).exclude(user_name=user_name)\
+        .values("user_name").annotate(n=Count("term")).order_by("-n", "user_name")[:k]
+    return [(row["user_name"], row["n"]) for row in rows]
+
+
+@transaction.atomic
+def rebuild(chunk_size=2000):
+    """Rebuild Tag_Index from User_Tag, return the number of index rows"""
+    Tag_Index.objects.all().delete()
+    batch = []
+    for user_name, content in User_Tag.objects.values_list("user_name_id", "content").iterator(chunk_size=chunk_size):
+        term = normalize_tag(content)
+        if term is not None:
+            batch.append(Tag_Index(term=term, user_name_id=user_name))
+        if len(batch) >= chunk_size:
+            Tag_Index.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    Tag_Index.objects.bulk_create(batch, ignore_conflicts=True)
+    return Tag_Index.objects.count()
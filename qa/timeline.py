@@ -0,0 +1,196 @@
+"""
+Home timeline: moments of the users someone follows.
+
+post_moment fans the moment out into a Timeline_Entry per follower (and
+one for the author), so reading a timeline is an index range scan and
+never writes. Timelines are trimmed to TIMELINE_MAX_LENGTH entries after
+about one moment in TIMELINE_TRIM_EVERY: its fan-out queues the owners on
+trim_queue, which trims them on a daemon thread after the commit (so a
+timeline grows past the limit by about that many entries before it is
+trimmed). Every backfill trims the one follower in the request.
+
+Authors with more than CELEBRITY_FOLLOWER_CNT followers are not fanned
+out. Their moments are read from Moment when the timeline is read and
+k-way merged with the stored entries. Once such an author drops back below
+the threshold, the moments posted meanwhile are in no timeline and are no
+longer merged either, until the followers' timelines are rebuilt
+(rebuild_timelines --author <user_name>).
+
+Following someone backfills their latest moments into the timeline,
+unfollowing removes them. rebuild() builds timelines from the existing
+follows and moments (the rebuild_timelines command).
+"""
+from collections import OrderedDict
+from heapq import merge
+from threading import Lock, Thread, Event
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+
+from qa.models import Moment, User_Info, Friendship, Timeline_Entry
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_MAX_LENGTH = 800
+TIMELINE_BACKFILL = 20
+TIMELINE_TRIM_EVERY = 50
+CELEBRITY_FOLLOWER_CNT = 5000
+
+
+def is_celebrity(user_name):
+    follower_cnt = User_Info.objects.filter(pk=user_name).values_list("follower_cnt", flat=True).first()
+    return (follower_cnt or 0) > CELEBRITY_FOLLOWER_CNT
+
+
+def fan_out(moment):
+    """Write the new moment into the timelines of the author and its followers"""
+    author = moment.user_name_id
+    owners = [author]
+    if not is_celebrity(author):
+        owners += Friendship.objects.filter(follow=author, follower__isnull=False)\
+            .exclude(follower=author).values_list("follower_id", flat=True).distinct()
+    Timeline_Entry.objects.bulk_create([
+        Timeline_Entry(user_name_id=owner, moment_id=moment.moment_id, author_id=author, created_time=moment.created_time)
+        for owner in owners
+    ], batch_size=1000, ignore_conflicts=True)
+    # 每个时间线约每 TIMELINE_TRIM_EVERY 条截断一次, 在请求之外进行
+    if moment.moment_id % TIMELINE_TRIM_EVERY == 0:
+        transaction.on_commit(lambda: trim_queue.put(*owners))
+
+
+def backfill(follower, follow):
+    """follower started following follow"""
+    if is_celebrity(follow):
+        return
+    moments = Moment.objects.filter(user_name=follow).order_by("-created_time", "-moment_id")\
+        .values_list("moment_id", "created_time")[:TIMELINE_BACKFILL]
+    Timeline_Entry.objects.bulk_create([
+        Timeline_Entry(user_name_id=follower, moment_id=moment_id, author_id=follow, created_time=created_time)
+        for moment_id, created_time in moments
+    ], ignore_conflicts=True)
+    trim(follower)
+
+
+def remove_author(follower, follow):
+    """follower stopped following follow"""
+    if follower != follow:
+        Timeline_Entry.objects.filter(user_name=follower, author=follow).delete()
+
+
+def trim(user_name):
+    boundary = Timeline_Entry.objects.filter(user_name=user_name)\
+        .order_by("-created_time", "-moment_id").values_list("created_time", "moment_id")[TIMELINE_MAX_LENGTH:TIMELINE_MAX_LENGTH + 1]
+    boundary = list(boundary)
+    if boundary:
+        created_time, moment_id = boundary[0]
+        Timeline_Entry.objects.filter(user_name=user_name)\
+            .filter(Q(created_time__lt=created_time) | Q(created_time=created_time, moment_id__lte=moment_id)).delete()
+
+
+class TrimQueue:
+    """Trims the timelines of the queued users on a daemon thread.
+    A user queued again before its turn is trimmed once."""
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def put(self, *user_names):
+        with self._lock:
+            for user_name in user_names:
+                self._pending[user_name] = None
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="timeline-trim", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _take(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            return self._pending.popitem(last=False)[0]
+
+    def _apply(self, user_name):
+        try:
+            trim(user_name)
+        except Exception:
+            logger.exception("Fail to trim the timeline of %s", user_name)
+
+    def _run(self):
+        from django.db import close_old_connections
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            close_old_connections()
+            while True:
+                user_name = self._take()
+                if user_name is None:
+                    break
+                self._apply(user_name)
+
+    def flush(self):
+        """Trim every queued user in the calling thread"""
+        while True:
+            user_name = self._take()
+            if user_name is None:
+                return
+            self._apply(user_name)
+
+
+trim_queue = TrimQueue()
+
+
+def followed_authors(user_name):
+    """The user and the users it follows whose moments are fanned out"""
+    authors = Friendship.objects.filter(follower=user_name, follow__isnull=False)\
+        .filter(Q(follow__user_info__isnull=True) | Q(follow__user_info__follower_cnt__lte=CELEBRITY_FOLLOWER_CNT))\
+        .values_list("follow_id", flat=True)
+    return {user_name, *authors}
+
+
+def rebuild(user_name):
+    """Replace the timeline of the user with the latest TIMELINE_MAX_LENGTH
+    moments of the authors it follows, return the number of entries"""
+    moments = Moment.objects.filter(user_name__in=followed_authors(user_name))\
+        .order_by("-created_time", "-moment_id").values_list("moment_id", "user_name_id", "created_time")
+    entries = [
+        Timeline_Entry(user_name_id=user_name, moment_id=moment_id, author_id=author, created_time=created_time)
+        for moment_id, author, created_time in moments[:TIMELINE_MAX_LENGTH]
+    ]
+    with transaction.atomic():
+        Timeline_Entry.objects.filter(user_name=user_name).delete()
+        Timeline_Entry.objects.bulk_create(entries, batch_size=1000)
+    return len(entries)
+
+
+def private_before(queryset, before):
+    if before is None:
+        return queryset
+    return queryset.filter(Q(created_time__lt=before[0]) | Q(created_time=before[0], moment_id__lt=before[1]))
+
+
+def read(user_name, before=None, limit=20):
+    """One page of the home timeline, newest first, after the keyset cursor
+    (created_time, moment_id) if given. Return (moments, has_more)."""
+    entries = private_before(Timeline_Entry.objects.filter(user_name=user_name), before)\
+        .select_related("moment").order_by("-created_time", "-moment_id")[:limit + 1]
+    sources = [[entry.moment for entry in entries]]
+    celebrities = Friendship.objects.filter(follower=user_name, follow__user_info__follower_cnt__gt=CELEBRITY_FOLLOWER_CNT)\
+        .values("follow_id")
+    celebrity_moments = private_before(Moment.objects.filter(user_name__in=celebrities), before)\
+        .order_by("-created_time", "-moment_id")[:limit + 1]
+    sources.append(list(celebrity_moments))
+
+    moments, seen = [], set()
+    for moment in merge(*sources, key=lambda m: (m.created_time, m.moment_id), reverse=True):
+        # 成为 celebrity 之前 fan-out 的 moment 会在两边都出现
+        if moment.moment_id in seen:
+            continue
+        seen.add(moment.moment_id)
+        moments.append(moment)
+        if len(moments) > limit:
+            break
+    return moments[:limit], len(moments) > limit
@@ -4,6 +4,8 @@ from . import views
 
 urlpatterns = [
     path('api/user/<str:user_name>/', views.get_user_info),
+    path('api/users/batch/', views.get_user_cards),
+    path('api/batch/', views.post_batch),
     path('api/user/', views.user_register),
     path('api/user-tag/', views.post_user_tag),
     path('api/email/send/', views.user_send_validate_email),
@@ -16,8 +18,11 @@ urlpatterns = [
     path('api/get_cos_credential/', views.get_cos_credential),
     path('api/chat/', views.post_create_chat),
     path('api/chat/<str:user_name>/', views.get_chat),
+    path('api/chat-read/', views.post_chat_read),
+    path('api/chat-unread/', views.get_total_unread),
     path('api/chat-message/<int:chat_id>/', views.get_chat_message),
     path('api/chat-message/', views.post_chat_message),
+    path('api/chat-message/batch/', views.post_chat_message_batch),
     path('api/chat-message/delete/', views.delete_chat_message),
     path('api/friendship/follow/', views.post_follow),
     path('api/friendship/unfollow/', views.post_unfollow),
@@ -28,5 +33,10 @@ urlpatterns = [
     path('api/pair/<str:user_name>/', views.get_pair_degree),
     path('api/moment/', views.post_moment),
     path('api/moment/user/<str:user_name>/<int:page>/', views.get_user_moments),
-    path('api/moment/lattest/<int:page>/', views.get_lattest_moments)
+    path('api/moment/user/<str:user_name>/', views.get_user_moments),
+    path('api/moment/lattest/<int:page>/', views.get_lattest_moments),
+    path('api/moment/lattest/', views.get_lattest_moments),
+    path('api/moment/timeline/<str:user_name>/', views.get_timeline),
+    path('api/search/moment/', views.search_moment),
+    path('api/search/chat-message/', views.search_chat_message),
 ]
@@ -0,0 +1,98 @@
+"""
+In-process cache of user cards.
+
+A card is what get_user_info returns for a user: the public User fields
+joined with the User_Info row. Responses that embed other users (chat
+list, follower / follow lists, pair suggestions) hydrate them through
+get_many(), which loads every miss in one joined query.
+Entries expire after USER_CARD_TTL_SECONDS, so a card changed by another
+process is stale for at most that long, and the least recently used entry
+is dropped once USER_CARD_MAX_SIZE is reached.
+Code that changes a card (profile, avatar, email state, counters) must
+call invalidate().
+Views tagged by conditional_get pass fresh=True: their ETag comes from
+Version_Stamp in the database, so a body served from a stale entry would be
+cached by the client under the new ETag. They read the cards from the
+database and put them back in the cache.
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from django.conf import settings
+
+from qa.models import User, User_Info
+from qa.serializer import serializer_for
+
+USER_CARD_TTL_SECONDS = getattr(settings, "USER_CARD_TTL_SECONDS", 60)
+USER_CARD_MAX_SIZE = getattr(settings, "USER_CARD_MAX_SIZE", 20000)
+
+USER_FIELDS = ("user_name", "created_time", "is_active", "avatar")
+
+_lock = Lock()
+# user_name -> (card, deadline)
+_cards = OrderedDict()
+
+
+def load_cards(user_names) -> dict:
+    """{user_name: card} of the existing users, in one query"""
+    info_serializer = serializer_for(User_Info)
+    info_columns = ["user_info__" + attname for attname in info_serializer.attnames]
+    cards = {}
+    user_names = list(user_names)
+    for k in range(0, len(user_names), 500):
+        rows = User.objects.filter(pk__in=user_names[k:k + 500]).values_list(*USER_FIELDS, *info_columns)
+        for row in rows:
+            card = dict(zip(USER_FIELDS, row[:len(USER_FIELDS)]))
+            info = row[len(USER_FIELDS):]
+            # 没有 User_Info 的用户只有 User 的字段
+            if info[info_serializer.names.index("user_name")] is not None:
+                card.update(zip(info_serializer.names, info))
+            cards[card["user_name"]] = card
+    return cards
+
+
+def get_many(user_names, fresh=False) -> dict:
+    """{user_name: card}, users that do not exist are left out.
+    With fresh, every card is loaded from the database.
+    The cards are shared, callers must not modify them."""
+    cards, missing = {}, []
+    now = time.monotonic()
+    with _lock:
+        for user_name in set(user_names):
+            if fresh:
+                missing.append(user_name)
+                continue
+            entry = _cards.get(user_name)
+            if entry is None or entry[1] < now:
+                missing.append(user_name)
+                continue
+            _cards.move_to_end(user_name)
+            cards[user_name] = entry[0]
+    if missing:
+        loaded = load_cards(missing)
+        deadline = time.monotonic() + USER_CARD_TTL_SECONDS
+        with _lock:
+            for user_name, card in loaded.items():
+                _cards[user_name] = (card, deadline)
+                _cards.move_to_end(user_name)
+            while len(_cards) > USER_CARD_MAX_SIZE:
+                _cards.popitem(last=False)
+        cards.update(loaded)
+    return cards
+
+
+def get(user_name, fresh=False):
+    """The card of the user, None if the user does not exist"""
+    return get_many([user_name], fresh).get(user_name)
+
+
+def invalidate(*user_names):
+    with _lock:
+        for user_name in user_names:
+            _cards.pop(user_name, None)
+
+
+def clear():
+    with _lock:
+        _cards.clear()
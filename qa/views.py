@@ -3,6 +3,7 @@ from django.shortcuts import get_object_or_404
 from django.http import JsonResponse, HttpResponse
 from .models import *
 from django.db.utils import IntegrityError
+from django.db import transaction
 from django.views.decorators.http import require_http_methods
 from django.forms.models import model_to_dict
 from itertools import chain
@@ -12,11 +13,12 @@ from functools import wraps
 from django.db.models import Count, Sum
 from django.db.models import Q, F
 import json
-from django.core.mail import send_mail
 from django.views import generic
 from django.contrib.auth.mixins import LoginRequiredMixin
-from sts.sts import Sts
-from qa.cos import client, settings as cos_settings
+from qa import session, realtime, pair, tag_index, counters, feed, timeline, search, mail, credential, serializer
+from qa import conditional, user_card, batch
+from qa import chat as chat_service, intimacy
+from qa.conditional import conditional_get, profile_stamp, moment_stamp, friendship_stamp, pair_stamp
 import os
 import re
 import copy
@@ -24,6 +26,8 @@ import math
 from random import sample
 from ciwkbe.settings import EMAIL_HOST_USER as FROM_EMAIL
 from django.db.models import Max
+from django.db.models import Value, DateTimeField
+from django.db.models.functions import Coalesce
 
 TOKEN_LENGTH = 50
 TOKEN_DURING_DAYS = 15
@@ -49,56 +53,115 @@ RESPONSE_MOMENT_DO_NOT_EXIST = HttpResponse(content="Moment do not exist", statu
 
 
 RESPONSE_UNKNOWN_ERROR = HttpResponse(content="Unknown error", status=500, reason="U-ERR")
+RESPONSE_SEARCH_DISABLED = HttpResponse(content="Search is disabled", status=503, reason="S-DIS")
 
 
 def post_token_auth_decorator(force_active=True, require_user_identity=["S", "T", "V", "A"]):
+    """Authenticate the POST by the token cookie.
+    The parsed body is attached as request.body_dict and the resolved
+    session.Session as request.auth_user, so the view does not parse or
+    query them again. A request.auth_user already resolved from the same
+    cookie (by api/batch/) is reused."""
     def decorator(func):
+        @wraps(func)
         def token_auth(request, *args):
             body_dict = json.loads(request.body.decode('utf-8'))
-            try:
-                user = User.objects.get(pk=body_dict.get("user_name"))
-            except User.DoesNotExist:
-                return RESPONSE_USER_DO_NOT_EXIST
-            if request.COOKIES.get("token") != user.token:
-                return HttpResponse(content="Token does not match user", status=403, reason="T-DNM")
-            if user.expired_date < datetime.now():
+            token = request.COOKIES.get("token")
+            auth_user = getattr(request, "auth_user", None) or session.get_session(token)
+            if auth_user is None or auth_user.user_name != body_dict.get("user_name"):
+                try:
+                    user = User.objects.get(pk=body_dict.get("user_name"))
+                except User.DoesNotExist:
+                    return RESPONSE_USER_DO_NOT_EXIST
+                if token != user.token:
+                    return HttpResponse(content="Token does not match user", status=403, reason="T-DNM")
+                auth_user = session.session_from_user(user)
+                session.put_session(auth_user)
+            if auth_user.expired_date < datetime.now():
                 return RESPONSE_TOKEN_EXPIRE
-            if force_active and not user.is_active:
+            if force_active and not auth_user.is_active:
                 return HttpResponse(content="Inactive user, need to validate email", status=403, reason="U-INA")
-            if user.identity not in require_user_identity:
+            if auth_user.identity not in require_user_identity:
                 return HttpResponse(content="User wrong identity", status=403, reason="U-WID")
+            request.body_dict = body_dict
+            request.auth_user = auth_user
             return func(request, *args)
         return token_auth
     return decorator
 
 
 def to_dict(instance, except_fields=[]):
-    opts = instance._meta
-    d = {}
-    for f in chain(opts.concrete_fields, opts.private_fields):
-        if f.name in except_fields:
-            continue
-        d[f.name] = f.value_from_object(instance)
-    for f in opts.many_to_many:
-        if f.name in except_fields:
-            continue
-        d[f.name] = [i.id for i in f.value_from_object(instance)]
-    return d
+    return serializer.serializer_for(type(instance), tuple(except_fields)).from_instance(instance)
+
+
+def private_get_auth_user(request):
+    """Resolve the token cookie of a GET request to a session.Session,
+    None if the token is unknown."""
+    auth_user = getattr(request, "auth_user", None)
+    if auth_user is not None:
+        return auth_user
+    return session.resolve_token(request.COOKIES.get("token"))
+
+
+DEFAULT_PAGE_LIMIT = 20
+MAX_PAGE_LIMIT = 100
+
+
+def private_get_limit(request, default=DEFAULT_PAGE_LIMIT) -> int:
+    """Read ?limit= from the query string, clamped to [1, MAX_PAGE_LIMIT].
+    Raise ValueError on a non-integer value."""
+    limit = int(request.GET.get("limit", default))
+    return max(1, min(limit, MAX_PAGE_LIMIT))
+
+
+def private_parse_time(value):
+    """Parse an ISO format timestamp used as pagination cursor, None if blank.
+    Raise ValueError on a malformed value."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
 
 # User
 
 
 @require_http_methods(["GET"])
+@conditional_get(lambda request, user_name: [profile_stamp(user_name)])
 def get_user_info(request, user_name: str):
     try:
-        user = User.objects.get(pk=user_name)
-        json_dict = {
-            **model_to_dict(user, fields=["user_name", "created_time", "is_active", "avatar"]),
-            **to_dict(user.user_info)
-        }
-        return JsonResponse(json_dict)
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
+        # ETag 来自数据库的版本号, 响应也从数据库读取
+        card = user_card.get(user_name, fresh=True)
+        if card is None:
+            return RESPONSE_USER_DO_NOT_EXIST
+        return serializer.json_response(card)
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+def private_profile_changed(user_name):
+    """Drop the cached card of the user and move the ETag of its profile"""
+    user_card.invalidate(user_name)
+    conditional.bump(profile_stamp(user_name))
+
+
+@require_http_methods(["GET"])
+def get_user_cards(request):
+    """Cards of many users, ?user_name=a&user_name=b or ?user_names=a,b,
+    at most MAX_PAGE_LIMIT. Users that do not exist are listed in not_found."""
+    user_names = request.GET.getlist("user_name")
+    for names in request.GET.getlist("user_names"):
+        user_names += [name for name in names.split(",") if name]
+    user_names = list(dict.fromkeys(user_names))
+    if not user_names:
+        return RESPONSE_BLANK_PARAM
+    if len(user_names) > MAX_PAGE_LIMIT:
+        return RESPONSE_INVALID_PARAM
+    try:
+        cards = user_card.get_many(user_names)
+        return serializer.json_response({
+            "result": [cards[name] for name in user_names if name in cards],
+            "not_found": [name for name in user_names if name not in cards],
+        })
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -153,6 +216,7 @@ def user_register(request):
         response.set_cookie("token", user.token)
         user.save()
         user.user_info.save()
+        private_profile_changed(user.user_name)
         return response
     except IntegrityError:
         return RESPONSE_UNIQUE_CONSTRAINT
@@ -166,13 +230,12 @@ def user_register(request):
 def post_user_tag(request):
     try:
         tag = User_Tag()
-        body_dict = json.loads(request.body.decode("utf-8"))
-        # user = body_dict.get("user_name")
+        body_dict = request.body_dict
         content = body_dict.get("content")
-        user = User.objects.get(user_name=body_dict.get("user_name"))
-        tag.user_name = user
+        tag.user_name_id = request.auth_user.user_name
         tag.content = content
         tag.save()
+        tag_index.add_user_tag(tag.user_name_id, content)
         return HttpResponse("Add tag")
     except User.DoesNotExist:
         return RESPONSE_USER_DO_NOT_EXIST
@@ -209,26 +272,9 @@ def user_send_validate_email(request):
         user.is_active = False
         user.save()
         user.user_info.save()
-        EMAIL_VERIFY_URL_PREFIX = "http://lguwelcome.online/email-validate/"
-
-        # 组装 Text 版邮件内容
-        text_content = "This is a validation email, please copy the following code: {} and finish validation\n".format(user.email_code)\
-            + "这是一封验证邮件：请复制验证码: {} 完成注册".format(user.email_code)\
-
-        # 组装 HTML 版邮件内容
-        BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        with open((os.path.join(BASE_DIR, 'email.html')), 'r') as f:
-            email_html_str = f.read()
-        email_html_str = email_html_str.replace("--code--", user.email_code).replace("--user--", user.user_name)
-
-        send_mail(
-            subject="Confirm your email 验证电子邮箱",
-            message=text_content,
-            from_email="TeaPal <{}>".format(FROM_EMAIL),
-            recipient_list=[user.email],
-            fail_silently=False,
-            html_message=email_html_str,
-        )
+        session.invalidate_user(user.user_name)
+        private_profile_changed(user.user_name)
+        mail.outbox.send(mail.build_validate_email(user, "TeaPal <{}>".format(FROM_EMAIL)))
         response = HttpResponse("Send email successfully")
         return response
     except User.DoesNotExist:
@@ -248,6 +294,8 @@ def user_email_code_validate(request):
             return RESPONSE_WRONG_EMAIL_CODE
         user.is_active = True
         user.save()
+        session.invalidate_user(user.user_name)
+        private_profile_changed(user.user_name)
         return HttpResponse(content="Validate email code successfully")
     except User.DoesNotExist:
         return RESPONSE_USER_DO_NOT_EXIST
@@ -268,26 +316,7 @@ def send_reset_password_email(request):
         user.email_code = private_generate_random_code()
         user.save()
 
-        EMAIL_VERIFY_URL_PREFIX = "http://lguwelcome.online/reset-password/"
-        link = EMAIL_VERIFY_URL_PREFIX+user.user_name+'/'+user.email_code+'/'
-
-        # 组装 Text 版邮件内容
-        text_content = "This is a validation email, please copy the following code: {} and finish validation\n".format(user.email_code)\
-            + "这是一封验证邮件：请复制验证码: {} 完成修改".format(user.email_code)\
-            # 组装 HTML 版邮件内容
-        BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        with open((os.path.join(BASE_DIR, 'email-reset-psw.html')), 'r') as f:
-            email_html_str = f.read()
-        email_html_str = email_html_str.replace("--code--", user.email_code)
-
-        send_mail(
-            subject='Reset password 重置您的密码',
-            message=text_content,
-            from_email="TeaPal <{}>".format(FROM_EMAIL),
-            recipient_list=[user.email],
-            fail_silently=False,
-            html_message=email_html_str,
-        )
+        mail.outbox.send(mail.build_reset_password_email(user, "TeaPal <{}>".format(FROM_EMAIL)))
         response = HttpResponse("Send email successfully")
         return response
     except User.DoesNotExist:
@@ -330,6 +359,7 @@ def alter_user_info(request):
             else:
                 user.password = body_dict.get("new_password", user.password)
                 user.save()
+                session.invalidate_user(user.user_name)
                 return JsonResponse({"success": True, "message": "Successfully change password!"})
         else:
             user.user_info.phone = body_dict.get("phone", user.user_info.phone)
@@ -340,6 +370,8 @@ def alter_user_info(request):
             user.avatar = body_dict.get("avatar", user.avatar)
             user.save()
             user.user_info.save()
+            session.invalidate_user(user.user_name)
+            private_profile_changed(user.user_name)
             return JsonResponse({"user_name": user.user_name,
                                  "message": "Alter user information successfully"})
     except User.DoesNotExist:
@@ -373,6 +405,7 @@ def login(request):
                                     content_type='application/json')
             response.set_cookie("token", user.token)
             user.save()
+            session.invalidate_user(user.user_name)
             return response
         else:
             return JsonResponse({"user_name": user.user_name,
@@ -388,7 +421,10 @@ def login(request):
 @require_http_methods(["POST"])
 def resume_login(request):
     try:
-        user = User.objects.get(user_name=user_name)
+        body_dict = json.loads(request.body.decode('utf-8'))
+        user = User.objects.get(user_name=body_dict.get("user_name"))
+        if request.COOKIES.get("token") != user.token:
+            return RESPONSE_AUTH_FAIL
         if user.expired_date < datetime.now():
             return RESPONSE_TOKEN_EXPIRE
         user.token = token_urlsafe(TOKEN_LENGTH)
@@ -398,6 +434,7 @@ def resume_login(request):
                                 content_type='application/json')
         response.set_cookie("token", user.token)
         user.save()
+        session.invalidate_user(user.user_name)
         return response
     except User.DoesNotExist:
         return RESPONSE_USER_DO_NOT_EXIST
@@ -409,41 +446,15 @@ def resume_login(request):
 def get_cos_credential(request):
     """
     Get cos credential.
-    By default, the duration is 30 min.
+    The credential lasts 2 hours and is shared by all users, it is cached
+    and refreshed in the background, see qa/credential.py.
     ---
     Return: json format.
     See https://cloud.tencent.com/document/product/436/31923 
     for more detail.
     """
-    config = {
-        # 临时密钥有效时长，单位是秒
-        'duration_seconds': 7200,
-        'secret_id': cos_settings["secret_id"],
-        # 固定密钥
-        'secret_key': cos_settings["secret_key"],
-        # 换成你的 bucket
-        'bucket': cos_settings["bucket"],
-        # 换成 bucket 所在地区
-        'region': cos_settings["region"],
-        # 例子： a.jpg 或者 a/* 或者 * (使用通配符*存在重大安全风险, 请谨慎评估使用)
-        'allow_prefix': '*',
-        # 密钥的权限列表。简单上传和分片需要以下的权限，其他权限列表请看 https://cloud.tencent.com/document/product/436/31923
-        'allow_actions': [
-            # 简单上传
-            'name/cos:PutObject',
-            'name/cos:PostObject',
-            # 分片上传
-            'name/cos:InitiateMultipartUpload',
-            'name/cos:ListMultipartUploads',
-            'name/cos:ListParts',
-            'name/cos:UploadPart',
-            'name/cos:CompleteMultipartUpload'
-        ],
-    }
     try:
-        sts = Sts(config)
-        response = sts.get_credential()
-        # print('get data : ' + json.dumps(dict(response), indent=4))
+        response = credential.cos_credential.get()
         return JsonResponse(dict(response))
     except Exception as e:
         raise e
@@ -456,17 +467,11 @@ def get_cos_credential(request):
 @post_token_auth_decorator()
 def post_create_chat(request):
     try:
-        body_dict = json.loads(request.body.decode('utf-8'))
-        user_a = User.objects.get(pk=body_dict.get("user_name"))
-        user_b = User.objects.get(pk=body_dict.get("to_user_name"))
-        chat = Chat.objects.filter((Q(user_a=user_a) & Q(user_b=user_b)) | (Q(user_b=user_a) & Q(user_a=user_b)))
-        if not chat:
-            chat = Chat(user_a=user_a, user_b=user_b)
-            chat.save()
-            json_dict = {"chat_id": chat.chat_id}
-        else:
-            json_dict = {"chat_id": chat[0].chat_id}
-        return JsonResponse(json_dict)
+        to_user_name = request.body_dict.get("to_user_name")
+        if not User.objects.filter(pk=to_user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        chat, _ = chat_service.get_or_create_chat(request.auth_user.user_name, to_user_name)
+        return JsonResponse({"chat_id": chat.chat_id})
     except User.DoesNotExist:
         return RESPONSE_USER_DO_NOT_EXIST
     except Exception as e:
@@ -474,39 +479,132 @@ def post_create_chat(request):
         return RESPONSE_UNKNOWN_ERROR
 
 
+# 没有消息的聊天排在最后
+INBOX_EMPTY_CHAT_TIME = datetime(1970, 1, 1)
+
+
+def query_inbox(user_name, before=None, before_id=None, limit=DEFAULT_PAGE_LIMIT):
+    """Chats of the user ordered by the time of their latest message.
+    The latest message is joined in, so one page costs a single query; the
+    participants come from the user card cache. (before, before_id) is the
+    keyset cursor of the last chat of the previous page."""
+    chats = Chat.objects.filter(Q(user_a=user_name) | Q(user_b=user_name))\
+        .select_related("last_message__lattest_message")\
+        .annotate(last_time=Coalesce("last_message__lattest_message__created_time", Value(INBOX_EMPTY_CHAT_TIME, output_field=DateTimeField())))\
+        .order_by("-last_time", "-chat_id")
+    if before is not None:
+        if before_id is None:
+            chats = chats.filter(last_time__lt=before)
+        else:
+            chats = chats.filter(Q(last_time__lt=before) | Q(last_time=before, chat_id__lt=before_id))
+    return list(chats[:limit])
+
+
+def inbox_chat_to_dict(chat, user_name, cards, positions, marks):
+    """cards: {user_name: card} of the participants,
+    positions: chat.read_positions() of the chats,
+    marks: intimacy.intimacy_marks() of the user with the other participants"""
+    if chat.user_a_id == user_name:
+        user, ano_user = cards.get(chat.user_a_id), cards.get(chat.user_b_id)
+    else:
+        user, ano_user = cards.get(chat.user_b_id), cards.get(chat.user_a_id)
+    read = {
+        "unread_cnt": positions.get((chat.chat_id, user_name), (None, 0))[1],
+        # 已读回执: 对方读到的消息
+        "ano_last_read": positions.get((chat.chat_id, ano_user["user_name"]), (None, 0))[0] if ano_user else None,
+        "intimacy": marks.get(ano_user["user_name"], 0) if ano_user else 0,
+    }
+    try:
+        lattest_message = chat.last_message.lattest_message
+    except Last_Message.DoesNotExist:
+        lattest_message = None
+    if lattest_message is None:
+        return {
+            "chat_id": chat.chat_id,
+            "avatar": user["avatar"] if user else None,
+            "ano_user": ano_user["user_name"] if ano_user else None,
+            "ano_avatar": ano_user["avatar"] if ano_user else None,
+            **read,
+        }
+    return {
+        "ano_user": ano_user["user_name"] if ano_user else None,
+        "avatar": ano_user["avatar"] if ano_user else None,
+        **to_dict(lattest_message, except_fields=["from_user", "to_user"]),
+        **read,
+    }
+
+
 @require_http_methods(["GET"])
 def get_chat(request, user_name):
-    """Get all chat messages of the user"""
+    """Get the chats of the user, most recently active first.
+    Paginated by ?before=<timestamp>&before_id=<chat_id>&limit=, pass the
+    returned next_before / next_before_id to get the following page.
+    count is the total number of chats of the user; each chat carries the
+    unread_cnt of the user, ano_last_read, the last message the other
+    user has read, and the intimacy of the two users."""
     try:
-        user = User.objects.get(pk=user_name)
-        chats = Chat.objects.filter(Q(user_a=user) | Q(user_b=user))
+        limit = private_get_limit(request)
+        before = private_parse_time(request.GET.get("before"))
+        before_id = request.GET.get("before_id")
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
+    try:
+        chats = query_inbox(user_name, before, before_id, limit)
+        if not chats and before is None and not User.objects.filter(pk=user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        cards = user_card.get_many({name for chat in chats for name in (chat.user_a_id, chat.user_b_id) if name})
+        positions = chat_service.read_positions([chat.chat_id for chat in chats]) if chats else {}
+        marks = intimacy.intimacy_marks(user_name, cards)
         json_dict = {
-            "count": chats.count(),
-            "result": []
+            "count": Chat.objects.filter(Q(user_a=user_name) | Q(user_b=user_name)).count(),
+            "result": [inbox_chat_to_dict(chat, user_name, cards, positions, marks) for chat in chats],
+            "next_before": None,
+            "next_before_id": None,
         }
-        for chat in chats:
-            try:
-                last_msg = chat.last_message
-            except Last_Message.DoesNotExist:
-                ano_user = chat.user_a if chat.user_a != user else chat.user_b
-                json_dict["result"].append({
-                    "chat_id": chat.chat_id,
-                    "avatar": user.avatar,
-                    "ano_user": ano_user.user_name,
-                    "ano_avatar": ano_user.avatar,
-                })
-            else:
-                if last_msg.lattest_message.from_user == user:
-                    ano_user = last_msg.lattest_message.to_user
-                else:
-                    ano_user = last_msg.lattest_message.from_user
-                json_dict["result"].append({
-                    "ano_user": ano_user.user_name,
-                    "avatar": ano_user.avatar,
-                    **to_dict(last_msg.lattest_message, except_fields=["from_user", "to_user"])})
-        return JsonResponse(json_dict)
-    except Chat.DoesNotExist:
-        return RESPONSE_CHAT_DO_NOT_EXIST
+        if len(chats) == limit:
+            json_dict["next_before"] = chats[-1].last_time.isoformat()
+            json_dict["next_before_id"] = chats[-1].chat_id
+        return serializer.json_response(json_dict)
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+@require_http_methods(["POST"])
+@post_token_auth_decorator()
+def post_chat_read(request):
+    """Mark the chat read, {"chat_id", "chat_message_id"} (up to the latest
+    message if chat_message_id is missing). Return the remaining unread_cnt."""
+    try:
+        body_dict = request.body_dict
+        user_name = request.auth_user.user_name
+        chat_id = int(body_dict.get("chat_id"))
+        chat_message_id = body_dict.get("chat_message_id")
+        chat_message_id = int(chat_message_id) if chat_message_id is not None else None
+    except (ValueError, TypeError):
+        return RESPONSE_INVALID_PARAM
+    try:
+        members = chat_service.chat_members([chat_id]).get(chat_id)
+        if members is None:
+            return RESPONSE_CHAT_DO_NOT_EXIST
+        if user_name not in members:
+            return RESPONSE_AUTH_FAIL
+        unread_cnt = chat_service.mark_read(chat_id, user_name, chat_message_id)
+        return JsonResponse({"chat_id": chat_id, "unread_cnt": unread_cnt})
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+@require_http_methods(["GET"])
+def get_total_unread(request):
+    """Number of unread messages over all chats of the token's user"""
+    try:
+        auth_user = private_get_auth_user(request)
+        if auth_user is None:
+            return RESPONSE_AUTH_FAIL
+        return JsonResponse({"total_unread": chat_service.total_unread(auth_user.user_name)})
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -514,57 +612,172 @@ def get_chat(request, user_name):
 # Chat Message
 
 
+MESSAGE_FIELDS = ("content", "quote", "image")
+CLIENT_KEY_MAX_LENGTH = 64
+
+
+def private_validate_message(body, members, from_user):
+    """(message fields for chat.post_message, None) or (None, error response).
+    The chat row alone tells whether from_user may write to it."""
+    to_user = chat_service.ano_member(members, from_user)
+    # chat_message 与 chat 不对应
+    if to_user is None or body.get("to_user", to_user) != to_user:
+        return None, RESPONSE_INVALID_PARAM
+    client_key = body.get("client_key") or None
+    if client_key is not None and (not isinstance(client_key, str) or len(client_key) > CLIENT_KEY_MAX_LENGTH):
+        return None, RESPONSE_INVALID_PARAM
+    message = {key: body.get(key) for key in MESSAGE_FIELDS}
+    message.update(chat_id=int(body["chat_id"]), to_user=to_user, client_key=client_key)
+    return message, None
+
+
+def private_after_message_posted(chat_message):
+    # 消息已经保存, 推送在后台线程进行, 失败不影响响应
+    realtime.publish_chat_message(to_dict(chat_message))
+    search.index_queue.update(chat_message)
+
+
 @require_http_methods(["POST"])
 @post_token_auth_decorator()
 def post_chat_message(request):
+    """Send a message, {"chat_id", "to_user", "content", "quote", "image",
+    "client_key"}. Sending again with the same client_key returns the
+    stored message instead of a duplicate."""
     try:
-        body_dict = json.loads(request.body.decode("utf-8"))
-        from_user = User.objects.get(pk=body_dict.get("user_name"))
-        to_user = User.objects.get(pk=body_dict.get("to_user"))
-        chat = Chat.objects.get(pk=body_dict.get("chat_id"))
-        # chat_message 与 chat 不对应
-        if not ((chat.user_a == from_user and chat.user_b == to_user) or (chat.user_b == from_user and chat.user_a == to_user)):
-            return RESPONSE_INVALID_PARAM
-        content = body_dict.get("content")
-        quote = body_dict.get("quote")
-        image = body_dict.get("image")
-        chat_message = Chat_Message(chat_id=chat, from_user=from_user,
-                                    to_user=to_user, content=content, quote=quote, image=image)
-        chat_message.save()
-        try:
-            last_msg = Last_Message.objects.get(chat_id=chat)
-        except Last_Message.DoesNotExist:
-            last_msg = Last_Message(chat_id=chat, lattest_message=chat_message)
-        else:
-            last_msg.lattest_message = chat_message
-        last_msg.save()
+        body_dict = request.body_dict
+        from_user = request.auth_user.user_name
+        chat_id = int(body_dict.get("chat_id"))
+        members = chat_service.chat_members([chat_id]).get(chat_id)
+        if members is None:
+            return RESPONSE_CHAT_DO_NOT_EXIST
+        message, error = private_validate_message(body_dict, members, from_user)
+        if error is not None:
+            return error
+        chat_message, created = chat_service.post_message(from_user=from_user, **message)
+        if created:
+            private_after_message_posted(chat_message)
         json_dict = {"chat_message_id:": chat_message.chat_message_id}
         return JsonResponse(json_dict)
-    except User.DoesNotExist as e:
+    except (ValueError, TypeError):
+        return RESPONSE_INVALID_PARAM
+    except Exception as e:
         raise e
-        return RESPONSE_USER_DO_NOT_EXIST
-    except Chat.DoesNotExist:
-        return RESPONSE_CHAT_DO_NOT_EXIST
+        return RESPONSE_UNKNOWN_ERROR
+
+
+@require_http_methods(["POST"])
+@post_token_auth_decorator()
+def post_chat_message_batch(request):
+    """Send many messages at once, e.g. an offline outbox,
+    {"messages": [{"chat_id", "to_user", "content", ..., "client_key"}]}.
+    Each message gets {"client_key", "chat_message_id", "created"} or
+    {"client_key", "error"}; messages already stored under their
+    client_key are not stored again."""
+    try:
+        body_dict = request.body_dict
+        from_user = request.auth_user.user_name
+        items = body_dict.get("messages")
+        if not items:
+            return RESPONSE_BLANK_PARAM
+        if not isinstance(items, list) or len(items) > MAX_PAGE_LIMIT or not all(isinstance(m, dict) for m in items):
+            return RESPONSE_INVALID_PARAM
+        for item in items:
+            try:
+                item["chat_id"] = int(item.get("chat_id"))
+            except (ValueError, TypeError):
+                item["chat_id"] = None
+        members = chat_service.chat_members({item["chat_id"] for item in items} - {None})
+        results, valid = [], []
+        for item in items:
+            if item["chat_id"] not in members:
+                results.append({"client_key": item.get("client_key"), "error": "Chat do not exist"})
+                continue
+            message, error = private_validate_message(item, members[item["chat_id"]], from_user)
+            if error is not None:
+                results.append({"client_key": item.get("client_key"), "error": error.content.decode()})
+                continue
+            results.append(message)
+            valid.append(message)
+        stored = iter(chat_service.post_messages(from_user, valid) if valid else [])
+        for i, result in enumerate(results):
+            if "error" in result:
+                continue
+            chat_message, created = next(stored)
+            if created:
+                private_after_message_posted(chat_message)
+            results[i] = {"client_key": chat_message.client_key,
+                          "chat_message_id": chat_message.chat_message_id, "created": created}
+        return serializer.json_response({"result": results})
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
+def private_parse_cursor(value):
+    """Parse a "<iso time>_<id>" keyset cursor into (time, id), None if blank.
+    Raise ValueError on a malformed value."""
+    if not value:
+        return None
+    time_str, _, id_str = value.rpartition("_")
+    return datetime.fromisoformat(time_str), int(id_str)
+
+
+def private_make_cursor(time, pk) -> str:
+    return "{}_{}".format(time.isoformat(), pk)
+
+
 @require_http_methods(["GET"])
 def get_chat_message(request, chat_id):
-    """Get all chat messages in a chat"""
+    """Get the chat messages in a chat, one page at a time.
+    Keyset paginated on (created_time, chat_message_id):
+        ?before=<cursor>  older messages, newest first (default: latest page)
+        ?after=<cursor>   newer messages, oldest first
+        ?after_id=<id>    only messages the client does not hold yet, oldest first
+    plus ?limit=. Pass next_cursor back with the same direction to continue;
+    in after_id mode it is the id of the last message returned."""
+    try:
+        limit = private_get_limit(request)
+        before = private_parse_cursor(request.GET.get("before"))
+        after = private_parse_cursor(request.GET.get("after"))
+        after_id = request.GET.get("after_id")
+        after_id = int(after_id) if after_id else None
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
     try:
         chat = Chat.objects.get(chat_id=chat_id)
-        user = User.objects.get(token=request.COOKIES.get("token"))
+        auth_user = private_get_auth_user(request)
         # not the 2 users in the given chat
-        if chat.user_a != user and chat.user_b != user:
+        if auth_user is None or auth_user.user_name not in (chat.user_a_id, chat.user_b_id):
             return RESPONSE_AUTH_FAIL
-        chat_msg = Chat_Message.objects.filter(chat_id=chat).order_by("-created_time")
-        json_dict = {"count": chat_msg.count()}
-        json_dict["result"] = [to_dict(m) for m in chat_msg]
-        return JsonResponse(json_dict)
+        chat_msg = Chat_Message.objects.filter(chat_id=chat_id)
+        if after_id is not None:
+            chat_msg = chat_msg.filter(chat_message_id__gt=after_id).order_by("chat_message_id")
+        elif after is not None:
+            chat_msg = chat_msg.filter(Q(created_time__gt=after[0]) | Q(created_time=after[0], chat_message_id__gt=after[1]))\
+                .order_by("created_time", "chat_message_id")
+        else:
+            if before is not None:
+                chat_msg = chat_msg.filter(Q(created_time__lt=before[0]) | Q(created_time=before[0], chat_message_id__lt=before[1]))
+            chat_msg = chat_msg.order_by("-created_time", "-chat_message_id")
+        # 多取一条用来判断是否还有下一页, 直接序列化 values_list 的结果
+        chat_msg_serializer = serializer.serializer_for(Chat_Message)
+        rows = chat_msg_serializer.from_rows(chat_msg.values_list(*chat_msg_serializer.attnames)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = None
+        if has_more:
+            # after_id 按 id 排序, 游标也是 id
+            next_cursor = str(rows[-1]["chat_message_id"]) if after_id is not None else \
+                private_make_cursor(rows[-1]["created_time"], rows[-1]["chat_message_id"])
+        json_dict = {
+            "count": len(rows),
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "result": rows,
+        }
+        return serializer.json_response(json_dict)
     except Chat.DoesNotExist:
-        return RESPONSE_DO_NOT_EXIST
+        return RESPONSE_CHAT_DO_NOT_EXIST
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -574,12 +787,16 @@ def get_chat_message(request, chat_id):
 @post_token_auth_decorator()
 def delete_chat_message(request):
     try:
-        body_dict = json.loads(request.body.decode('utf-8'))
+        body_dict = request.body_dict
         chat_msg = Chat_Message.objects.get(pk=body_dict.get("chat_message_id"))
         # 非用户本人无法删除信息
-        if chat_msg.from_user.user_name != body_dict.get("user_name"):
+        if chat_msg.from_user_id != request.auth_user.user_name:
             return RESPONSE_AUTH_FAIL
-        chat_msg.delete()
+        # delete() 会清空实例的主键, 用副本在提交后移出索引
+        removed = Chat_Message(pk=chat_msg.pk)
+        with transaction.atomic():
+            chat_service.delete_message(chat_msg)
+            transaction.on_commit(lambda: search.index_queue.remove(removed))
         return HttpResponse(content="Delete chat message successfully")
     except Chat_Message.DoesNotExist:
         return RESPONSE_CHAT_MSG_DO_NOT_EXIST
@@ -594,22 +811,21 @@ def delete_chat_message(request):
 @post_token_auth_decorator()
 def post_follow(request):
     try:
-        body_dict = json.loads(request.body.decode('utf-8'))
-        user = User.objects.get(user_name=body_dict.get("user_name"))
-        user_info = User_Info.objects.get(user_name=user)
-        follow_user = User.objects.get(user_name=body_dict.get("follow_user_name"))
-        follow_user_info = User_Info.objects.get(user_name=follow_user)
-        friendship = Friendship()
-        friendship.follow = follow_user
-        friendship.follower = user
-        user_info.follow_cnt += 1
-        follow_user_info.follower_cnt += 1
-        friendship.save()
-        user_info.save()
-        follow_user_info.save()
+        user_name = request.auth_user.user_name
+        follow_user_name = request.body_dict.get("follow_user_name")
+        if not User.objects.filter(pk=follow_user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        try:
+            with transaction.atomic():
+                Friendship.objects.create(follow_id=follow_user_name, follower_id=user_name)
+                counters.change_follow_counts(user_name, follow_user_name, 1)
+                timeline.backfill(user_name, follow_user_name)
+                conditional.bump(friendship_stamp(user_name), friendship_stamp(follow_user_name))
+        except IntegrityError:
+            # 已经关注
+            return RESPONSE_UNIQUE_CONSTRAINT
+        pair.follow_changed(user_name, follow_user_name)
         return HttpResponse("Followed")
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -619,62 +835,102 @@ def post_follow(request):
 @post_token_auth_decorator()
 def post_unfollow(request):
     try:
-        body_dict = json.loads(request.body.decode('utf-8'))
-        user = User.objects.get(user_name=body_dict.get("user_name"))
-        user_info = User_Info.objects.get(user_name=user)
-        follow_user = User.objects.get(user_name=body_dict.get("follow_user_name"))
-        follow_user_info = User_Info.objects.get(user_name=follow_user)
-        friendship = Friendship.objects.filter(Q(follow=follow_user) & Q(follower=user))
-        friendship.delete()
-        user_info.follow_cnt -= 1
-        follow_user_info.follower_cnt -= 1
-        user_info.save()
-        follow_user_info.save()
+        user_name = request.auth_user.user_name
+        follow_user_name = request.body_dict.get("follow_user_name")
+        if not User.objects.filter(pk=follow_user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        with transaction.atomic():
+            deleted, _ = Friendship.objects.filter(Q(follow=follow_user_name) & Q(follower=user_name)).delete()
+            counters.change_follow_counts(user_name, follow_user_name, -deleted)
+            if not Friendship.objects.filter(follow=follow_user_name, follower=user_name).exists():
+                timeline.remove_author(user_name, follow_user_name)
+            conditional.bump(friendship_stamp(user_name), friendship_stamp(follow_user_name))
+        pair.follow_changed(user_name, follow_user_name)
         return HttpResponse("Unfollowed")
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
+def private_friendships(user_name, side):
+    """Friendship rows listed by get_follower (side "follower") or get_follow
+    (side "follow")"""
+    if side == "follower":
+        return Friendship.objects.filter(follow=user_name, follower__isnull=False)
+    return Friendship.objects.filter(follower=user_name, follow__isnull=False)
+
+
+def private_friendship_rows(request, friendships, side):
+    """([(user_name, created_time, friendship_id)], has_more) of one page,
+    newest first. Raise ValueError on malformed ?before= / ?limit=."""
+    limit = private_get_limit(request)
+    before = private_parse_cursor(request.GET.get("before"))
+    if before is not None:
+        friendships = friendships.filter(Q(created_time__lt=before[0]) | Q(created_time=before[0], friendship_id__lt=before[1]))
+    friendships = list(friendships.order_by("-created_time", "-friendship_id")
+                       .values_list(side + "_id", "created_time", "friendship_id")[:limit + 1])
+    return friendships[:limit], len(friendships) > limit
+
+
+def private_friendship_stamps(side):
+    """conditional_get keys of a follower / follow page: the owner's profile
+    and friendships, and the profiles of the users on the page"""
+    def keys(request, user_name):
+        stamps = [profile_stamp(user_name), friendship_stamp(user_name)]
+        try:
+            friendships, _ = private_friendship_rows(request, private_friendships(user_name, side), side)
+        except ValueError:
+            # 参数错误的请求返回 400, 不打 ETag
+            return stamps
+        return stamps + [profile_stamp(f[0]) for f in friendships]
+    return keys
+
+
+def private_friendship_page(request, friendships, side):
+    """One page of user cards from friendships, newest first.
+    side is "follower" or "follow", the user of each friendship to return.
+    The cards are read from the database, the page is tagged by an ETag.
+    Raise ValueError on malformed ?before= / ?limit=."""
+    friendships, has_more = private_friendship_rows(request, friendships, side)
+    cards = user_card.get_many((f[0] for f in friendships), fresh=True)
+    return {
+        "result": [cards[f[0]] for f in friendships if f[0] in cards],
+        "has_more": has_more,
+        "next_cursor": private_make_cursor(friendships[-1][1], friendships[-1][2]) if has_more else None,
+    }
+
+
 @require_http_methods(["GET"])
+@conditional_get(private_friendship_stamps("follower"))
 def get_follower(request, user_name):
+    """Followers of the user, newest first, paginated by ?before=<cursor>&limit="""
     try:
-        user = User.objects.get(user_name=user_name)
-        user_info = User_Info.objects.get(user_name=user)
-        friendships = Friendship.objects.filter(follow=user).order_by("-created_time")
-        json_dict = {"total_follower": user_info.follower_cnt}
-        json_dict["result"] = [
-            {
-                **to_dict(f.follower.user_info),
-                "avatar": f.follower.avatar
-            } for f in friendships
-        ]
-        return JsonResponse(json_dict)
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
+        total = User_Info.objects.filter(pk=user_name).values_list("follower_cnt", flat=True).first()
+        if total is None:
+            return RESPONSE_USER_DO_NOT_EXIST
+        friendships = private_friendships(user_name, "follower")
+        json_dict = {"total_follower": total, **private_friendship_page(request, friendships, "follower")}
+        return serializer.json_response(json_dict)
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
 @require_http_methods(["GET"])
+@conditional_get(private_friendship_stamps("follow"))
 def get_follow(request, user_name):
+    """Users the user follows, newest first, paginated by ?before=<cursor>&limit="""
     try:
-        user = User.objects.get(user_name=user_name)
-        user_info = User_Info.objects.get(user_name=user)
-        friendships = Friendship.objects.filter(follower=user).order_by("-created_time")
-        json_dict = {"total_follow": user_info.follow_cnt}
-        json_dict["result"] = [
-            {
-                **to_dict(f.follow.user_info),
-                "avatar": f.follow.avatar
-            } for f in friendships
-        ]
-        return JsonResponse(json_dict)
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
+        total = User_Info.objects.filter(pk=user_name).values_list("follow_cnt", flat=True).first()
+        if total is None:
+            return RESPONSE_USER_DO_NOT_EXIST
+        friendships = private_friendships(user_name, "follow")
+        json_dict = {"total_follow": total, **private_friendship_page(request, friendships, "follow")}
+        return serializer.json_response(json_dict)
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -687,31 +943,15 @@ def get_initialize_pair(request, user_name):
     """在用户刚刚创建账号时推荐用户根据标签的重合度
         返回三个，根据follower的数量返回三个"""
     try:
-        user = User.objects.get(pk=user_name)
-        tags = User_Tag.objects.filter(user_name=user)
-        user_repeat, json_dict = {}, {}
-        result = []
-        for tag in tags:
-            repeat_tag = User_Tag.objects.filter(content__icontains=tag)
-            for t in repeat_tag:
-                user_repeat[t.user_name] = user_repeat.get(t.user_name) + 1
-        user_repeat = sorted(user_repeat.items(), key=lambda item: item[1])[-3:]
-        popular_user = User_Info.objects.all().order_by('-follower_cnt')[:3]
-        L = [
-            {
-                **to_dict(p)
-            } for p in popular_user
-        ]
-        for i, _ in user_repeat:
-            user_info = User_Info.objects.get(user_name=i)
-            json_dict["result"].append({
-                **to_dict(user_info),
-            })
-        result = [i for i in L if i not in result]
-        json_dict["result"] = result
-        return JsonResponse(json_dict)
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
+        if not User.objects.filter(pk=user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        similar_user = [name for name, _ in tag_index.top_overlap_users(user_name, k=3)]
+        popular_user = list(User_Info.objects.filter(~Q(user_name=user_name)).order_by('-follower_cnt')
+                            .values_list("user_name", flat=True)[:3])
+        cards = user_card.get_many(similar_user + popular_user)
+        result = [cards[name] for name in similar_user if name in cards]
+        result += [cards[name] for name in popular_user if name in cards and name not in similar_user]
+        return serializer.json_response({"result": result})
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -725,16 +965,6 @@ def calc_total_friends(user):
         return 0
 
 
-def calc_common_friends(friendships, p_friendships):
-    interact_friends = [f for f in friendships if f in p_friendships]
-    union_friends = list(set(friendships).union(set(p_friendships)))
-    N = len(interact_friends)
-    w_jaccord = float(N/len(union_friends))
-    w_common_friends = [float(1/math.log2(i)) for f in interact_friends]
-    w_common_friends = sum(w_common_friends)
-    return float(w_common_friends * (len(interact_friends)/len(union_friends)))
-
-
 # def calc_tag_appearances(tag, moment):
 #     return moment.content.count(tag.content.count())
 
@@ -742,70 +972,47 @@ def calc_common_friends(friendships, p_friendships):
 #     for tag in repeated_tags:
 
 
-def calc_pair_degree(user, p, friendships, tags):
-    """计算匹配度，用杰卡比相似系数与共同好友的好友数对共同好友数加权"""
-    try:
-        # p_moment = Moment.objects.get(user_name=p)
-        p_tags = User_Tag.objects.filter(user_name=p)
-        # repeated_tags = [i for i in tags if i in p_tags]
-        p_friendships = Friendship.objects.filter(follower=p)
-        pair_degree = calc_common_friends(friendships, p_friendships)
-        pair = Pair()
-        pair.user_a = user
-        pair.user_b = p
-        pair.pair_degree = pair_degree
-        pair.save()
-    except Exception as e:
-        raise e
-        return RESPONSE_UNKNOWN_ERROR
-
-
 @require_http_methods(["POST"])
 @post_token_auth_decorator()
 def post_pair_degree(request):
     try:
-        body_dict = json.loads(request.body.decode('utf-8'))
-        user = User.objects.get(user_name=body_dict.get("user_name"))
-        tags = User_Tag.objects.filter(user_name=user)
-        # moments = Moment.objects.get(user_name=user)
-        friendships = Friendship.objects.filter(follower=user)
-        pair_user = User.objects.filter(~Q(user_name=body_dict.get("user_name")))
-        for p in pair_user:
-            calc_pair_degree(user, p, friendships, tags)
+        pair.update_user_pairs(request.auth_user.user_name)
         return HttpResponse("Pair_degree has been updated")
-    except User.DoesNotExist:
-        return RESPONSE_DO_NOT_EXIST
-    except User_Tag.DoesNotExist:
-        return RESPONSE_TAG_DO_NOT_EXIST
-    except Friendship.DoesNotExist:
-        return RESPONSE_FRIENDSHIP_DO_NOT_EXIST
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
+def private_pair_degree_users(user_name):
+    """(paired_user, popular_user) listed by get_pair_degree"""
+    pairs = Pair.objects.filter(Q(user_a=user_name) | Q(user_b=user_name)).order_by("-pair_degree")\
+        .values_list("user_a_id", "user_b_id")[:4]
+    paired_user = [a if a != user_name else b for a, b in pairs]
+    popular_user = list(User_Info.objects.filter(~Q(user_name=user_name)).order_by("-follower_cnt")
+                        .values_list("user_name", flat=True)[:2])
+    return paired_user, popular_user
+
+
+def private_pair_degree_stamps(request, user_name):
+    """The pairs of the user and the profiles of the listed users; the
+    popular users change with their follower_cnt, so the ETag also follows
+    which users are listed"""
+    paired_user, popular_user = private_pair_degree_users(user_name)
+    return [pair_stamp(user_name), conditional.INTIMACY_STAMP] + [profile_stamp(name) for name in paired_user + popular_user]
+
+
 @require_http_methods(["GET"])
+@conditional_get(private_pair_degree_stamps)
 def get_pair_degree(request, user_name):
     try:
-        user = User.objects.get(user_name=user_name)
-        pairs = Pair.objects.filter(Q(user_a=user) | Q(user_b=user)).order_by("-pair_degree")[:4]
-        popular_user = User_Info.objects.filter(~Q(user_name=user_name)).order_by("-follower_cnt")[:2]
-        json_dict = dict(result=[])
-        for p in pairs:
-            if p.user_a != user:
-                p_user_info = User_Info.objects.get(user_name=p.user_a)
-                json_dict["result"].append(
-                    model_to_dict(p_user_info)
-                )
-            else:
-                p_user_info = User_Info.objects.get(user_name=p.user_b)
-                json_dict["result"].append(
-                    model_to_dict(p_user_info)
-                )
-        json_dict["result"].append([{
-            **to_dict(u)
-        } for u in popular_user])
-        return JsonResponse(json_dict)
+        if not User.objects.filter(pk=user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        paired_user, popular_user = private_pair_degree_users(user_name)
+        cards = user_card.get_many(paired_user + popular_user, fresh=True)
+        json_dict = dict(result=[cards[name] for name in paired_user if name in cards])
+        json_dict["result"].append([cards[name] for name in popular_user if name in cards])
+        json_dict["intimacy"] = intimacy.intimacy_marks(user_name, paired_user + popular_user)
+        return serializer.json_response(json_dict)
     except Pair.DoesNotExist:
         get_initialize_pair(request, user_name)
     except User.DoesNotExist:
@@ -824,48 +1031,168 @@ def post_moment(request):
         user = User.objects.get(pk=body_dict.get("user_name"))
         moment = Moment(user_name=user, content=body_dict.get("content"),
                         image=body_dict.get("image"), quote=body_dict.get("quote"))
-        moment.save()
+        with transaction.atomic():
+            moment.save()
+            feed.incr_moment_count(user.user_name)
+            timeline.fan_out(moment)
+        search.index_queue.update(moment)
         json_dict = {"moment_id": moment.moment_id}
         return JsonResponse(json_dict)
+    except User.DoesNotExist:
+        return RESPONSE_USER_DO_NOT_EXIST
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
-@require_http_methods(["GET"])
-def get_user_moments(request, user_name: str, page=1, per_page=6):
-    try:
-        user = User.objects.get(pk=user_name)
-        moments = Moment.objects.filter(user_name=user).order_by("-created_time")
-        json_dict = {
-            "count": moments.count(),
+def private_moment_page(request, user_name, total, page, per_page):
+    """A page of the moment feed of the user (of everyone if None).
+    With page, the old page-number pagination; otherwise keyset pagination
+    by ?before=<cursor>&limit=. The first page comes from the feed cache.
+    Raise ValueError on malformed parameters."""
+    if page is not None:
+        if page < 1:
+            raise ValueError("page starts from 1")
+        if page == 1:
+            moments, _ = feed.first_page(user_name, total, per_page)
+        else:
+            moments = Moment.objects.all() if user_name is None else Moment.objects.filter(user_name=user_name)
+            moments = feed.moment_rows(moments.order_by("-created_time", "-moment_id"), per_page*(page-1), per_page*page)
+        return {
+            "count": total,
             "current_page": page,
-            "result": [],
+            "result": moments,
         }
-        moments = moments[per_page*(page-1):per_page*page]
-        for moment in moments:
-            json_dict["result"].append(to_dict(moment))
-        return JsonResponse(json_dict)
-    except User.DoesNotExist:
-        return RESPONSE_USER_DO_NOT_EXIST
+    limit = private_get_limit(request, default=per_page)
+    before = private_parse_cursor(request.GET.get("before"))
+    if before is None:
+        moments, has_more = feed.first_page(user_name, total, limit)
+    else:
+        moments, has_more = feed.query_moments(user_name, before, limit)
+    return {
+        "count": total,
+        "result": moments,
+        "has_more": has_more,
+        "next_cursor": private_make_cursor(moments[-1]["created_time"], moments[-1]["moment_id"]) if has_more else None,
+    }
+
+
+@require_http_methods(["GET"])
+@conditional_get(lambda request, user_name, **kwargs: [moment_stamp(user_name)])
+def get_user_moments(request, user_name: str, page=None, per_page=6):
+    try:
+        total = feed.moment_total(user_name)
+        if total is None:
+            return RESPONSE_USER_DO_NOT_EXIST
+        return serializer.json_response(private_moment_page(request, user_name, total, page, per_page))
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+@require_http_methods(["GET"])
+def get_lattest_moments(request, page=None, per_page=6):
+    try:
+        total = feed.moment_total()
+        return serializer.json_response(private_moment_page(request, None, total, page, per_page))
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
 
 
 @require_http_methods(["GET"])
-def get_lattest_moments(request, page=1, per_page=6):
+def get_timeline(request, user_name: str):
+    """Home timeline of the user: moments of the user and of the users it
+    follows, newest first, paginated by ?before=<cursor>&limit="""
+    try:
+        limit = private_get_limit(request)
+        before = private_parse_cursor(request.GET.get("before"))
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
     try:
-        moments = Moment.objects.all().order_by("-created_time")
+        if not User.objects.filter(pk=user_name).exists():
+            return RESPONSE_USER_DO_NOT_EXIST
+        moments, has_more = timeline.read(user_name, before, limit)
         json_dict = {
-            "count": moments.count(),
-            "current_page": page,
-            "result": [],
+            "result": [to_dict(moment) for moment in moments],
+            "has_more": has_more,
+            "next_cursor": private_make_cursor(moments[-1].created_time, moments[-1].moment_id) if has_more else None,
         }
-        moments = moments[per_page*(page-1):per_page*page]
-        for moment in moments:
-            json_dict["result"].append(to_dict(moment))
-        return JsonResponse(json_dict)
+        return serializer.json_response(json_dict)
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+# Search
+
+
+@require_http_methods(["GET"])
+def search_moment(request):
+    """Full-text search of moments, ?q=<words>&limit="""
+    try:
+        q = request.GET.get("q", "").strip()
+        limit = private_get_limit(request)
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
+    if not q:
+        return RESPONSE_BLANK_PARAM
+    if not search.search_enabled():
+        return RESPONSE_SEARCH_DISABLED
+    try:
+        moments = search.search_moments(q, limit)
+        return serializer.json_response({"count": len(moments), "result": [to_dict(m) for m in moments]})
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+
+@require_http_methods(["GET"])
+def search_chat_message(request):
+    """Full-text search of the chat messages of the token's user, ?q=<words>&limit="""
+    try:
+        q = request.GET.get("q", "").strip()
+        limit = private_get_limit(request)
+    except ValueError:
+        return RESPONSE_INVALID_PARAM
+    if not q:
+        return RESPONSE_BLANK_PARAM
+    if not search.search_enabled():
+        return RESPONSE_SEARCH_DISABLED
+    try:
+        auth_user = private_get_auth_user(request)
+        if auth_user is None:
+            return RESPONSE_AUTH_FAIL
+        chat_msg = search.search_chat_messages(auth_user.user_name, q, limit)
+        return serializer.json_response({"count": len(chat_msg), "result": [to_dict(m) for m in chat_msg]})
+    except Exception as e:
+        raise e
+        return RESPONSE_UNKNOWN_ERROR
+
+# Batch
+
+
+@require_http_methods(["POST"])
+def post_batch(request):
+    """Run {"requests": [{"method", "path", "body", "headers"}, ...]} in
+    one round trip, see qa/batch.py. Return {"responses": [{"status",
+    "headers", "body"}, ...]} in the order of the requests."""
+    try:
+        body_dict = json.loads(request.body.decode('utf-8'))
+        items = body_dict.get("requests")
+    except (ValueError, AttributeError):
+        return RESPONSE_INVALID_PARAM
+    if not items:
+        return RESPONSE_BLANK_PARAM
+    if not isinstance(items, list) or len(items) > batch.BATCH_MAX_REQUESTS:
+        return RESPONSE_INVALID_PARAM
+    try:
+        auth_user = private_get_auth_user(request)
+        return serializer.json_response({"responses": batch.run_batch(request, items, auth_user)})
     except Exception as e:
         raise e
         return RESPONSE_UNKNOWN_ERROR
@@ -0,0 +1,30 @@
+"""
+Whoosh backend for haystack that tokenizes text fields with jieba, so
+Chinese content is searchable by word. Use it with
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'qa.whoosh_cn_backend.WhooshEngine',
+            'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
+        },
+    }
+"""
+from haystack.backends.whoosh_backend import WhooshSearchBackend, WhooshEngine as BaseWhooshEngine
+from jieba.analyse import ChineseAnalyzer
+from whoosh.fields import TEXT
+
+
+class ChineseWhooshSearchBackend(WhooshSearchBackend):
+    def build_schema(self, fields):
+        content_field_name, schema = super().build_schema(fields)
+        for name in schema.names():
+            field = schema[name]
+            if isinstance(field, TEXT):
+                schema.remove(name)
+                schema.add(name, TEXT(stored=field.stored, analyzer=ChineseAnalyzer(),
+                                      field_boost=field.format.field_boost, sortable=True))
+        return content_field_name, schema
+
+
+class WhooshEngine(BaseWhooshEngine):
+    backend = ChineseWhooshSearchBackend